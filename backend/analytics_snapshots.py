@@ -0,0 +1,510 @@
+"""
+Columnar analytics snapshots.
+
+The exporter copies proof_identity, fraude, exam_attempts, quiz_submissions
+(and the students they are joined with) to Parquet files partitioned by day
+under ANALYTICS_SNAPSHOT_DIR. Each run only reads documents newer than the
+per-collection watermark saved by the previous run. The API runs it every
+ANALYTICS_EXPORT_INTERVAL_SECONDS (SnapshotExporter; one worker at a time,
+through a lock file); documents changed after their export are only
+refreshed by a --full run.
+
+AnalyticsEngine loads those files into Arrow/NumPy columns and answers the
+analytics endpoints, plus cross-cohort aggregates, without reading
+Firestore document by document. A student's view also reads the proofs and
+fraud reports written since the last export from Firestore.
+
+    python analytics_snapshots.py          # incremental export
+    python analytics_snapshots.py --full   # rebuild every snapshot
+"""
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from dates import to_utc
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # snapshots are disabled without pyarrow
+    pa = None
+    pq = None
+
+PAGE_SIZE = 1000
+WATERMARKS_FILE = "_watermarks.json"
+LOCK_FILE = "_export.lock"
+EXPORT_INTERVAL_SECONDS = 900
+
+logger = logging.getLogger(__name__)
+
+# collection -> (watermark field, {column: type})
+EXPORTS = {
+    "students": ("created_at", {
+        "name": "string",
+        "field": "string",
+        "created_at": "timestamp",
+    }),
+    "proof_identity": ("created_at", {
+        "id_student": "string",
+        "accuracy": "float",
+        "precision": "float",
+        "type_cognitive": "string",
+        "temp_moyen_question": "float",
+        "niveau_focus": "float",
+        "violation": "int",
+        "score_consistante": "float",
+        "patern_dominante": "string",
+        "score_integrité": "float",
+        "scoring_version": "int",
+        "created_at": "timestamp",
+    }),
+    "fraude": ("date_fraude", {
+        "id_ref": "string",
+        "ref_type": "string",
+        "nombre_fraude": "int",
+        "type_fraude": "string",
+        "date_fraude": "timestamp",
+    }),
+    "exam_attempts": ("started_at", {
+        "exam_id": "string",
+        "student_id": "string",
+        "status": "string",
+        "fraud_attempts": "int",
+        "score": "float",
+        "started_at": "timestamp",
+        "completed_at": "timestamp",
+        "terminated_at": "timestamp",
+    }),
+    "quiz_submissions": ("submitted_at", {
+        "quiz_id": "string",
+        "student_id": "string",
+        "status": "string",
+        "score": "float",
+        "submitted_at": "timestamp",
+    }),
+}
+
+
+def _coerce(value, kind: str):
+    try:
+        if value is None:
+            return None
+        if kind == "timestamp":
+            return to_utc(value)
+        if kind == "float":
+            return float(value)
+        if kind == "int":
+            return int(value)
+        if kind == "bool":
+            return bool(value)
+        return str(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _arrow_type(kind: str):
+    return {
+        "string": pa.string(),
+        "float": pa.float64(),
+        "int": pa.int64(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+    }[kind]
+
+
+def _schema(columns: Dict[str, str]):
+    fields = [pa.field("document_id", pa.string()), pa.field("_exported_at", pa.timestamp("us", tz="UTC"))]
+    fields += [pa.field(name, _arrow_type(kind)) for name, kind in columns.items()]
+    return pa.schema(fields)
+
+
+# =============================================================================
+# EXPORTER
+# =============================================================================
+
+def _load_watermarks(snapshot_dir: str) -> Dict[str, str]:
+    path = os.path.join(snapshot_dir, WATERMARKS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def _save_watermarks(snapshot_dir: str, watermarks: Dict[str, str]):
+    path = os.path.join(snapshot_dir, WATERMARKS_FILE)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(watermarks, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _write_rows(snapshot_dir: str, collection: str, rows: List[Dict[str, Any]], watermark_field: str, run_id: str, part: int):
+    """Write one page of rows as a Parquet file per day partition"""
+    schema = _schema(EXPORTS[collection][1])
+    by_day: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        by_day.setdefault(row[watermark_field].strftime("%Y-%m-%d"), []).append(row)
+
+    for day, day_rows in by_day.items():
+        directory = os.path.join(snapshot_dir, collection, f"date={day}")
+        os.makedirs(directory, exist_ok=True)
+        table = pa.Table.from_pylist(day_rows, schema=schema)
+        pq.write_table(table, os.path.join(directory, f"part-{run_id}-{part:05d}.parquet"), compression="zstd")
+
+
+def export_collection(db, snapshot_dir: str, collection: str, watermark: Optional[datetime], page_size: int = PAGE_SIZE) -> Optional[datetime]:
+    """Export documents newer than watermark and return the new watermark"""
+    watermark_field, columns = EXPORTS[collection]
+    exported_at = datetime.now(timezone.utc)
+    run_id = exported_at.strftime("%Y%m%dT%H%M%S%f")
+
+    query = db.collection(collection).order_by(watermark_field)
+    if watermark is not None:
+        query = query.where(watermark_field, '>', watermark)
+
+    last_doc = None
+    part = 0
+    while True:
+        page_query = query.start_after(last_doc) if last_doc is not None else query
+        docs = list(page_query.limit(page_size).stream())
+        if not docs:
+            break
+
+        rows = []
+        for doc in docs:
+            data = doc.to_dict()
+            row = {name: _coerce(data.get(name), kind) for name, kind in columns.items()}
+            if row[watermark_field] is None:
+                continue
+            row["document_id"] = doc.id
+            row["_exported_at"] = exported_at
+            rows.append(row)
+            if watermark is None or row[watermark_field] > watermark:
+                watermark = row[watermark_field]
+
+        if rows:
+            _write_rows(snapshot_dir, collection, rows, watermark_field, run_id, part)
+            part += 1
+        last_doc = docs[-1]
+        if len(docs) < page_size:
+            break
+
+    return watermark
+
+
+def export_snapshots(db, snapshot_dir: str, full: bool = False, page_size: int = PAGE_SIZE) -> Dict[str, str]:
+    """Incrementally export every collection of EXPORTS"""
+    if pa is None:
+        raise RuntimeError("pyarrow est requis pour les snapshots analytiques")
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    watermarks = {} if full else _load_watermarks(snapshot_dir)
+
+    for collection in EXPORTS:
+        if full:
+            shutil.rmtree(os.path.join(snapshot_dir, collection), ignore_errors=True)
+        previous = watermarks.get(collection)
+        watermark = export_collection(
+            db, snapshot_dir, collection,
+            datetime.fromisoformat(previous) if previous else None,
+            page_size
+        )
+        if watermark is not None:
+            watermarks[collection] = watermark.isoformat()
+
+    # Written last: readers reload when this file changes
+    _save_watermarks(snapshot_dir, watermarks)
+    return watermarks
+
+
+class SnapshotExporter:
+    """Runs the incremental export in the background, one worker at a time"""
+
+    def __init__(self, db, snapshot_dir: str, interval: float = EXPORT_INTERVAL_SECONDS):
+        self.db = db
+        self.snapshot_dir = snapshot_dir
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def export(self) -> Optional[Dict[str, str]]:
+        """Incremental export, None when another worker is running one"""
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        with open(os.path.join(self.snapshot_dir, LOCK_FILE), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            return export_snapshots(self.db, self.snapshot_dir)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.export)
+            except Exception:
+                logger.exception("Analytics snapshot export failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def _rows_since(db, collection: str, field: str, value: str, watermark: Optional[datetime]) -> List[Dict[str, Any]]:
+    """Snapshot rows of the documents with field == value not exported yet"""
+    watermark_field, columns = EXPORTS[collection]
+    rows = []
+    for doc in db.collection(collection).where(field, '==', value).select(list(columns)).stream():
+        data = doc.to_dict()
+        row = {name: _coerce(data.get(name), kind) for name, kind in columns.items()}
+        if row[watermark_field] is not None and (watermark is None or row[watermark_field] > watermark):
+            row["document_id"] = doc.id
+            rows.append(row)
+    return rows
+
+
+# =============================================================================
+# ANALYTICS ENGINE
+# =============================================================================
+
+def _count_by(values: np.ndarray, weights: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    if not len(values):
+        return {}
+    values = np.where(values == None, "Unknown", values).astype(str)  # noqa: E711 (element-wise)
+    keys, inverse = np.unique(values, return_inverse=True)
+    counts = np.bincount(inverse, weights=weights, minlength=len(keys))
+    return {str(key): (int(count) if weights is None else float(count)) for key, count in zip(keys, counts)}
+
+
+class AnalyticsEngine:
+    """Answers analytics queries from the Parquet snapshots"""
+
+    def __init__(self, snapshot_dir: str):
+        self.snapshot_dir = snapshot_dir
+        self._tables: Dict[str, Dict[str, np.ndarray]] = {}
+        self._watermarks: Dict[str, datetime] = {}
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return pa is not None and os.path.exists(os.path.join(self.snapshot_dir, WATERMARKS_FILE))
+
+    def _read_table(self, collection: str) -> Dict[str, np.ndarray]:
+        """Read a collection snapshot, keeping the latest export of every document"""
+        columns = ["document_id", "_exported_at"] + list(EXPORTS[collection][1])
+        directory = os.path.join(self.snapshot_dir, collection)
+        if os.path.isdir(directory):
+            table = pq.read_table(directory, columns=columns, partitioning=None)
+        else:
+            table = _schema(EXPORTS[collection][1]).empty_table()
+
+        table = table.sort_by([("_exported_at", "descending")])
+        _, first = np.unique(table.column("document_id").to_numpy(zero_copy_only=False), return_index=True)
+        table = table.take(pa.array(np.sort(first)))
+
+        return {
+            name: table.column(name).to_numpy(zero_copy_only=False)
+            for name in columns
+        }
+
+    def _refresh(self):
+        mtime = os.path.getmtime(os.path.join(self.snapshot_dir, WATERMARKS_FILE))
+        if mtime == self._loaded_mtime:
+            return
+        with self._lock:
+            if mtime != self._loaded_mtime:
+                self._tables = {collection: self._read_table(collection) for collection in EXPORTS}
+                self._watermarks = {
+                    collection: datetime.fromisoformat(value)
+                    for collection, value in _load_watermarks(self.snapshot_dir).items()
+                }
+                self._loaded_mtime = mtime
+
+    def table(self, collection: str) -> Dict[str, np.ndarray]:
+        self._refresh()
+        return self._tables[collection]
+
+    def watermark(self, collection: str) -> Optional[datetime]:
+        """Newest watermark field value exported for a collection"""
+        self._refresh()
+        return self._watermarks.get(collection)
+
+    def _latest_proofs(self) -> Dict[str, np.ndarray]:
+        """One proof per student, the most recent"""
+        proofs = self.table("proof_identity")
+        if not len(proofs["document_id"]):
+            return proofs
+        order = np.argsort(proofs["created_at"])[::-1]
+        _, first = np.unique(proofs["id_student"][order].astype(str), return_index=True)
+        keep = order[first]
+        return {name: values[keep] for name, values in proofs.items()}
+
+    def dashboard(self) -> Dict[str, Any]:
+        proofs = self.table("proof_identity")
+        return {
+            "students": len(self.table("students")["document_id"]),
+            "completed_tests": len(proofs["document_id"]),
+            "fraudes": len(self.table("fraude")["document_id"]),
+            "cognitive_type_distribution": _count_by(proofs["type_cognitive"]),
+        }
+
+    def field(self, field: str) -> Dict[str, Any]:
+        students = self.table("students")
+        field_students = students["document_id"][students["field"] == field]
+        proofs = self._latest_proofs()
+        in_field = np.isin(proofs["id_student"].astype(str), field_students.astype(str))
+
+        total_students = len(field_students)
+        completed_tests = int(in_field.sum())
+        accuracy = np.nan_to_num(proofs["accuracy"][in_field].astype(np.float64))
+        avg_accuracy = float(accuracy.mean()) if completed_tests else 0
+        completion_rate = (completed_tests / total_students * 100) if total_students > 0 else 0
+
+        return {
+            "field": field,
+            "total_students": total_students,
+            "completed_tests": completed_tests,
+            "completion_rate": round(completion_rate, 2),
+            "avg_accuracy": round(avg_accuracy * 100, 2),
+            "cognitive_type_distribution": _count_by(proofs["type_cognitive"][in_field]),
+        }
+
+    def student(self, student_id: str, db=None) -> Dict[str, Any]:
+        """Latest proof and fraud reports of a student, completed from Firestore when db is given"""
+        proofs = self._latest_proofs()
+        proof_data = None
+        matches = np.flatnonzero(proofs["id_student"] == student_id)
+        if len(matches):
+            i = matches[0]
+            proof_data = {
+                name: _to_python(proofs[name][i])
+                for name in EXPORTS["proof_identity"][1]
+            }
+            proof_data["document_id"] = proofs["document_id"][i]
+
+        fraudes_table = self.table("fraude")
+        fraudes = [
+            {name: _to_python(fraudes_table[name][i]) for name in ["document_id"] + list(EXPORTS["fraude"][1])}
+            for i in np.flatnonzero(fraudes_table["id_ref"] == student_id)
+        ]
+
+        if db is not None:
+            # Written since the last export: newer than anything in the snapshot
+            newer_proofs = _rows_since(db, "proof_identity", "id_student", student_id, self.watermark("proof_identity"))
+            if newer_proofs:
+                proof_data = max(newer_proofs, key=lambda row: row["created_at"])
+            exported = {fraude["document_id"] for fraude in fraudes}
+            fraudes += [
+                row for row in _rows_since(db, "fraude", "id_ref", student_id, self.watermark("fraude"))
+                if row["document_id"] not in exported
+            ]
+        return {"proof_identity": proof_data, "fraudes": fraudes}
+
+    def cohorts(self) -> List[Dict[str, Any]]:
+        """Per-field completion, accuracy, integrity, fraud and cognitive type aggregates"""
+        students = self.table("students")
+        proofs = self._latest_proofs()
+        fraudes = self.table("fraude")
+
+        fields = students["field"].astype(str)
+        cohort_names, student_cohort = np.unique(fields, return_inverse=True)
+        n = len(cohort_names)
+        cohort_of = dict(zip(students["document_id"], student_cohort))
+
+        proof_cohort = np.array([cohort_of.get(student_id, -1) for student_id in proofs["id_student"]], dtype=np.int64)
+        known = proof_cohort >= 0
+        proof_cohort = proof_cohort[known]
+        accuracy = proofs["accuracy"][known].astype(np.float64)
+        integrity = proofs["score_integrité"][known].astype(np.float64)
+        types = proofs["type_cognitive"][known].astype(str)
+
+        fraud_cohort = np.array([cohort_of.get(ref, -1) for ref in fraudes["id_ref"]], dtype=np.int64)
+        fraud_counts = np.nan_to_num(fraudes["nombre_fraude"].astype(np.float64))
+        fraud_known = fraud_cohort >= 0
+
+        total_students = np.bincount(student_cohort, minlength=n)
+        completed = np.bincount(proof_cohort, minlength=n)
+        # Means ignore proofs missing the metric
+        accuracy_sum = np.bincount(proof_cohort, weights=np.nan_to_num(accuracy), minlength=n)
+        accuracy_count = np.bincount(proof_cohort, weights=~np.isnan(accuracy), minlength=n)
+        integrity_sum = np.bincount(proof_cohort, weights=np.nan_to_num(integrity), minlength=n)
+        integrity_count = np.bincount(proof_cohort, weights=~np.isnan(integrity), minlength=n)
+        frauds = np.bincount(fraud_cohort[fraud_known], weights=fraud_counts[fraud_known], minlength=n)
+
+        cohorts = []
+        for i, name in enumerate(cohort_names):
+            done = int(completed[i])
+            cohorts.append({
+                "field": str(name),
+                "total_students": int(total_students[i]),
+                "completed_tests": done,
+                "completion_rate": round(done / total_students[i] * 100, 2) if total_students[i] else 0,
+                "avg_accuracy": round(accuracy_sum[i] / accuracy_count[i] * 100, 2) if accuracy_count[i] else 0,
+                "avg_integrity": round(integrity_sum[i] / integrity_count[i] * 100, 2) if integrity_count[i] else 0,
+                "fraud_count": int(frauds[i]),
+                "cognitive_type_distribution": _count_by(types[proof_cohort == i]),
+            })
+        return cohorts
+
+
+def _to_python(value):
+    if isinstance(value, np.datetime64):
+        if np.isnat(value):
+            return None
+        return value.astype("datetime64[us]").item().replace(tzinfo=timezone.utc)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def get_engine() -> Optional[AnalyticsEngine]:
+    """Snapshot engine when ANALYTICS_SNAPSHOT_DIR is set"""
+    snapshot_dir = os.getenv("ANALYTICS_SNAPSHOT_DIR")
+    if not snapshot_dir or pa is None:
+        return None
+    return AnalyticsEngine(snapshot_dir)
+
+
+def get_exporter(db) -> Optional[SnapshotExporter]:
+    """Background exporter when ANALYTICS_SNAPSHOT_DIR is set, unless ANALYTICS_EXPORT_INTERVAL_SECONDS=0"""
+    snapshot_dir = os.getenv("ANALYTICS_SNAPSHOT_DIR")
+    interval = float(os.getenv("ANALYTICS_EXPORT_INTERVAL_SECONDS", EXPORT_INTERVAL_SECONDS))
+    if not snapshot_dir or pa is None or interval <= 0:
+        return None
+    return SnapshotExporter(db, snapshot_dir, interval)
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    parser = argparse.ArgumentParser(description="Export analytics snapshots to Parquet")
+    parser.add_argument("--dir", default=os.getenv("ANALYTICS_SNAPSHOT_DIR", "analytics_snapshots"))
+    parser.add_argument("--full", action="store_true", help="rebuild every snapshot from scratch")
+    args = parser.parse_args()
+
+    if not firebase_admin._apps:
+        cred = credentials.Certificate("./serviceAccountKey.json")
+        firebase_admin.initialize_app(cred)
+
+    started = time.perf_counter()
+    watermarks = export_snapshots(firestore.client(), args.dir, full=args.full)
+    print(json.dumps({"watermarks": watermarks, "elapsed_seconds": round(time.perf_counter() - started, 2)}))
@@ -0,0 +1,183 @@
+"""
+Incremental autosave of exam answers.
+
+PATCH /exam/{exam_id}/attempt/{attempt_id}/answers sends only the answers
+that changed. They are merged into a per-attempt buffer, so rapid edits of
+the same question collapse into one write, and flushed every
+FLUSH_INTERVAL_SECONDS as field-path updates (answers.`q17`) batched
+across attempts, never rewriting the whole answers map.
+
+The buffer is per worker. A flush only writes to attempts still
+`in_progress`, conditioned on the update_time it read, so answers never
+land on a submitted or expired attempt. A submission handled by another
+worker is journaled with SUBMIT_SETTLE_SECONDS of delay: the answers this
+worker accepted before it are flushed to the attempt first, and the
+journal's grading reads them from there.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.field_path import FieldPath
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_SECONDS = 1.0
+WRITE_BATCH_SIZE = 500  # Firestore limit per commit
+ATTEMPT_CACHE_SECONDS = 30
+# Delay of a journaled submission: every worker flushes its buffer meanwhile
+SUBMIT_SETTLE_SECONDS = 2 * FLUSH_INTERVAL_SECONDS + 1
+
+
+def answer_field_path(question_key: str) -> str:
+    """answers.<key>, quoted when the key is not a plain identifier (e.g. "17")"""
+    return FieldPath("answers", str(question_key)).to_api_repr()
+
+
+class AutosaveBuffer:
+    def __init__(self, db, collection: str = 'exam_attempts'):
+        self.db = db
+        self.collection = collection
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._attempts: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.coalesced = 0
+
+    def attempt(self, attempt_id: str) -> Optional[Dict[str, Any]]:
+        """Attempt document, re-read at most every ATTEMPT_CACHE_SECONDS"""
+        cached = self._attempts.get(attempt_id)
+        if cached and time.monotonic() - cached[0] < ATTEMPT_CACHE_SECONDS:
+            return cached[1]
+        doc = self.db.collection(self.collection).document(attempt_id).get()
+        data = doc.to_dict() if doc.exists else None
+        if data is not None:
+            data.pop('answers', None)
+        self._attempts[attempt_id] = (time.monotonic(), data)
+        return data
+
+    def close(self, attempt_id: str, status: str = 'completed'):
+        """Reject later autosaves without waiting for the status write to reach Firestore"""
+        data = dict(self._attempts.get(attempt_id, (0, None))[1] or {})
+        data['status'] = status
+        self._attempts[attempt_id] = (time.monotonic(), data)
+
+    def add(self, attempt_id: str, answers: Dict[str, Any]) -> int:
+        """Merge changed answers into the attempt's buffer, returns how many are pending"""
+        with self._lock:
+            pending = self._pending.setdefault(attempt_id, {})
+            self.coalesced += sum(1 for key in answers if str(key) in pending)
+            pending.update({str(key): value for key, value in answers.items()})
+            return len(pending)
+
+    def take(self, attempt_id: str) -> Dict[str, Any]:
+        """Remove and return an attempt's buffered answers, to be written with its submission"""
+        return self._take(attempt_id).get(attempt_id, {})
+
+    def pending_count(self, attempt_id: str) -> int:
+        return len(self._pending.get(attempt_id, {}))
+
+    def _take(self, attempt_id: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            if attempt_id is None:
+                taken, self._pending = self._pending, {}
+            else:
+                taken = {attempt_id: self._pending.pop(attempt_id)} if attempt_id in self._pending else {}
+        return taken
+
+    def _open_attempts(self, attempt_ids) -> Dict[str, Any]:
+        """attempt ID -> update_time of the attempts still in progress"""
+        refs = [self.db.collection(self.collection).document(attempt_id) for attempt_id in attempt_ids]
+        return {
+            doc.id: doc.update_time for doc in self.db.get_all(refs, field_paths=['status'])
+            if doc.exists and doc.to_dict().get('status') == 'in_progress'
+        }
+
+    def _write_one(self, attempt_id: str, data: Dict[str, Any]) -> bool:
+        """Write one attempt's answers if it is still in progress, False when dropped"""
+        update_time = self._open_attempts([attempt_id]).get(attempt_id)
+        if update_time is None:
+            logger.warning("Autosave dropped for closed or missing attempt %s", attempt_id)
+            return False
+        self.db.collection(self.collection).document(attempt_id).update(
+            data, option=self.db.write_option(last_update_time=update_time)
+        )
+        return True
+
+    def flush(self, attempt_id: Optional[str] = None) -> int:
+        """Write buffered answers (of one attempt, or all) as field-path updates"""
+        taken = self._take(attempt_id)
+        if not taken:
+            return 0
+        now = datetime.now(timezone.utc)
+        updates = []
+        for pending_attempt, answers in taken.items():
+            data = {answer_field_path(key): value for key, value in answers.items()}
+            data['last_autosave_at'] = now
+            updates.append((pending_attempt, data))
+
+        written = 0
+        for i in range(0, len(updates), WRITE_BATCH_SIZE):
+            chunk = updates[i:i + WRITE_BATCH_SIZE]
+            try:
+                # Answers of a submitted or expired attempt are dropped; the precondition
+                # fails the batch if one changed since the read
+                open_attempts = self._open_attempts(pending_attempt for pending_attempt, _ in chunk)
+                batch = self.db.batch()
+                for pending_attempt, data in chunk:
+                    if pending_attempt in open_attempts:
+                        batch.update(
+                            self.db.collection(self.collection).document(pending_attempt), data,
+                            option=self.db.write_option(last_update_time=open_attempts[pending_attempt])
+                        )
+                batch.commit()
+                written += len(open_attempts)
+                continue
+            except Exception:
+                logger.exception("Autosave batch failed, retrying attempt by attempt")
+            for pending_attempt, data in chunk:
+                try:
+                    written += self._write_one(pending_attempt, data)
+                except NotFound:
+                    logger.warning("Autosave dropped for missing attempt %s", pending_attempt)
+                except Exception:
+                    # Put the answers back (newer edits win) so the next flush retries them
+                    with self._lock:
+                        merged = taken[pending_attempt]
+                        merged.update(self._pending.get(pending_attempt, {}))
+                        self._pending[pending_attempt] = merged
+        self.writes += written
+        return written
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception:
+                logger.exception("Autosave flush failed")
+
+    def start(self, interval: float = FLUSH_INTERVAL_SECONDS):
+        self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.to_thread(self.flush)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_attempts": len(self._pending),
+            "pending_answers": sum(len(answers) for answers in self._pending.values()),
+            "writes": self.writes,
+            "coalesced": self.coalesced
+        }
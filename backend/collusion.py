@@ -0,0 +1,368 @@
+"""
+Answer-collusion detection across the attempts of an exam.
+
+Every attempt becomes a set of shingles: one per answer ("position=value"),
+repeated WRONG_ANSWER_WEIGHT times for wrong answers (two students sharing
+the same wrong answers is what matters, everybody shares the right ones),
+and the start / completion time buckets. MinHash signatures of these sets
+are split into LSH bands: only attempts sharing a band are compared, which
+is near-linear in the number of students instead of n² pairs.
+
+Candidate pairs are confirmed on their exact weighted Jaccard similarity
+and a minimum number of identical wrong answers, then written to `fraude`
+(ref_type "exam", type_fraude "collusion"), one report per student and exam
+with a deterministic ID so a re-run replaces it; the exam's reports of
+students no longer involved are deleted.
+
+The analysis runs in the background COLLUSION_DELAY_SECONDS after an exam
+window closes (hooked on the attempt finalizer), or on demand. Pending
+analyses are `collusion_runs/{exam_id}` documents with a `due_at`, so they
+survive restarts and are scheduled once whichever worker closes the
+window; any worker runs a due analysis after claiming it in a transaction
+(moving `due_at` RUN_TIMEOUT_SECONDS ahead, so an analysis whose worker
+died is taken up again).
+
+    python collusion.py   # LSH vs. pairwise comparison on a synthetic exam
+"""
+import asyncio
+import logging
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from itertools import combinations
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from firebase_admin import firestore
+
+from dates import to_utc
+from text_grading import normalize
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 128
+BANDS = 16  # 16 bands x 8 rows: pairs above ~0.7 similarity become candidates
+ROWS = NUM_PERM // BANDS
+SIMILARITY_THRESHOLD = 0.75
+MIN_SHARED_WRONG = 3
+WRONG_ANSWER_WEIGHT = 3
+TIMING_BUCKET_SECONDS = 120
+MAX_BUCKET_SIZE = 500  # larger buckets (e.g. identical blank attempts) are skipped
+SIGNATURE_CHUNK = 256
+COLLUSION_DELAY_SECONDS = 120  # let the last submissions reach Firestore
+RUNS_COLLECTION = "collusion_runs"
+POLL_SECONDS = 30
+RUN_TIMEOUT_SECONDS = 600  # a claimed analysis not done by then is run again
+WRITE_BATCH_SIZE = 500
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_rng = np.random.RandomState(1)
+_A = _rng.randint(1, (1 << 61) - 1, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.randint(0, (1 << 61) - 1, size=NUM_PERM, dtype=np.uint64)
+
+
+class AttemptProfile:
+    """Shingles of an attempt, with its wrong answers"""
+
+    __slots__ = ("attempt_id", "student_id", "shingles", "wrong")
+
+    def __init__(self, attempt_id: str, student_id: str, shingles: Set[str], wrong: Set[str]):
+        self.attempt_id = attempt_id
+        self.student_id = student_id
+        self.shingles = shingles
+        self.wrong = wrong
+
+
+def profile(key, attempt_id: str, attempt: Dict[str, Any]) -> AttemptProfile:
+    """Shingles of an attempt's answers (graded with the exam's AnswerKey) and timing"""
+    answers = attempt.get('answers') or {}
+    texts: Dict[int, Any] = {}
+    chosen = key.encode(answers, texts)
+    shingles, wrong = set(), set()
+    for answer_key, value in answers.items():
+        position = key.positions.get(str(answer_key))
+        if position is None or chosen[position] < 0:
+            continue
+        if key.auto[position]:
+            token = str(int(chosen[position]))
+            is_wrong = chosen[position] != key.correct[position]
+        else:
+            token = normalize(value)
+            scorer = key.scorers.get(position)
+            is_wrong = scorer is None or scorer.credit(value) < 1.0
+        if not token:
+            continue
+        answer = f"{position}={token}"
+        shingles.add(answer)
+        if is_wrong:
+            wrong.add(answer)
+            shingles.update(f"{answer}#{i}" for i in range(1, WRONG_ANSWER_WEIGHT))
+    for label in ('started_at', 'completed_at'):
+        moment = to_utc(attempt.get(label))
+        if moment is not None:
+            shingles.add(f"{label}:{int(moment.timestamp() // TIMING_BUCKET_SECONDS)}")
+    return AttemptProfile(attempt_id, attempt.get('student_id'), shingles, wrong)
+
+
+def signatures(profiles: List[AttemptProfile]) -> np.ndarray:
+    """MinHash signatures (attempts x NUM_PERM), computed a chunk of attempts at a time"""
+    result = np.full((len(profiles), NUM_PERM), _MAX_HASH, dtype=np.uint64)
+    for start in range(0, len(profiles), SIGNATURE_CHUNK):
+        chunk = profiles[start:start + SIGNATURE_CHUNK]
+        lengths = [len(item.shingles) for item in chunk]
+        if not sum(lengths):
+            continue
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) for item in chunk for shingle in item.shingles),
+            dtype=np.uint64, count=sum(lengths)
+        )
+        # Universal hashing as in datasketch: (a * h + b) mod p, kept on 32 bits
+        with np.errstate(over="ignore"):
+            permuted = ((hashes[None, :] * _A[:, None] + _B[:, None]) % _MERSENNE_PRIME) & _MAX_HASH
+        offsets = np.cumsum([0] + lengths[:-1])
+        non_empty = np.array(lengths) > 0
+        minima = np.minimum.reduceat(permuted, offsets[non_empty], axis=1).T
+        result[start + np.flatnonzero(non_empty)] = minima
+    return result
+
+
+def candidate_pairs(signature_matrix: np.ndarray) -> Set[Tuple[int, int]]:
+    """Pairs of attempts sharing at least one LSH band"""
+    pairs = set()
+    for band in range(BANDS):
+        rows = np.ascontiguousarray(signature_matrix[:, band * ROWS:(band + 1) * ROWS])
+        buckets: Dict[bytes, List[int]] = {}
+        for i, row in enumerate(rows):
+            buckets.setdefault(row.tobytes(), []).append(i)
+        for members in buckets.values():
+            if 1 < len(members) <= MAX_BUCKET_SIZE:
+                pairs.update(combinations(members, 2))
+            elif len(members) > MAX_BUCKET_SIZE:
+                logger.warning("Collusion LSH bucket of %d attempts skipped", len(members))
+    return pairs
+
+
+def confirm(a: AttemptProfile, b: AttemptProfile) -> Optional[Dict[str, Any]]:
+    """Exact check of a candidate pair"""
+    shared_wrong = a.wrong & b.wrong
+    if len(shared_wrong) < MIN_SHARED_WRONG:
+        return None
+    union = len(a.shingles | b.shingles)
+    similarity = len(a.shingles & b.shingles) / union if union else 0.0
+    if similarity < SIMILARITY_THRESHOLD:
+        return None
+    return {"similarity": round(similarity, 3), "shared_wrong_answers": len(shared_wrong)}
+
+
+def find_pairs(profiles: List[AttemptProfile]) -> List[Dict[str, Any]]:
+    profiles = [item for item in profiles if item.wrong]
+    if len(profiles) < 2:
+        return []
+    found = []
+    for i, j in candidate_pairs(signatures(profiles)):
+        match = confirm(profiles[i], profiles[j])
+        if match:
+            found.append({"a": profiles[i], "b": profiles[j], **match})
+    return sorted(found, key=lambda pair: -pair["similarity"])
+
+
+def reports(exam_id: str, pairs: List[Dict[str, Any]], now: datetime) -> Dict[str, Dict[str, Any]]:
+    """One fraude document per student involved, keyed by its ID"""
+    partners: Dict[str, List[Dict[str, Any]]] = {}
+    for pair in pairs:
+        for own, other in ((pair["a"], pair["b"]), (pair["b"], pair["a"])):
+            partners.setdefault(own.student_id, []).append({
+                "student_id": other.student_id,
+                "attempt_id": other.attempt_id,
+                "similarity": pair["similarity"],
+                "shared_wrong_answers": pair["shared_wrong_answers"],
+            })
+    documents = {}
+    for student_id, matches in partners.items():
+        fraude_id = f"fraude_collusion_{exam_id}_{student_id}"
+        documents[fraude_id] = {
+            "id": fraude_id,
+            "id_ref": student_id,
+            "ref_type": "exam",
+            "nombre_fraude": len(matches),
+            "type_fraude": "collusion",
+            "date_fraude": now,
+            "details": {"exam_id": exam_id, "partners": matches},
+        }
+    return documents
+
+
+class CollusionAnalyzer:
+    """Runs the analysis of closed exams in the background"""
+
+    def __init__(self, db, answer_keys, delay_seconds: float = COLLUSION_DELAY_SECONDS):
+        self.db = db
+        self.answer_keys = answer_keys
+        self.delay_seconds = delay_seconds
+        self._task: Optional[asyncio.Task] = None
+        self.last_runs: Dict[str, Dict[str, Any]] = {}
+
+    def analyze(self, exam_id: str) -> Dict[str, Any]:
+        """Compare the submitted attempts of an exam and write the collusion reports"""
+        started = time.perf_counter()
+        key = self.answer_keys.get('exam', exam_id)
+        if key is None:
+            return {"exam_id": exam_id, "attempts": 0, "pairs": 0, "students": 0}
+        query = (
+            self.db.collection('exam_attempts')
+            .where('exam_id', '==', exam_id)
+            .where('status', 'in', ['completed', 'expired', 'terminated'])
+            .select(['student_id', 'answers', 'started_at', 'completed_at'])
+        )
+        profiles = [profile(key, doc.id, doc.to_dict()) for doc in query.stream()]
+        pairs = find_pairs(profiles)
+
+        documents = reports(exam_id, pairs, datetime.now(timezone.utc))
+        # Reports of a previous run whose student is no longer part of a pair
+        previous = (
+            self.db.collection('fraude')
+            .where('type_fraude', '==', 'collusion')
+            .where('details.exam_id', '==', exam_id)
+            .select([])
+        )
+        writes = [(doc.reference, None) for doc in previous.stream() if doc.id not in documents]
+        writes += [(self.db.collection('fraude').document(fraude_id), data) for fraude_id, data in documents.items()]
+        for i in range(0, len(writes), WRITE_BATCH_SIZE):
+            batch = self.db.batch()
+            for ref, data in writes[i:i + WRITE_BATCH_SIZE]:
+                if data is None:
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data)
+            batch.commit()
+
+        result = {
+            "exam_id": exam_id,
+            "attempts": len(profiles),
+            "pairs": len(pairs),
+            "students": len(documents),
+            "top_pairs": [
+                {"students": [pair["a"].student_id, pair["b"].student_id],
+                 "similarity": pair["similarity"], "shared_wrong_answers": pair["shared_wrong_answers"]}
+                for pair in pairs[:20]
+            ],
+            "seconds": round(time.perf_counter() - started, 3),
+            "at": datetime.now(timezone.utc),
+        }
+        self.last_runs[exam_id] = result
+        return result
+
+    def schedule(self, window: Dict[str, Any]):
+        """Finalizer hook (called from its worker thread): analyze an exam once its window is closed"""
+        if window.get('type') != 'exam':
+            return
+        run_ref = self.db.collection(RUNS_COLLECTION).document(window['id'])
+        run_doc = run_ref.get()
+        if run_doc.exists and to_utc(run_doc.to_dict().get('window_end')) == to_utc(window['end']):
+            return  # already scheduled (or done) for this window, e.g. by a previous leader
+        run_ref.set({
+            "exam_id": window['id'],
+            "window_end": window['end'],
+            "due_at": datetime.now(timezone.utc) + timedelta(seconds=self.delay_seconds),
+        })
+
+    def _claim(self, run_ref) -> bool:
+        """Take a due analysis, False when another worker took it first"""
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def claim(transaction) -> bool:
+            snapshot = run_ref.get(transaction=transaction)
+            now = datetime.now(timezone.utc)
+            due_at = to_utc((snapshot.to_dict() or {}).get('due_at')) if snapshot.exists else None
+            if due_at is None or due_at > now:
+                return False
+            transaction.update(run_ref, {"due_at": now + timedelta(seconds=RUN_TIMEOUT_SECONDS)})
+            return True
+
+        return claim(transaction)
+
+    def run_due(self) -> int:
+        """Run the analyses that are due, returns how many ran"""
+        now = datetime.now(timezone.utc)
+        ran = 0
+        for run_doc in self.db.collection(RUNS_COLLECTION).where('due_at', '<=', now).stream():
+            if not self._claim(run_doc.reference):
+                continue
+            exam_id = run_doc.to_dict()['exam_id']
+            try:
+                result = self.analyze(exam_id)
+            except Exception:
+                # Left claimed: run again once RUN_TIMEOUT_SECONDS have passed
+                logger.exception("Collusion analysis of %s failed", exam_id)
+                continue
+            run_doc.reference.update({
+                "due_at": firestore.DELETE_FIELD,
+                "analyzed_at": result["at"],
+                "pairs": result["pairs"],
+                "students": result["students"],
+            })
+            ran += 1
+        return ran
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_due)
+            except Exception:
+                logger.exception("Collusion analyses failed")
+            await asyncio.sleep(min(POLL_SECONDS, self.delay_seconds))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+if __name__ == "__main__":
+    from grading import AnswerKey
+
+    rng = np.random.default_rng(0)
+    questions, students, rings = 40, 3000, 10
+    key = AnswerKey([
+        {"id": f"q{q}", "question_number": q + 1, "type": "multiple_choice",
+         "options": ["a", "b", "c", "d"], "correct_answer": int(rng.integers(0, 4)), "points": 1}
+        for q in range(questions)
+    ])
+    base = datetime(2024, 6, 1, 9, 0, tzinfo=timezone.utc).timestamp()
+
+    def attempt(i, answers, offset):
+        return {"student_id": f"s{i}", "answers": answers,
+                "started_at": datetime.fromtimestamp(base + offset, timezone.utc),
+                "completed_at": datetime.fromtimestamp(base + 3600 + offset, timezone.utc)}
+
+    attempts = []
+    for i in range(students):
+        skill = rng.uniform(0.3, 0.9)
+        answers = {str(q): int(key.correct[q]) if rng.random() < skill else int(rng.integers(0, 4)) for q in range(questions)}
+        attempts.append(attempt(i, answers, float(rng.integers(0, 1800))))
+    for r in range(rings):
+        # A copies B except for a couple of answers
+        source = attempts[r * 2]
+        copied = dict(source["answers"])
+        for q in rng.choice(questions, 2, replace=False):
+            copied[str(q)] = int(rng.integers(0, 4))
+        attempts[r * 2 + 1] = attempt(r * 2 + 1, copied, (source["started_at"].timestamp() - base) + 30)
+
+    profiles = [profile(key, f"a{i}", item) for i, item in enumerate(attempts)]
+
+    start = time.perf_counter()
+    pairs = find_pairs(profiles)
+    lsh_seconds = time.perf_counter() - start
+    print(f"LSH       {lsh_seconds * 1000:8.1f} ms  {len(pairs)} pairs: {sorted((p['a'].student_id, p['b'].student_id) for p in pairs)}")
+
+    start = time.perf_counter()
+    naive = [(a, b) for a, b in combinations(profiles, 2) if confirm(a, b)]
+    print(f"pairwise  {(time.perf_counter() - start) * 1000:8.1f} ms  {len(naive)} pairs")
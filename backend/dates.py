@@ -0,0 +1,19 @@
+"""
+Date helpers shared by the API and the background components.
+"""
+from datetime import datetime, timezone
+from typing import Optional
+
+
+def to_utc(value) -> Optional[datetime]:
+    """Normalize a Firestore timestamp, datetime or ISO string to an aware UTC datetime"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
@@ -0,0 +1,328 @@
+"""
+Content-addressed store for fraud evidence (flagged webcam frames, audio
+clips, screenshots).
+
+Each file is stored once under the SHA-256 of its bytes
+(EVIDENCE_DIR/objects/ab/abcdef...), with a small JSON sidecar holding its
+content type and size. The same frame uploaded or flagged twice, by any
+number of reports, takes the space of one. `fraude` documents (and exam
+attempts flagged by report_fraud) only keep the digests.
+
+- uploads are multipart/form-data parsed as a stream: every file part is
+  hashed and written to a temporary file chunk by chunk, then renamed to its
+  address (or dropped when the address already exists), so a file is never
+  held in memory whole; files of the parts already read stay stored when a
+  later part fails (`MultipartUpload.files`);
+- files are served by digest with single-range requests (206 / 416), and
+  being immutable, with the digest as ETag;
+- image thumbnails are generated on first request and kept next to the
+  objects (OpenCV, optional as for frame_analysis).
+
+    python evidence.py   # streamed upload throughput and memory, then the same file deduplicated
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.multipart import parse_options_header
+
+try:
+    import cv2
+except ImportError:  # optional, thumbnails are unavailable instead
+    cv2 = None
+
+CONTENT_TYPES = (
+    "image/jpeg", "image/png", "image/webp",
+    "audio/wav", "audio/webm", "audio/ogg", "video/webm", "video/mp4",
+)
+MAX_FILE_BYTES = 20 * 1024 * 1024
+MAX_FILES_PER_UPLOAD = 20
+MAX_ATTEMPT_EVIDENCE_BYTES = 50 * 1024 * 1024  # uploaded by a student over one exam attempt
+THUMBNAIL_SIZES = (128, 256, 512)
+READ_CHUNK_BYTES = 64 * 1024
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def is_digest(value: str) -> bool:
+    return bool(_DIGEST.match(value or ""))
+
+
+class EvidenceWriter:
+    """One file being written: hashed as it goes, committed to its address"""
+
+    def __init__(self, store: "EvidenceStore", content_type: str, filename: Optional[str] = None):
+        self.store = store
+        self.content_type = content_type
+        self.filename = filename
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=store.tmp_dir)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > MAX_FILE_BYTES:
+            raise ValueError(f"Fichier trop volumineux (au plus {MAX_FILE_BYTES // (1024 * 1024)} Mo)")
+        self._hash.update(data)
+        self._file.write(data)
+
+    def commit(self) -> Dict[str, Any]:
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self.store.path(digest)
+        deduplicated = os.path.exists(path)
+        if deduplicated:
+            os.remove(self._tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Concurrent uploads of the same bytes replace each other with identical content
+            os.replace(self._tmp_path, path)
+        # The sidecar goes in after the object: a crash in between leaves an object
+        # without one, completed by the next upload of the same bytes
+        if not os.path.exists(f"{path}.json"):
+            # Unique temporary name: concurrent uploads of the same bytes must not share it
+            fd, sidecar_tmp = tempfile.mkstemp(dir=self.store.tmp_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    "content_type": self.content_type,
+                    "size": self.size,
+                    "filename": self.filename,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                }, f)
+            os.replace(sidecar_tmp, f"{path}.json")
+        return {"sha256": digest, "size": self.size, "content_type": self.content_type, "deduplicated": deduplicated}
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class MultipartUpload:
+    """Streaming multipart/form-data parser storing every file part as evidence"""
+
+    def __init__(self, store: "EvidenceStore", content_type_header: str):
+        kind, options = parse_options_header(content_type_header)
+        boundary = options.get(b"boundary")
+        if kind != b"multipart/form-data" or not boundary:
+            raise ValueError("multipart/form-data requis")
+        self.store = store
+        self.files: List[Dict[str, Any]] = []
+        self.fields: Dict[str, str] = {}
+        self._headers: Dict[str, str] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._writer: Optional[EvidenceWriter] = None
+        self._field: Optional[Tuple[str, bytearray]] = None
+        self._parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": lambda data, start, end: self._append_header("_header_field", data[start:end]),
+            "on_header_value": lambda data, start, end: self._append_header("_header_value", data[start:end]),
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _append_header(self, name: str, data: bytes):
+        setattr(self, name, getattr(self, name) + data)
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_end(self):
+        self._headers[self._header_field.decode("latin-1").lower()] = self._header_value.decode("latin-1")
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, disposition = parse_options_header(self._headers.get("content-disposition", ""))
+        name = disposition.get(b"name", b"").decode("utf-8", "replace")
+        filename = disposition.get(b"filename")
+        if filename is None:
+            self._field = (name, bytearray())
+            return
+        content_type = parse_options_header(self._headers.get("content-type", ""))[0].decode("latin-1")
+        if content_type not in CONTENT_TYPES:
+            raise ValueError(f"Type de fichier non accepté: {content_type or 'inconnu'}")
+        if len(self.files) >= MAX_FILES_PER_UPLOAD:
+            raise ValueError(f"Au plus {MAX_FILES_PER_UPLOAD} fichiers par envoi")
+        self._writer = EvidenceWriter(self.store, content_type, os.path.basename(filename.decode("utf-8", "replace")))
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._writer is not None:
+            self._writer.write(data[start:end])
+        elif self._field is not None:
+            if len(self._field[1]) + end - start > 4096:
+                raise ValueError("Champ de formulaire trop long")
+            self._field[1].extend(data[start:end])
+
+    def _on_part_end(self):
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            self.files.append(writer.commit())
+        elif self._field is not None:
+            name, value = self._field
+            self.fields[name] = value.decode("utf-8", "replace")
+            self._field = None
+
+    def write(self, chunk: bytes):
+        try:
+            self._parser.write(chunk)
+        except Exception:
+            self.abort()
+            raise
+
+    def finish(self) -> List[Dict[str, Any]]:
+        self._parser.finalize()
+        if self._writer is not None:
+            self.abort()
+            raise ValueError("Envoi multipart incomplet")
+        return self.files
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+
+
+class EvidenceStore:
+    """Local-disk backend: objects by SHA-256, JSON sidecars, cached thumbnails"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.tmp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return is_digest(digest) and os.path.exists(self.path(digest))
+
+    def info(self, digest: str) -> Optional[Dict[str, Any]]:
+        if not is_digest(digest):
+            return None
+        try:
+            with open(f"{self.path(digest)}.json") as f:
+                return {"sha256": digest, **json.load(f)}
+        except FileNotFoundError:
+            return None
+
+    def put_bytes(self, data: bytes, content_type: str) -> Dict[str, Any]:
+        """Store media already in memory (e.g. the frame that triggered a report)"""
+        writer = EvidenceWriter(self, content_type)
+        try:
+            writer.write(data)
+        except Exception:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def upload(self, content_type_header: str) -> MultipartUpload:
+        return MultipartUpload(self, content_type_header)
+
+    def read(self, digest: str, start: int, end: int) -> Iterator[bytes]:
+        """Bytes start..end (inclusive) of an object, in READ_CHUNK_BYTES pieces"""
+        with open(self.path(digest), "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(READ_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def thumbnail(self, digest: str, size: int) -> Optional[str]:
+        """Path of a JPEG thumbnail of an image (at most size x size), made on first request"""
+        info = self.info(digest)
+        if info is None or not info["content_type"].startswith("image/") or cv2 is None:
+            return None
+        path = os.path.join(self.directory, "thumbnails", digest[:2], f"{digest}_{size}.jpg")
+        if os.path.exists(path):
+            return path
+        with open(self.path(digest), "rb") as f:
+            image = cv2.imdecode(np.frombuffer(f.read(), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return None
+        scale = size / max(image.shape[:2])
+        if scale < 1:
+            image = cv2.resize(image, (max(1, int(image.shape[1] * scale)), max(1, int(image.shape[0] * scale))),
+                               interpolation=cv2.INTER_AREA)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes())
+        os.replace(tmp_path, path)
+        return path
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """(start, end) inclusive of a single `bytes=` range, None for the whole file
+
+    Raises ValueError when the range cannot be satisfied (416).
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None  # multiple or malformed ranges: the whole file
+    first, last = match.groups()
+    if not first:
+        # bytes=-N: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Plage vide")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Plage hors du fichier")
+    return start, end
+
+
+def get_evidence_store() -> EvidenceStore:
+    return EvidenceStore(os.getenv("EVIDENCE_DIR", "./evidence"))
+
+
+if __name__ == "__main__":
+    import shutil
+    import time
+    import tracemalloc
+
+    directory = tempfile.mkdtemp()
+    store = EvidenceStore(directory)
+    rng = np.random.default_rng(0)
+    payload = rng.integers(0, 256, 50 * 1024 * 1024, dtype=np.uint8).tobytes()
+    boundary = "evidence-benchmark"
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"clip.webm\"\r\n"
+            f"Content-Type: video/webm\r\n\r\n").encode() + payload[:MAX_FILE_BYTES] + f"\r\n--{boundary}--\r\n".encode()
+
+    for label in ("upload", "same bytes again"):
+        tracemalloc.start()
+        start = time.perf_counter()
+        upload = store.upload(f"multipart/form-data; boundary={boundary}")
+        view = memoryview(body)
+        for offset in range(0, len(body), READ_CHUNK_BYTES):
+            upload.write(bytes(view[offset:offset + READ_CHUNK_BYTES]))
+        files = upload.finish()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<17} {len(body) / elapsed / 1e6:7.0f} MB/s, peak memory {peak / 1024:6.0f} KB, "
+              f"deduplicated={files[0]['deduplicated']}")
+    shutil.rmtree(directory)
@@ -0,0 +1,391 @@
+"""
+Per-exam result statistics maintained as submissions are graded.
+
+Each exam has one small `exam_stats` document holding, for score (points
+and % of max), duration and fraud attempts, a KLL quantile sketch and a
+fixed-bin histogram. Both merge by addition, so:
+
+- graded submissions are accumulated in memory and merged into the
+  document every FLUSH_INTERVAL_SECONDS in a transaction (several workers
+  can write the same exam without losing updates);
+- each counted attempt leaves a `exam_stats/{exam_id}/counted/{attempt_id}`
+  marker, read and written in the same transaction, so an attempt recorded
+  on several workers (a re-submission, a retried journal flush) is counted
+  once;
+- a bulk (re)grade rebuilds the document from every graded attempt, after
+  marking them counted so deltas still pending on other workers skip them;
+- /exams/{id}/stats reads one document whatever the number of students,
+  and module-level stats merge the documents of the module's exams.
+
+    python exam_stats.py   # sketch accuracy and size vs. exact percentiles
+"""
+import asyncio
+import logging
+import math
+import random
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from firebase_admin import firestore
+
+from dates import to_utc
+
+logger = logging.getLogger(__name__)
+
+STATS_COLLECTION = "exam_stats"
+COUNTED_COLLECTION = "counted"
+FLUSH_INTERVAL_SECONDS = 5.0
+MAX_ATTEMPTS_PER_MERGE = 200  # markers read and written in one transaction
+BATCH_SIZE = 400
+SKETCH_K = 200
+PERCENTILES = (10, 25, 50, 75, 90, 99)
+
+# metric -> histogram bin edges (a value v falls in the last bin with edge <= v)
+HISTOGRAMS = {
+    "score_percent": [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100],
+    "score": None,  # points depend on the exam, only the sketch is kept
+    "duration_minutes": [0, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180],
+    "fraud_attempts": [0, 1, 2, 3],
+}
+
+
+class KLLSketch:
+    """KLL quantile sketch (Karnin, Lang, Liberty): mergeable, ~O(k) items"""
+
+    def __init__(self, k: int = SKETCH_K, c: float = 2 / 3):
+        self.k = k
+        self.c = c
+        self.compactors: List[List[float]] = [[]]
+        self.n = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def _capacity(self, height: int) -> int:
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.c ** depth * self.k)) + 1
+
+    def _size(self) -> int:
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(height) for height in range(len(self.compactors)))
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for height, compactor in enumerate(self.compactors):
+                if len(compactor) >= self._capacity(height):
+                    if height + 1 == len(self.compactors):
+                        self.compactors.append([])
+                    # Keep every other item (random offset), each now weighs twice as much
+                    compactor.sort()
+                    offset = random.random() < 0.5
+                    promoted = compactor[offset::2] if len(compactor) % 2 == 0 else compactor[1:][offset::2]
+                    leftover = [] if len(compactor) % 2 == 0 else [compactor[0]]
+                    self.compactors[height + 1].extend(promoted)
+                    self.compactors[height] = leftover
+                    break
+
+    def update(self, value: float):
+        value = float(value)
+        self.compactors[0].append(value)
+        self.n += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def merge(self, other: "KLLSketch"):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+        self.n += other.n
+        self.total += other.total
+        for bound, pick in (("min", min), ("max", max)):
+            values = [value for value in (getattr(self, bound), getattr(other, bound)) if value is not None]
+            setattr(self, bound, pick(values) if values else None)
+        self._compress()
+
+    def quantiles(self, qs: Iterable[float]) -> List[Optional[float]]:
+        """Approximate quantiles (q in [0, 1]) from the weighted items"""
+        items = sorted(
+            (value, 2 ** height)
+            for height, compactor in enumerate(self.compactors)
+            for value in compactor
+        )
+        if not items:
+            return [None for _ in qs]
+        weight = sum(w for _, w in items)
+        result = []
+        for q in qs:
+            target, cumulative = q * weight, 0
+            for value, w in items:
+                cumulative += w
+                if cumulative >= target:
+                    break
+            result.append(value)
+        return result
+
+    def mean(self) -> Optional[float]:
+        return self.total / self.n if self.n else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "k": self.k,
+            "n": self.n,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            # Firestore does not store nested arrays
+            "compactors": {str(height): [round(value, 4) for value in compactor]
+                           for height, compactor in enumerate(self.compactors)},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "KLLSketch":
+        sketch = cls(k=(data or {}).get("k", SKETCH_K))
+        if data:
+            heights = sorted(int(height) for height in data.get("compactors", {}))
+            sketch.compactors = [list(data["compactors"][str(height)]) for height in range(heights[-1] + 1)] if heights else [[]]
+            sketch.n = data.get("n", 0)
+            sketch.total = data.get("total", 0.0)
+            sketch.min = data.get("min")
+            sketch.max = data.get("max")
+        return sketch
+
+
+def _bin(edges: List[float], value: float) -> int:
+    position = 0
+    for i, edge in enumerate(edges):
+        if value >= edge:
+            position = i
+    return position
+
+
+class ExamStats:
+    """Sketch and histogram of every metric; mergeable"""
+
+    def __init__(self):
+        self.sketches = {metric: KLLSketch() for metric in HISTOGRAMS}
+        self.histograms = {metric: [0] * len(edges) for metric, edges in HISTOGRAMS.items() if edges}
+        self.count = 0
+
+    def add(self, values: Dict[str, Optional[float]]):
+        self.count += 1
+        for metric, value in values.items():
+            if value is None:
+                continue
+            self.sketches[metric].update(value)
+            if metric in self.histograms:
+                self.histograms[metric][_bin(HISTOGRAMS[metric], value)] += 1
+
+    def merge(self, other: "ExamStats"):
+        self.count += other.count
+        for metric, sketch in other.sketches.items():
+            self.sketches[metric].merge(sketch)
+        for metric, counts in other.histograms.items():
+            self.histograms[metric] = [a + b for a, b in zip(self.histograms[metric], counts)]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sketches": {metric: sketch.to_dict() for metric, sketch in self.sketches.items()},
+            "histograms": self.histograms,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "ExamStats":
+        stats = cls()
+        if data:
+            stats.count = data.get("count", 0)
+            for metric, sketch in (data.get("sketches") or {}).items():
+                if metric in stats.sketches:
+                    stats.sketches[metric] = KLLSketch.from_dict(sketch)
+            for metric, counts in (data.get("histograms") or {}).items():
+                if metric in stats.histograms and len(counts) == len(stats.histograms[metric]):
+                    stats.histograms[metric] = list(counts)
+        return stats
+
+    def summary(self) -> Dict[str, Any]:
+        metrics = {}
+        for metric, sketch in self.sketches.items():
+            values = sketch.quantiles([p / 100 for p in PERCENTILES])
+            mean = sketch.mean()
+            metrics[metric] = {
+                "count": sketch.n,
+                "mean": round(mean, 2) if mean is not None else None,
+                "min": sketch.min,
+                "max": sketch.max,
+                "percentiles": {f"p{p}": value for p, value in zip(PERCENTILES, values)},
+            }
+            if metric in self.histograms:
+                edges = HISTOGRAMS[metric]
+                metrics[metric]["histogram"] = [
+                    {"from": edge, "to": edges[i + 1] if i + 1 < len(edges) else None, "count": count}
+                    for i, (edge, count) in enumerate(zip(edges, self.histograms[metric]))
+                ]
+        return {"count": self.count, "metrics": metrics}
+
+
+def attempt_values(attempt: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    """Metric values of a graded attempt"""
+    score, max_score = attempt.get("score"), attempt.get("max_score")
+    started, completed = to_utc(attempt.get("started_at")), to_utc(attempt.get("completed_at"))
+    return {
+        "score": score,
+        "score_percent": 100.0 * score / max_score if score is not None and max_score else None,
+        "duration_minutes": (completed - started).total_seconds() / 60 if started and completed else None,
+        "fraud_attempts": attempt.get("fraud_attempts", 0) or 0,
+    }
+
+
+class ExamStatsAggregator:
+    """Accumulates graded attempts in memory, merges them into exam_stats/{exam_id}"""
+
+    def __init__(self, db):
+        self.db = db
+        self._pending: Dict[str, Dict[str, Dict[str, Optional[float]]]] = {}  # exam -> attempt -> values
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, exam_id: str, attempt_id: str, attempt: Dict[str, Any]):
+        """Count a graded attempt once (a re-submission is not counted twice)"""
+        with self._lock:
+            self._pending.setdefault(exam_id, {})[attempt_id] = attempt_values(attempt)
+
+    def _exam_fields(self, exam_id: str) -> Dict[str, Any]:
+        exam_doc = self.db.collection('exams').document(exam_id).get()
+        exam = exam_doc.to_dict() if exam_doc.exists else {}
+        return {"exam_id": exam_id, "module_name": exam.get("module_name"), "id_teacher": exam.get("id_teacher")}
+
+    def _merge_into(self, exam_id: str, values: Dict[str, Dict[str, Optional[float]]]):
+        stats_ref = self.db.collection(STATS_COLLECTION).document(exam_id)
+        counted_refs = {attempt_id: stats_ref.collection(COUNTED_COLLECTION).document(attempt_id) for attempt_id in values}
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def merge(transaction):
+            snapshot = stats_ref.get(transaction=transaction)
+            counted = {doc.id for doc in transaction.get_all(list(counted_refs.values())) if doc.exists}
+            delta = ExamStats()
+            for attempt_id, attempt in values.items():
+                if attempt_id not in counted:
+                    delta.add(attempt)
+            if not delta.count:
+                return
+            current = snapshot.to_dict() if snapshot.exists else None
+            stats = ExamStats.from_dict(current)
+            stats.merge(delta)
+            fields = {key: current.get(key) for key in ("exam_id", "module_name", "id_teacher")} if current else self._exam_fields(exam_id)
+            now = datetime.now(timezone.utc)
+            transaction.set(stats_ref, {**fields, **stats.to_dict(), "updated_at": now})
+            for attempt_id, counted_ref in counted_refs.items():
+                if attempt_id not in counted:
+                    transaction.set(counted_ref, {"counted_at": now})
+
+        merge(transaction)
+
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for exam_id, values in pending.items():
+            attempt_ids = list(values)
+            for i in range(0, len(attempt_ids), MAX_ATTEMPTS_PER_MERGE):
+                chunk = {attempt_id: values[attempt_id] for attempt_id in attempt_ids[i:i + MAX_ATTEMPTS_PER_MERGE]}
+                try:
+                    self._merge_into(exam_id, chunk)
+                except Exception:
+                    logger.exception("Exam stats of %s not merged, kept for the next flush", exam_id)
+                    with self._lock:
+                        # A newer grade recorded meanwhile wins
+                        self._pending[exam_id] = {**chunk, **self._pending.get(exam_id, {})}
+        return len(pending)
+
+    def rebuild(self, exam_id: str, attempts: Dict[str, Dict[str, Any]]) -> ExamStats:
+        """Replace the exam's stats with those of every graded attempt (after a bulk grade)
+
+        attempts maps attempt IDs to attempts. They are marked counted before
+        the document is replaced, so the deltas still pending for them here or
+        on other workers are dropped instead of counted a second time.
+        """
+        stats = ExamStats()
+        for attempt in attempts.values():
+            stats.add(attempt_values(attempt))
+        with self._lock:
+            self._pending.pop(exam_id, None)
+        stats_ref = self.db.collection(STATS_COLLECTION).document(exam_id)
+        now = datetime.now(timezone.utc)
+        attempt_ids = list(attempts)
+        for i in range(0, len(attempt_ids), BATCH_SIZE):
+            batch = self.db.batch()
+            for attempt_id in attempt_ids[i:i + BATCH_SIZE]:
+                batch.set(stats_ref.collection(COUNTED_COLLECTION).document(attempt_id), {"counted_at": now})
+            batch.commit()
+        stats_ref.set({**self._exam_fields(exam_id), **stats.to_dict(), "updated_at": now})
+        return stats
+
+    def exam(self, exam_id: str) -> Optional[Dict[str, Any]]:
+        stats_doc = self.db.collection(STATS_COLLECTION).document(exam_id).get()
+        if not stats_doc.exists:
+            return None
+        data = stats_doc.to_dict()
+        return {"exam_id": exam_id, "updated_at": data.get("updated_at"), **ExamStats.from_dict(data).summary()}
+
+    def module(self, module_name: str, teacher_id: Optional[str] = None) -> Dict[str, Any]:
+        """Stats of a module: the exams' sketches and histograms merged"""
+        query = self.db.collection(STATS_COLLECTION).where('module_name', '==', module_name)
+        if teacher_id is not None:
+            query = query.where('id_teacher', '==', teacher_id)
+        merged, exams = ExamStats(), []
+        for doc in query.stream():
+            merged.merge(ExamStats.from_dict(doc.to_dict()))
+            exams.append(doc.id)
+        return {"module_name": module_name, "exams": exams, **merged.summary()}
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception:
+                logger.exception("Exam stats flush failed")
+
+    def start(self, interval: float = FLUSH_INTERVAL_SECONDS):
+        self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.to_thread(self.flush)
+
+
+if __name__ == "__main__":
+    import json
+
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    exams = [np.clip(rng.normal(loc, 15, 5000), 0, 100) for loc in (55, 65, 75, 85)]
+
+    parts = []
+    for values in exams:
+        stats = ExamStats()
+        for value in values:
+            stats.add({"score_percent": float(value)})
+        parts.append(stats)
+    merged = ExamStats()
+    for part in parts:
+        merged.merge(ExamStats.from_dict(part.to_dict()))
+
+    exact = np.percentile(np.concatenate(exams), PERCENTILES)
+    approx = merged.sketches["score_percent"].quantiles([p / 100 for p in PERCENTILES])
+    for p, e, a in zip(PERCENTILES, exact, approx):
+        print(f"p{p:<3} exact {e:6.2f}  sketch {a:6.2f}")
+    print(f"{merged.count} attempts over {len(exams)} exams, document {len(json.dumps(parts[0].to_dict())) / 1024:.1f} KiB per exam")
@@ -0,0 +1,130 @@
+"""
+Streaming exports of report collections (fraude, proof_identity).
+
+Documents are read page by page with a query cursor and turned into NDJSON
+or CSV lines as they arrive, so memory stays flat whatever the size of the
+export and the first rows are sent as soon as the first page is read.
+"""
+import csv
+import io
+import itertools
+import json
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from google.cloud.firestore_v1.field_path import FieldPath
+
+EXPORT_PAGE_SIZE = 500
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+FRAUDE_COLUMNS = ["document_id", "id", "id_ref", "ref_type", "nombre_fraude", "type_fraude", "date_fraude", "details"]
+PROOF_COLUMNS = [
+    "document_id",
+    "id_student",
+    "student_name",
+    "student_field",
+    "accuracy",
+    "precision",
+    "type_cognitive",
+    "temp_moyen_question",
+    "niveau_focus",
+    "violation",
+    "score_consistante",
+    "patern_dominante",
+    "score_integrité",
+    "scoring_version",
+    "created_at",
+    "statistics"
+]
+
+
+def build_query(collection_ref, date_field: str, start: Optional[datetime] = None, end: Optional[datetime] = None, filters: Optional[Dict[str, Any]] = None):
+    """Filtered query ordered by date then document ID, so it can be paged with a cursor"""
+    query = collection_ref
+    for field, value in (filters or {}).items():
+        if value is not None:
+            query = query.where(field, '==', value)
+    if start:
+        query = query.where(date_field, '>=', start)
+    if end:
+        query = query.where(date_field, '<', end)
+    return query.order_by(date_field).order_by(FieldPath.document_id())
+
+
+def iter_pages(query, page_size: int = EXPORT_PAGE_SIZE) -> Iterator[List[Any]]:
+    """Yield pages of snapshots, resuming after the last document of the previous page"""
+    cursor = None
+    while True:
+        page_query = query.start_after(cursor) if cursor is not None else query
+        page = list(page_query.limit(page_size).stream())
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        cursor = page[-1]
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=_json_default, ensure_ascii=False)
+    return value
+
+
+def ndjson_lines(rows: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    for row in rows:
+        yield (json.dumps(row, default=_json_default, ensure_ascii=False) + "\n").encode()
+
+
+def csv_lines(rows: Iterable[Dict[str, Any]], columns: List[str]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    writer.writerow(columns)
+    yield flush()
+    for row in rows:
+        writer.writerow([_csv_value(row.get(column)) for column in columns])
+        yield flush()
+
+
+def stream_rows(pages: Iterator[List[Any]], transform: Optional[Callable[[List[Dict[str, Any]]], Iterable[Dict[str, Any]]]] = None) -> Iterator[Dict[str, Any]]:
+    """Turn pages of snapshots into row dicts, transform is applied page by page (joins, filters)"""
+    for page in pages:
+        rows = []
+        for doc in page:
+            row = doc.to_dict()
+            row['document_id'] = doc.id
+            rows.append(row)
+        yield from (transform(rows) if transform else rows)
+
+
+def encode(rows: Iterable[Dict[str, Any]], export_format: str, columns: List[str]) -> Iterator[bytes]:
+    if export_format == "csv":
+        return csv_lines(rows, columns)
+    return ndjson_lines(rows)
+
+
+def prime(rows: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Read the first row now so query errors surface before the response starts"""
+    first = next(rows, None)
+    if first is None:
+        return iter(())
+    return itertools.chain([first], rows)
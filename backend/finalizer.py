@@ -0,0 +1,293 @@
+"""
+Background expiry of exam/quiz attempts when their window closes.
+
+An asyncio task sleeps until the next window end known to the schedule
+index (plus FINALIZE_GRACE_SECONDS), then moves every attempt still
+`in_progress` for the closed windows to `expired` in batched writes.
+Answers already on the attempt (autosave) are kept; for quizzes, where
+results live in quiz_submissions, they are also written as an expired
+submission under the submission's own journal-derived ID, and only for
+students who did not submit.
+
+Submissions are written by the submission journal's flusher, after the
+request: a window is only finalized once the local journal holds no
+pending entry for it (the grace period covers the journals of other
+hosts), attempts and students with a journal entry are left alone, and
+the exam expiry is conditioned on the attempt's update_time, so a
+completion written meanwhile wins. The window closed hooks run after that.
+
+Only the worker holding the Firestore lease (locks/attempt_finalizer) does
+the work, so running several uvicorn workers or instances is safe. The
+lease is renewed while the leader is alive and taken over once it expires.
+"""
+import asyncio
+import logging
+import os
+import socket
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from firebase_admin import firestore
+
+import journal
+
+logger = logging.getLogger(__name__)
+
+LEASE_COLLECTION = "locks"
+LEASE_DOCUMENT = "attempt_finalizer"
+LEASE_SECONDS = 90
+RENEW_SECONDS = 30
+CATCHUP_HOURS = 24
+FINALIZE_GRACE_SECONDS = 30  # submissions journaled before the end reach Firestore first
+POSTPONE_SECONDS = 2  # retry of a window waiting for the journal
+WRITE_BATCH_SIZE = 500  # Firestore limit per commit
+
+# window type -> (attempts collection, id field, submissions collection or None)
+ATTEMPTS = {
+    "exam": ("exam_attempts", "exam_id", None),
+    "quiz": ("quiz_attempts", "quiz_id", "quiz_submissions"),
+}
+
+
+class AttemptFinalizer:
+    def __init__(self, db, schedule_index, submission_journal: Optional[journal.SubmissionJournal] = None, owner: Optional[str] = None):
+        self.db = db
+        self.schedule_index = schedule_index
+        self.journal = submission_journal
+        self.postponed = False
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self.lease_expires_at: Optional[datetime] = None
+        self.next_wakeup: Optional[datetime] = None
+        self.swept_until: Optional[datetime] = None
+        self.total_expired = 0
+        self.recent_runs = deque(maxlen=50)
+        self.last_error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        # Called with every window once it is closed and its attempts expired
+        self.on_window_closed: List[Callable[[Dict[str, Any]], None]] = []
+
+    # -- lease -------------------------------------------------------------------
+
+    def _acquire_lease(self) -> bool:
+        """Take or renew the lease in a transaction, True when this worker holds it"""
+        lease_ref = self.db.collection(LEASE_COLLECTION).document(LEASE_DOCUMENT)
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def take(transaction):
+            now = datetime.now(timezone.utc)
+            snapshot = lease_ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            expires_at = lease.get('expires_at')
+            if lease.get('owner') not in (None, self.owner) and expires_at and expires_at > now:
+                return None
+            expires_at = now + timedelta(seconds=LEASE_SECONDS)
+            transaction.set(lease_ref, {'owner': self.owner, 'expires_at': expires_at, 'renewed_at': now})
+            return expires_at
+
+        self.lease_expires_at = take(transaction)
+        return self.lease_expires_at is not None
+
+    def _release_lease(self):
+        lease_ref = self.db.collection(LEASE_COLLECTION).document(LEASE_DOCUMENT)
+        snapshot = lease_ref.get()
+        if snapshot.exists and snapshot.to_dict().get('owner') == self.owner:
+            lease_ref.delete()
+
+    # -- expiry ------------------------------------------------------------------
+
+    def _commit(self, groups: List[List[tuple]]) -> int:
+        """Commit groups of writes (one group per attempt) in batches, returns how many groups were written"""
+        written = 0
+        for i in range(0, len(groups), WRITE_BATCH_SIZE // 2):
+            chunk = groups[i:i + WRITE_BATCH_SIZE // 2]
+            batch = self.db.batch()
+            for group in chunk:
+                for operation, ref, data, kwargs in group:
+                    getattr(batch, operation)(ref, data, **kwargs)
+            try:
+                batch.commit()
+                written += len(chunk)
+                continue
+            except Exception:
+                pass
+            # A failed precondition (attempt submitted meanwhile, submission already
+            # there) fails the whole batch: retry attempt by attempt, skipping those
+            for group in chunk:
+                batch = self.db.batch()
+                for operation, ref, data, kwargs in group:
+                    getattr(batch, operation)(ref, data, **kwargs)
+                try:
+                    batch.commit()
+                    written += 1
+                except Exception as e:
+                    logger.info("Attempt %s not expired: %s", group[0][1].id, e)
+        return written
+
+    def expire_window(self, window: Dict[str, Any]) -> Optional[int]:
+        """Move the in-progress attempts of a closed window to expired, None when the journal
+        still has submissions to write for it"""
+        collection, id_field, submissions = ATTEMPTS[window['type']]
+        attempts = list(
+            self.db.collection(collection)
+            .where(id_field, '==', window['id'])
+            .where('status', '==', 'in_progress')
+            .stream()
+        )
+        if not attempts:
+            return 0
+        # key -> dead-lettered: pending entries postpone the window, failed ones are skipped
+        journaled = self.journal.unflushed(window['type']) if self.journal else {}
+        submitted = set()
+        if submissions:
+            # submit_quiz leaves the quiz attempt in_progress, the submission is what counts
+            submitted = {
+                doc.to_dict().get('student_id')
+                for doc in self.db.collection(submissions).where(id_field, '==', window['id']).stream()
+            }
+        now = datetime.now(timezone.utc)
+
+        groups = []
+        for attempt in attempts:
+            attempt_data = attempt.to_dict()
+            student_id = attempt_data.get('student_id')
+            if submissions:
+                key = journal.submission_key(window['type'], window['id'], str(student_id))
+            else:
+                key = journal.submission_key(window['type'], attempt.id)
+            if key in journaled:
+                if not journaled[key]:
+                    return None
+                continue
+            if student_id in submitted:
+                continue
+            group = [('update', attempt.reference, {
+                'status': 'expired',
+                'expired_at': now,
+                'completed_at': now
+            }, {'option': self.db.write_option(last_update_time=attempt.update_time)})]
+            if submissions:
+                # Same ID as the journaled submission: never a second document per student
+                group.append(('create', self.db.collection(submissions).document(journal.quiz_submission_id(key)), {
+                    id_field: window['id'],
+                    'student_id': student_id,
+                    'attempt_id': attempt.id,
+                    'answers': attempt_data.get('answers', {}),
+                    'submitted_at': now,
+                    'status': 'expired'
+                }, {}))
+            groups.append(group)
+
+        expired = self._commit(groups)
+        if expired:
+            self.recent_runs.appendleft({
+                "type": window['type'],
+                "id": window['id'],
+                "title": window.get('title'),
+                "window_end": window['end'],
+                "expired": expired,
+                "at": now
+            })
+            self.total_expired += expired
+        return expired
+
+    def sweep(self, now: datetime) -> int:
+        """Expire attempts of every window closed FINALIZE_GRACE_SECONDS ago since the last sweep"""
+        cutoff = now - timedelta(seconds=FINALIZE_GRACE_SECONDS)
+        since = self.swept_until or now - timedelta(hours=CATCHUP_HOURS)
+        expired = 0
+        self.postponed = False
+        for window in self.schedule_index.ended_between(since, cutoff):
+            count = self.expire_window(window)
+            if count is None:
+                # This window and the later ones are taken up again once the journal drained
+                self.postponed = True
+                self.swept_until = window['end'] - timedelta(microseconds=1)
+                return expired
+            expired += count
+            for hook in self.on_window_closed:
+                try:
+                    hook(window)
+                except Exception:
+                    logger.exception("Window closed hook failed")
+        self.swept_until = cutoff
+        return expired
+
+    # -- loop --------------------------------------------------------------------
+
+    async def _run(self):
+        while True:
+            try:
+                self.is_leader = await asyncio.to_thread(self._acquire_lease)
+                now = datetime.now(timezone.utc)
+                if self.is_leader:
+                    await asyncio.to_thread(self.sweep, now)
+                    next_end = await asyncio.to_thread(
+                        self.schedule_index.next_end, now - timedelta(seconds=FINALIZE_GRACE_SECONDS)
+                    )
+                else:
+                    # A new leader catches up from its own CATCHUP_HOURS window
+                    self.swept_until = None
+                    self.postponed = False
+                    next_end = None
+                self.last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Attempt finalizer run failed")
+                self.last_error = str(e)
+                next_end = None
+
+            # Wake at the next window end, or in time to renew the lease
+            delay = POSTPONE_SECONDS if self.postponed else RENEW_SECONDS
+            if next_end is not None:
+                finalize_at = next_end + timedelta(seconds=FINALIZE_GRACE_SECONDS)
+                delay = min(delay, max(0.0, (finalize_at - datetime.now(timezone.utc)).total_seconds()) + 1)
+            self.next_wakeup = datetime.now(timezone.utc) + timedelta(seconds=delay)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def wake(self):
+        """Re-plan now (a window was created or changed)"""
+        self._wake.set()
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.is_leader:
+            await asyncio.to_thread(self._release_lease)
+        self.is_leader = False
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "owner": self.owner,
+            "running": self._task is not None and not self._task.done(),
+            "is_leader": self.is_leader,
+            "lease_expires_at": self.lease_expires_at,
+            "next_wakeup": self.next_wakeup,
+            "swept_until": self.swept_until,
+            "total_expired": self.total_expired,
+            "last_error": self.last_error,
+            "recent_runs": list(self.recent_runs)
+        }
+
+
+def get_finalizer(db, schedule_index, submission_journal: Optional[journal.SubmissionJournal] = None) -> Optional[AttemptFinalizer]:
+    """Attempt finalizer unless ATTEMPT_FINALIZER=0"""
+    if os.getenv("ATTEMPT_FINALIZER", "1") == "0":
+        return None
+    return AttemptFinalizer(db, schedule_index, submission_journal)
@@ -0,0 +1,267 @@
+"""
+Server-side face counting on webcam frames sampled during exam attempts.
+
+The browser detection (WebcamSurveillance) can be tampered with, so the
+client also uploads a JPEG frame every few seconds. Frames are decoded at
+half resolution in grayscale (libjpeg DCT scaling, about 4x less work than
+a full decode) and scanned with OpenCV's frontal-face Haar cascade in a
+process pool, one cascade loaded per worker.
+
+- the pool queue is bounded (MAX_IN_FLIGHT_PER_WORKER frames per worker):
+  beyond that frames are refused instead of piling up latency;
+- frames over MAX_FRAME_PIXELS (read from the JPEG header) are refused
+  before decoding, and a frame that kills a pool worker is not retried;
+- each attempt may send at most one frame every MIN_FRAME_INTERVAL_SECONDS
+  (with a burst of FRAME_BURST), enforced with a token bucket;
+- VIOLATION_STREAK consecutive frames with no face or several faces make a
+  fraud report, through the same flow as browser detections.
+
+The token bucket and the streak of an attempt are kept in
+`frame_checks/{attempt_id}` and updated in transactions, so frames may
+reach any worker; the documents carry `expires_at` for a Firestore TTL
+policy.
+
+OpenCV is optional (opencv-python-headless): without it the analysis is
+unavailable and the browser detection remains the only source.
+
+    python frame_analysis.py   # frames per second, one process vs. the pool
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from firebase_admin import firestore
+
+try:
+    import cv2
+except ImportError:  # optional, server-side frame analysis is disabled instead
+    cv2 = None
+
+CHECKS_COLLECTION = 'frame_checks'
+MAX_FRAME_BYTES = 512 * 1024
+MAX_FRAME_PIXELS = 2560 * 1440
+MAX_IN_FLIGHT_PER_WORKER = 4
+MIN_FRAME_INTERVAL_SECONDS = 2.0
+FRAME_BURST = 3
+VIOLATION_STREAK = 3
+DETECTION_WIDTH = 320  # frames are scanned at most this wide
+ATTEMPT_IDLE_SECONDS = 3600
+
+logger = logging.getLogger(__name__)
+
+_cascade = None
+
+
+def available() -> bool:
+    return cv2 is not None
+
+
+# Start of frame markers (baseline, progressive, lossless...), which carry the size
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(jpeg: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) from the JPEG header, None when it is not a JPEG"""
+    if jpeg[:2] != b"\xff\xd8":
+        return None
+    position = 2
+    while position + 9 <= len(jpeg):
+        if jpeg[position] != 0xFF:
+            return None
+        marker = jpeg[position + 1]
+        if marker == 0xFF:  # fill byte
+            position += 1
+            continue
+        if marker in _SOF_MARKERS:
+            height = int.from_bytes(jpeg[position + 5:position + 7], "big")
+            width = int.from_bytes(jpeg[position + 7:position + 9], "big")
+            return width, height
+        if marker == 0xD9 or marker == 0xDA:  # end of image or scan data before any frame header
+            return None
+        position += 2 + int.from_bytes(jpeg[position + 2:position + 4], "big")
+    return None
+
+
+def _load_cascade():
+    global _cascade
+    if _cascade is None:
+        _cascade = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+    return _cascade
+
+
+def count_faces(jpeg: bytes) -> Dict[str, Any]:
+    """Number of faces in a JPEG frame (runs in a pool worker)"""
+    started = time.perf_counter()
+    size = jpeg_size(jpeg)
+    if size is None or size[0] * size[1] > MAX_FRAME_PIXELS:
+        return {"faces": None, "error": "Image illisible ou trop grande"}
+    gray = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None:
+        return {"faces": None, "error": "Image illisible"}
+    height, width = gray.shape
+    if width > DETECTION_WIDTH:
+        gray = cv2.resize(gray, (DETECTION_WIDTH, int(height * DETECTION_WIDTH / width)), interpolation=cv2.INTER_AREA)
+    gray = cv2.equalizeHist(gray)
+    faces = _load_cascade().detectMultiScale(gray, scaleFactor=1.15, minNeighbors=5, minSize=(30, 30))
+    return {
+        "faces": int(len(faces)),
+        "width": width * 2,
+        "height": height * 2,
+        "analysis_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+
+class FrameAnalyzer:
+    """Bounded process pool, per-attempt rate limits and violation streaks (in Firestore)"""
+
+    def __init__(self, db=None, workers: Optional[int] = None):
+        self.db = db
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = self.workers * MAX_IN_FLIGHT_PER_WORKER
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.in_flight = 0
+        self.analyzed = 0
+        self.rejected_busy = 0
+        self.rejected_rate = 0
+        self.pool_restarts = 0
+        self.crashed = 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _reset_pool(self, broken: ProcessPoolExecutor):
+        # Frames in flight may all fail on the same pool: only the first replaces it
+        if self._pool is broken:
+            logger.warning("Frame analysis pool broken, restarting it")
+            self._pool = None
+            self.pool_restarts += 1
+            broken.shutdown(wait=False, cancel_futures=True)
+
+    def _update_checks(self, attempt_id: str, change) -> Any:
+        """Apply change(checks) -> result to the attempt's frame_checks document in a transaction"""
+        checks_ref = self.db.collection(CHECKS_COLLECTION).document(attempt_id)
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def apply(transaction):
+            snapshot = checks_ref.get(transaction=transaction)
+            checks = snapshot.to_dict() if snapshot.exists else {}
+            result = change(checks)
+            now = datetime.now(timezone.utc)
+            transaction.set(checks_ref, {**checks, "expires_at": now + timedelta(seconds=ATTEMPT_IDLE_SECONDS)})
+            return result
+
+        return apply(transaction)
+
+    def admit(self, attempt_id: str) -> bool:
+        """Take a token of the attempt's bucket, False when it sends frames too fast"""
+
+        def take(checks: Dict[str, Any]) -> bool:
+            now = time.time()
+            tokens = float(checks.get("tokens", FRAME_BURST))
+            tokens = min(float(FRAME_BURST), tokens + (now - checks.get("refilled_at", now)) / MIN_FRAME_INTERVAL_SECONDS)
+            admitted = tokens >= 1.0
+            checks["tokens"] = tokens - 1.0 if admitted else tokens
+            checks["refilled_at"] = now
+            return admitted
+
+        admitted = self._update_checks(attempt_id, take)
+        if not admitted:
+            self.rejected_rate += 1
+        return admitted
+
+    async def analyze(self, jpeg: bytes) -> Optional[Dict[str, Any]]:
+        """Face count of a frame, None when the pool queue is full"""
+        if self.in_flight >= self.max_in_flight:
+            self.rejected_busy += 1
+            return None
+        self.in_flight += 1
+        try:
+            pool = self._get_pool()
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(pool, count_faces, jpeg)
+            except BrokenProcessPool:
+                # A worker died, maybe on this very frame: replace the pool, never retry the frame
+                self._reset_pool(pool)
+                self.crashed += 1
+                return {"faces": None, "error": "Analyse de l'image interrompue"}
+        finally:
+            self.in_flight -= 1
+        self.analyzed += 1
+        return result
+
+    def observe(self, attempt_id: str, faces: int) -> Tuple[Optional[str], bool]:
+        """Violation of a frame and whether the streak calls for a fraud report"""
+        violation = "no_face" if faces == 0 else "multiple_faces" if faces > 1 else None
+
+        def count(checks: Dict[str, Any]) -> bool:
+            streak = int(checks.get("streak") or 0) + 1 if violation else 0
+            report = streak >= VIOLATION_STREAK
+            checks["streak"] = 0 if report else streak
+            return report
+
+        return violation, self._update_checks(attempt_id, count)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": available(),
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "analyzed": self.analyzed,
+            "rejected_busy": self.rejected_busy,
+            "rejected_rate": self.rejected_rate,
+            "pool_restarts": self.pool_restarts,
+            "crashed": self.crashed,
+        }
+
+
+if __name__ == "__main__":
+    if cv2 is None:
+        raise SystemExit("opencv-python-headless is required for the benchmark")
+
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(32):
+        # 640x480 webcam-like frame: smooth background, an ellipse for a head, sensor noise
+        image = np.tile(np.linspace(60, 180, 640, dtype=np.float32), (480, 1))
+        cv2.ellipse(image, (int(rng.integers(200, 440)), 220), (80, 105), 0, 0, 360, 200, -1)
+        image = np.clip(image + rng.normal(0, 8, image.shape), 0, 255).astype(np.uint8)
+        frames.append(cv2.imencode(".jpg", cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes())
+    count = 640
+
+    start = time.perf_counter()
+    for i in range(count // 4):
+        count_faces(frames[i % len(frames)])
+    single = (count // 4) / (time.perf_counter() - start)
+    print(f"1 process      {single:8.1f} frames/s   ({len(frames[0]) // 1024} KB JPEG, 640x480)")
+
+    analyzer = FrameAnalyzer()
+
+    async def run_pool():
+        list(analyzer._get_pool().map(len, [b""] * analyzer.workers))  # start the workers
+        semaphore = asyncio.Semaphore(analyzer.max_in_flight)
+
+        async def one(i):
+            async with semaphore:
+                await analyzer.analyze(frames[i % len(frames)])
+
+        await asyncio.gather(*(one(i) for i in range(count)))
+
+    start = time.perf_counter()
+    asyncio.run(run_pool())
+    pooled = count / (time.perf_counter() - start)
+    analyzer.shutdown()
+    print(f"{analyzer.workers} workers      {pooled:8.1f} frames/s   ({pooled / analyzer.workers:.1f} frames/s per core)")
@@ -0,0 +1,294 @@
+"""
+Automatic grading of exam attempts and quiz submissions.
+
+The answer key of an assessment (its exam_questions / quiz_questions) is
+loaded once and cached as compact arrays: correct option and points per
+question, in question_number order. A submission is encoded to an array of
+chosen options (-1 when unanswered) and graded with one comparison and one
+dot product; a whole exam is graded as a (submissions x questions) matrix in
+a single pass and the scores are written back in batches.
+
+Answers are accepted the way the clients send them: keyed by the 0-based
+question position (student dashboard), the question_number or the question
+document ID, with the option text or its index as value.
+
+short_answer questions with accepted_answers are scored by similarity
+(text_grading); other questions are left for review (pending_review) and do
+not count in the automatic score.
+
+    python grading.py   # grading throughput, one by one vs. batch
+"""
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from text_grading import TextScorer
+
+WRITE_BATCH_SIZE = 500  # Firestore limit per commit
+# invalidate() only reaches the worker that made the correction: the TTL
+# bounds how long the other workers grade with the previous key
+ANSWER_KEY_TTL_SECONDS = 60
+MISSING_KEY_TTL_SECONDS = 10  # questions may be added right after the assessment
+AUTO_GRADED_TYPES = ("multiple_choice", "true_false")
+UNANSWERED = -1
+
+# kind -> (questions collection, submissions collection, id field, statuses graded or None for all)
+GRADED = {
+    "exam": ("exam_questions", "exam_attempts", "exam_id", ["completed", "expired", "terminated"]),
+    "quiz": ("quiz_questions", "quiz_submissions", "quiz_id", None),
+}
+
+
+class AnswerKey:
+    """Correct options and points of an assessment, as arrays in question order"""
+
+    def __init__(self, questions: List[Dict[str, Any]]):
+        questions = sorted(questions, key=lambda question: question.get("question_number") or 0)
+        self.size = len(questions)
+        self.ids = [question.get("id") for question in questions]
+        self.types = [question.get("type") or "multiple_choice" for question in questions]
+        self._auto = [kind in AUTO_GRADED_TYPES for kind in self.types]
+        self.auto = np.array(self._auto, dtype=np.bool_)
+        self.correct = np.array(
+            [int(question.get("correct_answer", UNANSWERED)) if auto else UNANSWERED
+             for question, auto in zip(questions, self.auto)],
+            dtype=np.int16
+        )
+        self.points = np.array([float(question.get("points") or 0) for question in questions], dtype=np.float64)
+        self.max_score = float(self.points.sum())
+        self.scorers = {
+            i: scorer for i, question in enumerate(questions)
+            if not self._auto[i] and (scorer := TextScorer.from_question(question)) is not None
+        }
+        self.graded = self.auto.copy()
+        self.graded[list(self.scorers)] = True
+        self.version = hashlib.blake2b(json.dumps(
+            [[question.get(field) for field in (
+                "question_number", "type", "correct_answer", "points",
+                "accepted_answers", "full_credit_threshold", "partial_credit_threshold"
+            )] for question in questions]
+        ).encode(), digest_size=8).hexdigest()
+
+        # Every key a client may use for a question -> its position
+        self.positions: Dict[str, int] = {}
+        for i, question in enumerate(questions):
+            if question.get("id"):
+                self.positions[str(question["id"])] = i
+            self.positions.setdefault(str(i), i)
+        # question_number is 1-based; the 0-based position wins when both exist
+        for i, question in enumerate(questions):
+            if question.get("question_number") is not None:
+                self.positions.setdefault(str(question["question_number"]), i)
+        self.options = [
+            {str(option): j for j, option in enumerate(question.get("options") or [])}
+            for question in questions
+        ]
+        # Valid option indexes are [0, option_counts[i]); true/false may omit its options
+        self.option_counts = [
+            len(question.get("options") or []) or (2 if kind == "true_false" else 0)
+            for question, kind in zip(questions, self.types)
+        ]
+        # (question key, option text) -> (position, option): one lookup per answer
+        self._pairs = {
+            (question_key, option): (position, j)
+            for question_key, position in self.positions.items()
+            for option, j in self.options[position].items()
+        }
+
+    def choice(self, position: int, value: Any) -> int:
+        """Option index of an answer value (option text or index), UNANSWERED when it is no option"""
+        if value is None or isinstance(value, bool):
+            return UNANSWERED
+        if not isinstance(value, int):
+            value = str(value)
+            index = self.options[position].get(value)
+            if index is not None:
+                return index
+            if not value.isdigit():
+                return UNANSWERED
+            value = int(value)
+        # Out of range would not fit the int16 arrays (and can't be a right answer anyway)
+        return value if 0 <= value < self.option_counts[position] else UNANSWERED
+
+    def _encode_into(self, chosen, answers: Optional[Dict[str, Any]], texts: Optional[Dict[int, Any]] = None):
+        """Chosen options into `chosen`, answers of similarity-graded questions into `texts`"""
+        pairs = self._pairs
+        for key, value in (answers or {}).items():
+            pair = pairs.get((key, value)) if isinstance(key, str) and isinstance(value, str) else None
+            if pair is not None:
+                chosen[pair[0]] = pair[1]
+                continue
+            position = self.positions.get(str(key))
+            if position is None:
+                continue
+            if self._auto[position]:
+                chosen[position] = self.choice(position, value)
+            elif value not in (None, ""):
+                # Free text: answered, scored apart when the question has a scorer
+                chosen[position] = 0
+                if texts is not None and position in self.scorers:
+                    texts[position] = value
+
+    def encode(self, answers: Optional[Dict[str, Any]], texts: Optional[Dict[int, Any]] = None) -> np.ndarray:
+        chosen = [UNANSWERED] * self.size
+        self._encode_into(chosen, answers, texts)
+        return np.array(chosen, dtype=np.int16)
+
+    def _result(self, earned, correct, answered, review) -> Dict[str, Any]:
+        return {
+            "score": round(float(earned), 4),
+            "max_score": self.max_score,
+            "correct_count": int(correct),
+            "answered_count": int(answered),
+            "pending_review": int(review),
+            "answer_key_version": self.version,
+        }
+
+    def grade(self, answers: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Score of one submission"""
+        texts: Dict[int, Any] = {}
+        chosen = self.encode(answers, texts)
+        hits = (chosen == self.correct) & self.auto
+        answered = chosen != UNANSWERED
+        earned, correct = float(hits @ self.points), int(hits.sum())
+        for position, value in texts.items():
+            credit = self.scorers[position].credit(value)
+            earned += credit * self.points[position]
+            correct += credit == 1.0
+        return self._result(earned, correct, answered.sum(), (answered & ~self.graded).sum())
+
+    def grade_many(self, submissions: List[Optional[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Scores of many submissions in one vectorized pass"""
+        if not submissions:
+            return []
+        rows = []
+        texts: Dict[int, Any] = {}
+        text_rows: Dict[int, List[int]] = {position: [] for position in self.scorers}
+        text_values: Dict[int, List[Any]] = {position: [] for position in self.scorers}
+        for row, answers in enumerate(submissions):
+            chosen = [UNANSWERED] * self.size
+            self._encode_into(chosen, answers, texts)
+            rows.append(chosen)
+            for position, value in texts.items():
+                text_rows[position].append(row)
+                text_values[position].append(value)
+            texts.clear()
+        chosen = np.array(rows, dtype=np.int16)
+        hits = (chosen == self.correct) & self.auto
+        answered = chosen != UNANSWERED
+        earned = hits @ self.points
+        correct = hits.sum(axis=1)
+        # Text answers: one similarity pass per question (memoized, pooled when large)
+        for position, scorer in self.scorers.items():
+            if text_rows[position]:
+                credits = np.array(scorer.credits(text_values[position]))
+                earned[text_rows[position]] += credits * self.points[position]
+                correct[text_rows[position]] += credits == 1.0
+        answered_count = answered.sum(axis=1)
+        review = (answered & ~self.graded).sum(axis=1)
+        return [
+            self._result(earned[i], correct[i], answered_count[i], review[i])
+            for i in range(len(submissions))
+        ]
+
+
+class AnswerKeyCache:
+    """Answer keys by (kind, assessment ID), loaded on first use and reloaded after a TTL"""
+
+    def __init__(self, db):
+        self.db = db
+        self._keys: Dict[tuple, tuple] = {}  # (kind, id) -> (expires_at, key)
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, assessment_id: str) -> Optional[AnswerKey]:
+        """Answer key of an exam or quiz, None when it has no questions"""
+        cache_key = (kind, assessment_id)
+        cached = self._keys.get(cache_key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        questions_collection, _, id_field, _ = GRADED[kind]
+        questions = []
+        for doc in self.db.collection(questions_collection).where(id_field, '==', assessment_id).stream():
+            question = doc.to_dict()
+            question["id"] = doc.id
+            questions.append(question)
+        key = AnswerKey(questions) if questions else None
+        ttl = ANSWER_KEY_TTL_SECONDS if key is not None else MISSING_KEY_TTL_SECONDS
+        with self._lock:
+            self._keys[cache_key] = (time.monotonic() + ttl, key)
+        return key
+
+    def invalidate(self, kind: str, assessment_id: str):
+        with self._lock:
+            self._keys.pop((kind, assessment_id), None)
+
+
+def grade_assessment(db, key: AnswerKey, kind: str, assessment_id: str,
+                     extra_fields: Iterable[str] = (), observe: Optional[Callable] = None) -> Dict[str, Any]:
+    """Grade every submission of an assessment, writing changed scores in batches
+
+    observe(rows, results) receives the submissions by ID (answers, score
+    and extra_fields) with their new grades, e.g. to rebuild statistics.
+    """
+    started = time.perf_counter()
+    _, collection, id_field, statuses = GRADED[kind]
+    query = db.collection(collection).where(id_field, '==', assessment_id)
+    if statuses:
+        query = query.where('status', 'in', statuses)
+    docs = list(query.select(['answers', 'score', 'answer_key_version', *extra_fields]).stream())
+    data = [doc.to_dict() for doc in docs]
+    results = key.grade_many([entry.get('answers') for entry in data])
+    if observe is not None:
+        observe({doc.id: entry for doc, entry in zip(docs, data)}, results)
+
+    now = datetime.now(timezone.utc)
+    updates = [
+        (doc.reference, {**result, "graded_at": now})
+        for doc, entry, result in zip(docs, data, results)
+        # A regrade only rewrites the submissions whose grading changed
+        if entry.get('score') != result["score"] or entry.get('answer_key_version') != key.version
+    ]
+    for i in range(0, len(updates), WRITE_BATCH_SIZE):
+        batch = db.batch()
+        for ref, update in updates[i:i + WRITE_BATCH_SIZE]:
+            batch.update(ref, update)
+        batch.commit()
+
+    scores = np.array([result["score"] for result in results], dtype=np.float64)
+    return {
+        "graded": len(results),
+        "updated": len(updates),
+        "mean_score": round(float(scores.mean()), 4) if len(scores) else None,
+        "max_score": key.max_score,
+        "answer_key_version": key.version,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    question_count, submission_count = 40, 10000
+    options = [[f"option {q}.{j}" for j in range(4)] for q in range(question_count)]
+    key = AnswerKey([
+        {"id": f"doc{q}", "question_number": q + 1, "type": "multiple_choice",
+         "options": options[q], "correct_answer": int(rng.integers(0, 4)), "points": 1}
+        for q in range(question_count)
+    ])
+    submissions = [
+        {str(q): options[q][int(choice)] for q, choice in enumerate(rng.integers(0, 4, question_count))}
+        for _ in range(submission_count)
+    ]
+
+    for label, func in [
+        ("one by one", lambda: [key.grade(answers) for answers in submissions]),
+        ("batch", lambda: key.grade_many(submissions)),
+    ]:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<12} {elapsed * 1000:8.1f} ms  ({elapsed / submission_count * 1e6:6.1f} us/submission)")
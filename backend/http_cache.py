@@ -0,0 +1,91 @@
+"""
+ETag / conditional GET support for rarely-changing read endpoints.
+
+Payloads (question sets, modules, exams, teachers) are serialized once per
+cached version and keyed by resource; the ETag is a hash of those bytes.
+A request whose If-None-Match matches a fresh entry gets a 304 without any
+Firestore read. Writes invalidate the matching keys, and the TTL bounds
+staleness when another instance did the write.
+"""
+import hashlib
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import Request, Response
+
+from responses import dumps
+
+DEFAULT_TTL_SECONDS = 300
+
+# Cache-Control per kind of resource
+CACHE_POLICIES = {
+    "questions": "private, max-age=300, must-revalidate",
+    "modules": "public, max-age=3600",
+    "exam": "private, no-cache",
+    "teacher": "private, max-age=300",
+}
+
+
+class CachedPayload:
+    __slots__ = ("body", "etag", "expires_at")
+
+    def __init__(self, body: bytes, ttl: float):
+        self.body = body
+        self.etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.expires_at = time.monotonic() + ttl
+
+
+class ResponseCache:
+    """Serialized payloads and their ETags, by resource key"""
+
+    def __init__(self):
+        self._entries: Dict[str, CachedPayload] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CachedPayload]:
+        entry = self._entries.get(key)
+        if entry is None or entry.expires_at < time.monotonic():
+            return None
+        return entry
+
+    def put(self, key: str, payload: Any, ttl: float = DEFAULT_TTL_SECONDS) -> CachedPayload:
+        entry = CachedPayload(dumps(payload), ttl)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def invalidate(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Compare weakly: a proxy may have re-compressed the body and added W/
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+def cached_response(
+    request: Request,
+    cache: ResponseCache,
+    key: str,
+    build: Callable[[], Any],
+    policy: str,
+    ttl: float = DEFAULT_TTL_SECONDS
+) -> Response:
+    """Serve key from the cache (304 when the client copy is current), building it on a miss"""
+    entry = cache.get(key)
+    if entry is None:
+        entry = cache.put(key, build(), ttl)
+
+    headers = {"ETag": entry.etag, "Cache-Control": CACHE_POLICIES[policy]}
+    if etag_matches(request, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
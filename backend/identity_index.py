@@ -0,0 +1,351 @@
+"""
+Nearest-neighbour index over the cognitive profiles of proof_identity.
+
+Each student is enrolled with the vector of their latest proof (accuracy,
+mean time per question, focus, consistency, hesitation statistics and the
+dominant pattern / cognitive type one-hot encoded). Vectors live in a NumPy
+matrix and are compared after z-score normalization over all students, so
+each feature weighs the same whatever its unit.
+
+- verify(student_id, profile): is a new session consistent with the
+  enrolled student? The claimed student must be among the nearest
+  enrolled profiles of the session (rank) to be consistent.
+- similar(student_id, k): the students whose profiles look the most alike.
+
+Exact search is a matrix-vector product (milliseconds for 100k students).
+When hnswlib is installed and the index exceeds ANN_MIN_SIZE, an HNSW graph
+answers the similar-students queries instead. New proofs are added in place
+as they are created (normalized with the current statistics, which are only
+recomputed once the index has grown by RENORMALIZE_GROWTH), and proofs
+written by other instances are picked up every REFRESH_SECONDS by a
+background task, from the created_at watermark of the previous load.
+
+    python identity_index.py   # query latency, exact vs. ANN
+"""
+import asyncio
+import logging
+import threading
+import time
+import warnings
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from dates import to_utc
+
+try:
+    import hnswlib
+except ImportError:  # optional, exact search is used instead
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+NUMERIC_FEATURES = [
+    "accuracy",
+    "temp_moyen_question",
+    "niveau_focus",
+    "score_consistante",
+    "statistics.response_time_std",
+    "statistics.hesitation_mean",
+    "statistics.hesitation_p50",
+    "statistics.hesitation_p90",
+    "statistics.pattern_dominance",
+]
+CATEGORICAL_FEATURES = {
+    "patern_dominante": ["sérieux", "stratégique", "aléatoire"],
+    "type_cognitive": ["Analytique", "Auditif", "Kinesthésique", "Visuel"],
+}
+PROOF_FIELDS = ["id_student", "created_at", "patern_dominante", "type_cognitive", "accuracy",
+                "temp_moyen_question", "niveau_focus", "score_consistante", "statistics"]
+DIMENSIONS = len(NUMERIC_FEATURES) + sum(len(values) for values in CATEGORICAL_FEATURES.values())
+
+CONSISTENT_RANK = 5  # the claimed student must be among the 5 closest profiles
+ANN_MIN_SIZE = 20000
+RENORMALIZE_GROWTH = 0.1  # normalization statistics are recomputed after 10% more students
+REFRESH_SECONDS = 60
+# Re-read the proofs just before the watermark, whose write may have landed after the last load
+SYNC_OVERLAP_SECONDS = 30
+
+
+def _value(profile: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = profile
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def vectorize(profile: Dict[str, Any]) -> np.ndarray:
+    """Raw feature vector of a proof or scoring result (NaN for missing numbers)"""
+    vector = np.full(DIMENSIONS, np.nan, dtype=np.float64)
+    for i, path in enumerate(NUMERIC_FEATURES):
+        value = _value(profile, path)
+        if value is not None:
+            vector[i] = value
+    offset = len(NUMERIC_FEATURES)
+    for field, values in CATEGORICAL_FEATURES.items():
+        vector[offset:offset + len(values)] = [float(profile.get(field) == value) for value in values]
+        offset += len(values)
+    return vector
+
+
+class IdentityIndex:
+    """One profile vector per student, searched after z-score normalization"""
+
+    def __init__(self, db=None, capacity: int = 1024):
+        self.db = db
+        self._raw = np.zeros((capacity, DIMENSIONS), dtype=np.float64)
+        self.student_ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._normalized: Optional[np.ndarray] = None
+        self._norms: Optional[np.ndarray] = None
+        self._normalized_count = 0
+        self._mean = np.zeros(DIMENSIONS)
+        self._scale = np.ones(DIMENSIONS)
+        self._ann = None
+        self._ann_stale = True
+        self._created_at: Dict[str, datetime] = {}
+        self.watermark: Optional[datetime] = None
+        self._synced_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.student_ids)
+
+    # -- building ----------------------------------------------------------------
+
+    def add(self, student_id: str, profile: Dict[str, Any]):
+        """Enroll a student, or replace their profile with a newer one"""
+        vector = vectorize(profile)
+        created_at = to_utc(profile.get("created_at"))
+        with self._lock:
+            enrolled_at = self._created_at.get(student_id)
+            if created_at and enrolled_at and created_at < enrolled_at:
+                return
+            if created_at:
+                self._created_at[student_id] = created_at
+            row = self._rows.get(student_id)
+            if row is None:
+                row = len(self.student_ids)
+                if row == len(self._raw):
+                    self._raw = np.concatenate([self._raw, np.zeros_like(self._raw)])
+                self._rows[student_id] = row
+                self.student_ids.append(student_id)
+            self._raw[row] = vector
+            if self._normalized is not None and len(self.student_ids) <= self._normalized_count * (1 + RENORMALIZE_GROWTH):
+                self._place(row, self._normalize(vector))
+            else:
+                self._normalized = None
+                self._ann_stale = True
+
+    def load(self) -> int:
+        """Add the proofs created since the previous load (everything the first time)
+
+        The watermark only moves here: proofs added locally meanwhile must
+        not hide those written by other instances.
+        """
+        query = self.db.collection('proof_identity').select(PROOF_FIELDS)
+        if self.watermark is not None:
+            query = query.where('created_at', '>', self.watermark - timedelta(seconds=SYNC_OVERLAP_SECONDS))
+        proofs = sorted(
+            (doc.to_dict() for doc in query.stream()),
+            key=lambda proof: to_utc(proof.get('created_at')) or datetime.min.replace(tzinfo=timezone.utc)
+        )
+        for proof in proofs:
+            if proof.get('id_student'):
+                self.add(proof['id_student'], proof)
+        created = [to_utc(proof.get('created_at')) for proof in proofs]
+        latest = max((value for value in created if value), default=None)
+        if latest and (self.watermark is None or latest > self.watermark):
+            self.watermark = latest
+        self._synced_at = time.monotonic()
+        return len(proofs)
+
+    def _ensure_fresh(self):
+        # With the background task running, requests never load on the event loop's behalf
+        if self.db is None or self._task is not None:
+            return
+        if self._synced_at is None or time.monotonic() - self._synced_at > REFRESH_SECONDS:
+            try:
+                self.load()
+            except Exception:
+                logger.exception("Identity index refresh failed")
+                self._synced_at = time.monotonic()
+
+    def _place(self, row: int, normalized: np.ndarray):
+        """Store one normalized vector (and update the ANN graph) without renormalizing"""
+        if row >= len(self._normalized):
+            grow = len(self._normalized)
+            self._normalized = np.concatenate([self._normalized, np.zeros((grow, DIMENSIONS), dtype=np.float32)])
+            self._norms = np.concatenate([self._norms, np.zeros(grow)])
+        self._normalized[row] = normalized
+        self._norms[row] = float(normalized @ normalized)
+        if self._ann is not None and not self._ann_stale:
+            if row >= self._ann.get_max_elements():
+                self._ann.resize_index(2 * self._ann.get_max_elements())
+            # Adding an existing label replaces its vector
+            self._ann.add_items(normalized[None, :].astype(np.float32), [row])
+
+    def _matrix(self) -> np.ndarray:
+        """Normalized vectors (missing values at the mean)"""
+        with self._lock:
+            count = len(self.student_ids)
+            if self._normalized is None:
+                raw = self._raw[:count]
+                with warnings.catch_warnings():
+                    # Features nobody has yet (all NaN) fall back to 0 / 1
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    self._mean = np.nan_to_num(np.nanmean(raw, axis=0)) if count else np.zeros(DIMENSIONS)
+                    std = np.nan_to_num(np.nanstd(raw, axis=0)) if count else np.ones(DIMENSIONS)
+                self._scale = np.where(std > 1e-9, std, 1.0)
+                self._normalized = np.nan_to_num((self._raw - self._mean) / self._scale).astype(np.float32)
+                self._norms = (self._normalized.astype(np.float64) ** 2).sum(axis=1)
+                self._normalized_count = count
+            return self._normalized[:count]
+
+    def _normalize(self, vector: np.ndarray) -> np.ndarray:
+        return np.nan_to_num((vector - self._mean) / self._scale)
+
+    def _ann_index(self, matrix: np.ndarray):
+        if hnswlib is None or len(matrix) < ANN_MIN_SIZE:
+            return None
+        if self._ann_stale:
+            index = hnswlib.Index(space="l2", dim=DIMENSIONS)
+            index.init_index(max_elements=len(matrix), ef_construction=100, M=16)
+            index.add_items(matrix.astype(np.float32), np.arange(len(matrix)))
+            index.set_ef(64)
+            self._ann, self._ann_stale = index, False
+        return self._ann
+
+    # -- queries -----------------------------------------------------------------
+
+    def _distances(self, matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # |x - q|² = |x|² - 2 x.q + |q|²: one matrix-vector product, no n x d temporary
+        query = query.astype(np.float64)
+        squared = self._norms[:len(matrix)] - 2.0 * (matrix @ query.astype(np.float32)) + query @ query
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    def verify(self, student_id: str, profile: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Consistency of a session profile with the student's enrolled profile, None if not enrolled"""
+        self._ensure_fresh()
+        row = self._rows.get(student_id)
+        if row is None:
+            return None
+        matrix = self._matrix()
+        distances = self._distances(matrix, self._normalize(vectorize(profile)))
+        distance = distances[row]
+        rank = int((distances < distance).sum())
+        return {
+            "student_id": student_id,
+            "consistent": rank < min(CONSISTENT_RANK, len(distances)),
+            "distance": round(float(distance), 4),
+            "rank": rank,
+            # Share of enrolled students further from the session than the claimed one
+            "percentile": round(100.0 * (distances > distance).sum() / max(1, len(distances) - 1), 1),
+            "enrolled": len(distances),
+        }
+
+    def similar(self, student_id: str, k: int = 10) -> Optional[List[Dict[str, Any]]]:
+        """The k students whose enrolled profiles are the closest, None if not enrolled"""
+        self._ensure_fresh()
+        row = self._rows.get(student_id)
+        if row is None:
+            return None
+        matrix = self._matrix()
+        k = max(0, min(k, len(matrix) - 1))
+        ann = self._ann_index(matrix)
+        if ann is not None:
+            labels, squared = ann.knn_query(matrix[row:row + 1].astype(np.float32), k=k + 1)
+            nearest = [(int(label), float(np.sqrt(value))) for label, value in zip(labels[0], squared[0]) if label != row][:k]
+        else:
+            distances = self._distances(matrix, matrix[row])
+            distances[row] = np.inf
+            candidates = np.argpartition(distances, k)[:k] if k < len(distances) else np.arange(len(distances))
+            nearest = sorted(((int(i), float(distances[i])) for i in candidates), key=lambda item: item[1])[:k]
+        return [{"student_id": self.student_ids[i], "distance": round(distance, 4)} for i, distance in nearest]
+
+    # -- background refresh ------------------------------------------------------
+
+    async def _run(self, interval: float):
+        while True:
+            try:
+                await asyncio.to_thread(self.load)
+            except Exception:
+                logger.exception("Identity index refresh failed")
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float = REFRESH_SECONDS):
+        self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enrolled": len(self),
+            "dimensions": DIMENSIONS,
+            "ann": hnswlib is not None and len(self) >= ANN_MIN_SIZE,
+            "watermark": self.watermark,
+        }
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    students = 100000
+
+    def random_profile(center=None):
+        base = center if center is not None else {
+            "accuracy": rng.uniform(0.3, 1.0), "temp_moyen_question": rng.uniform(1, 10),
+            "niveau_focus": rng.uniform(0, 1), "score_consistante": rng.uniform(0, 1),
+            "statistics": {"response_time_std": rng.uniform(200, 3000), "hesitation_mean": rng.uniform(100, 3000),
+                           "hesitation_p50": rng.uniform(100, 3000), "hesitation_p90": rng.uniform(500, 5000),
+                           "pattern_dominance": rng.uniform(0.2, 0.9)},
+            "patern_dominante": str(rng.choice(CATEGORICAL_FEATURES["patern_dominante"])),
+            "type_cognitive": str(rng.choice(CATEGORICAL_FEATURES["type_cognitive"])),
+        }
+        if center is None:
+            return base
+        # Same student, another session: a little noise on every number
+        return {
+            **base,
+            **{key: base[key] * rng.normal(1, 0.03) for key in ("accuracy", "temp_moyen_question", "niveau_focus", "score_consistante")},
+            "statistics": {key: value * rng.normal(1, 0.03) for key, value in base["statistics"].items()},
+        }
+
+    profiles = [random_profile() for _ in range(students)]
+    index = IdentityIndex()
+    start = time.perf_counter()
+    for i, profile in enumerate(profiles):
+        index.add(f"s{i}", profile)
+    index._matrix()
+    print(f"build {students} profiles  {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    start = time.perf_counter()
+    for i in range(1000):
+        index.add(f"new{i}", random_profile())
+    print(f"add (incremental)       {(time.perf_counter() - start):8.2f} ms/profile")
+
+    queries = 200
+    start = time.perf_counter()
+    genuine = sum(index.verify(f"s{i}", random_profile(profiles[i]))["consistent"] for i in range(queries))
+    impostor = sum(index.verify(f"s{i}", random_profile(profiles[i + 1]))["consistent"] for i in range(queries))
+    print(f"verify                  {(time.perf_counter() - start) / (2 * queries) * 1000:8.2f} ms/query  "
+          f"genuine accepted {genuine}/{queries}, impostors accepted {impostor}/{queries}")
+
+    start = time.perf_counter()
+    for i in range(queries):
+        index.similar(f"s{i}", 10)
+    print(f"similar (exact)         {(time.perf_counter() - start) / queries * 1000:8.2f} ms/query")
+    if hnswlib is not None:
+        index._ann_index(index._matrix())
+        start = time.perf_counter()
+        for i in range(queries):
+            index.similar(f"s{i}", 10)
+        print(f"similar (hnswlib)       {(time.perf_counter() - start) / queries * 1000:8.2f} ms/query")
@@ -0,0 +1,461 @@
+"""
+Keystroke dynamics of the profile-setup writing step.
+
+The client streams its key events in batches while the student types,
+either as a binary body (EVENT_DTYPE records, little-endian, 12 bytes
+each: timestamp in ms as float64, key code as uint16, 1 for keydown / 0
+for keyup, one padding byte) or as JSON arrays
+({"t": [...], "key": [...], "down": [...]}). Raw events are never stored:
+each batch only updates the session's features, then is dropped.
+
+- dwell: how long a key is held (keydown -> keyup of the same key);
+- flight: from the release of a key to the next press (negative when the
+  next key is pressed before the previous one is released);
+- n-graph latencies: keydown -> keydown over 2 and 3 consecutive presses,
+  per key sequence (count, sum, sum of squares).
+
+Dwell and flight go to fixed-bin histograms. Latencies above MAX_GAP_MS
+are pauses, not rhythm, and are left out. Everything adds up, so the
+signature of a student (`keystroke_signatures`, one document per student
+next to their proof_identity) is the merge of their writing sessions.
+
+An open session lives in `keystroke_sessions/{session_id}`: its features
+so far and the few keys that span batches (held keys, last presses).
+Each batch is applied in a transaction, so the batches of a session may
+reach any worker. Clients number their batches (`seq`, increasing): a
+batch at or below the session's last applied number is a retry and is
+acknowledged without being counted again. Abandoned sessions carry
+`expires_at` for a Firestore TTL policy.
+
+    python keystrokes.py   # ingestion throughput
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+
+SIGNATURES_COLLECTION = 'keystroke_signatures'
+SESSIONS_COLLECTION = 'keystroke_sessions'
+EVENT_DTYPE = np.dtype([("t", "<f8"), ("key", "<u2"), ("down", "u1"), ("pad", "u1")])
+MAX_BATCH_EVENTS = 50000
+MAX_BATCH_BYTES = MAX_BATCH_EVENTS * EVENT_DTYPE.itemsize
+MAX_JSON_BATCH_BYTES = MAX_BATCH_EVENTS * 40  # the same events as JSON numbers
+MAX_GAP_MS = 2000.0
+DWELL_BIN_MS, DWELL_BINS = 10.0, 50          # 0 - 500 ms, the last bin holds the rest
+FLIGHT_MIN_MS, FLIGHT_BIN_MS, FLIGHT_BINS = -500.0, 20.0, 125  # -500 - 2000 ms
+MAX_NGRAMS = 300  # per order, the most frequent are kept in the signature
+MAX_SESSION_NGRAMS = 5000  # per order in an open session document (1 MiB Firestore limit)
+SESSION_IDLE_SECONDS = 3600
+TOKEN_RECHECK_SECONDS = 60  # a session's token is re-verified at most this often
+
+
+def decode_events(body: bytes) -> np.ndarray:
+    """EVENT_DTYPE records of a binary batch"""
+    if len(body) % EVENT_DTYPE.itemsize:
+        raise ValueError(f"Batch size must be a multiple of {EVENT_DTYPE.itemsize} bytes")
+    return np.frombuffer(body, dtype=EVENT_DTYPE)
+
+
+def events_from_arrays(payload: Dict[str, Any]) -> np.ndarray:
+    """EVENT_DTYPE records of a JSON batch ({"t", "key", "down"} arrays)"""
+    t, key, down = (payload.get(field) or [] for field in ("t", "key", "down"))
+    if not (len(t) == len(key) == len(down)):
+        raise ValueError("t, key and down must have the same length")
+    events = np.zeros(len(t), dtype=EVENT_DTYPE)
+    events["t"] = np.asarray(t, dtype=np.float64)
+    events["key"] = np.asarray(key, dtype=np.int64) & 0xFFFF
+    events["down"] = np.asarray(down, dtype=bool)
+    return events
+
+
+def _bin_counts(values: np.ndarray, start: float, width: float, bins: int) -> np.ndarray:
+    index = np.clip(((values - start) // width).astype(np.int64), 0, bins - 1)
+    return np.bincount(index, minlength=bins)
+
+
+def _ngram_name(code: int, order: int) -> str:
+    return "-".join(str((code >> (16 * (order - 1 - i))) & 0xFFFF) for i in range(order))
+
+
+class KeystrokeProfile:
+    """Mergeable typing-rhythm features: dwell/flight histograms and n-graph latencies"""
+
+    def __init__(self):
+        self.dwell = np.zeros(DWELL_BINS, dtype=np.int64)
+        self.flight = np.zeros(FLIGHT_BINS, dtype=np.int64)
+        self.dwell_sum = 0.0
+        self.flight_sum = 0.0
+        # order -> n-graph code -> [count, sum, sum of squares] (ms)
+        self.ngrams: Dict[int, Dict[int, List[float]]] = {2: {}, 3: {}}
+        self.keystrokes = 0
+        self.typing_ms = 0.0  # keydown -> keydown time, pauses excluded
+
+    def add_dwell(self, values: np.ndarray):
+        if len(values):
+            self.dwell += _bin_counts(values, 0.0, DWELL_BIN_MS, DWELL_BINS)
+            self.dwell_sum += float(values.sum())
+
+    def add_flight(self, values: np.ndarray):
+        if len(values):
+            self.flight += _bin_counts(values, FLIGHT_MIN_MS, FLIGHT_BIN_MS, FLIGHT_BINS)
+            self.flight_sum += float(values.sum())
+
+    def add_ngrams(self, order: int, codes: np.ndarray, latencies: np.ndarray):
+        if not len(codes):
+            return
+        unique, inverse = np.unique(codes, return_inverse=True)
+        counts = np.bincount(inverse)
+        sums = np.bincount(inverse, weights=latencies)
+        squares = np.bincount(inverse, weights=latencies * latencies)
+        table = self.ngrams[order]
+        for code, count, total, square in zip(unique.tolist(), counts.tolist(), sums.tolist(), squares.tolist()):
+            entry = table.get(code)
+            if entry is None:
+                table[code] = [count, total, square]
+            else:
+                entry[0] += count
+                entry[1] += total
+                entry[2] += square
+
+    def merge(self, other: "KeystrokeProfile") -> "KeystrokeProfile":
+        self.dwell += other.dwell
+        self.flight += other.flight
+        self.dwell_sum += other.dwell_sum
+        self.flight_sum += other.flight_sum
+        for order, table in other.ngrams.items():
+            mine = self.ngrams.setdefault(order, {})
+            for code, (count, total, square) in table.items():
+                entry = mine.setdefault(code, [0, 0.0, 0.0])
+                entry[0] += count
+                entry[1] += total
+                entry[2] += square
+        self.keystrokes += other.keystrokes
+        self.typing_ms += other.typing_ms
+        return self
+
+    def to_dict(self, top_ngrams: Optional[int] = MAX_NGRAMS) -> Dict[str, Any]:
+        """Firestore fields, with the top_ngrams most frequent n-graphs per order (None: all)"""
+        ngrams = {}
+        for order, table in self.ngrams.items():
+            top = sorted(table.items(), key=lambda item: (-item[1][0], item[0]))[:top_ngrams]
+            ngrams[str(order)] = {_ngram_name(code, order): entry for code, entry in top}
+        return {
+            "dwell_histogram": self.dwell.tolist(),
+            "flight_histogram": self.flight.tolist(),
+            "dwell_sum": self.dwell_sum,
+            "flight_sum": self.flight_sum,
+            "ngrams": ngrams,
+            "keystrokes": self.keystrokes,
+            "typing_ms": self.typing_ms,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "KeystrokeProfile":
+        profile = cls()
+        if not data:
+            return profile
+        profile.dwell += np.array(data.get("dwell_histogram") or [0] * DWELL_BINS, dtype=np.int64)
+        profile.flight += np.array(data.get("flight_histogram") or [0] * FLIGHT_BINS, dtype=np.int64)
+        profile.dwell_sum = float(data.get("dwell_sum") or 0)
+        profile.flight_sum = float(data.get("flight_sum") or 0)
+        for order, table in (data.get("ngrams") or {}).items():
+            profile.ngrams[int(order)] = {
+                sum(int(key) << (16 * (int(order) - 1 - i)) for i, key in enumerate(name.split("-"))): list(entry)
+                for name, entry in table.items()
+            }
+        profile.keystrokes = int(data.get("keystrokes") or 0)
+        profile.typing_ms = float(data.get("typing_ms") or 0)
+        return profile
+
+    @staticmethod
+    def _quantile(counts: np.ndarray, q: float, start: float, width: float) -> Optional[float]:
+        total = counts.sum()
+        if not total:
+            return None
+        index = int(np.searchsorted(np.cumsum(counts), q * total))
+        return round(start + (index + 0.5) * width, 1)
+
+    def summary(self, top: int = 10) -> Dict[str, Any]:
+        dwell_count, flight_count = int(self.dwell.sum()), int(self.flight.sum())
+        digraphs = sorted(self.ngrams.get(2, {}).items(), key=lambda item: (-item[1][0], item[0]))[:top]
+        return {
+            "keystrokes": self.keystrokes,
+            "keys_per_minute": round(self.keystrokes / self.typing_ms * 60000, 1) if self.typing_ms else None,
+            "dwell": {
+                "count": dwell_count,
+                "mean_ms": round(self.dwell_sum / dwell_count, 1) if dwell_count else None,
+                "median_ms": self._quantile(self.dwell, 0.5, 0.0, DWELL_BIN_MS),
+                "p90_ms": self._quantile(self.dwell, 0.9, 0.0, DWELL_BIN_MS),
+            },
+            "flight": {
+                "count": flight_count,
+                "mean_ms": round(self.flight_sum / flight_count, 1) if flight_count else None,
+                "median_ms": self._quantile(self.flight, 0.5, FLIGHT_MIN_MS, FLIGHT_BIN_MS),
+                "p90_ms": self._quantile(self.flight, 0.9, FLIGHT_MIN_MS, FLIGHT_BIN_MS),
+            },
+            "digraphs": [
+                {"keys": _ngram_name(code, 2), "count": int(count), "mean_ms": round(total / count, 1)}
+                for code, (count, total, _) in digraphs
+            ],
+        }
+
+
+class KeystrokeSession:
+    """Features of one writing session, with the state that spans batches"""
+
+    def __init__(self, student_id: str):
+        self.student_id = student_id
+        self.profile = KeystrokeProfile()
+        self.events = 0
+        self.batches = 0
+        self.last_seq: Optional[int] = None  # number of the last batch applied
+        self._lock = threading.Lock()
+        self._held: Dict[int, Tuple[float, int]] = {}   # key -> (keydown time, press number)
+        self._next_press: Dict[int, float] = {}         # press number still held -> next keydown time
+        self._released: Optional[Tuple[int, float]] = None  # last press, released before the next one
+        self._presses = 0
+        self._recent: List[Tuple[float, int]] = []      # last keydowns, n-graphs span batches
+
+    def ingest(self, events: np.ndarray) -> int:
+        """Update the features with a batch of events (ordered by time within the batch)"""
+        if len(events) and np.any(np.diff(events["t"]) < 0):
+            events = events[np.argsort(events["t"], kind="stable")]
+        with self._lock:
+            press_t, press_key, dwell, flight = self._pair(
+                events["t"].tolist(), events["key"].tolist(), events["down"].tolist()
+            )
+            profile = self.profile
+            profile.add_dwell(np.array(dwell))
+            profile.add_flight(np.array(flight))
+            self._add_latencies(press_t, press_key)
+            profile.keystrokes += len(press_t)
+            self.events += len(events)
+            self.batches += 1
+        return len(events)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Firestore fields of an open session (no nested arrays: maps of arrays instead)"""
+        return {
+            "id_student": self.student_id,
+            "profile": self.profile.to_dict(top_ngrams=MAX_SESSION_NGRAMS),
+            "events": self.events,
+            "batches": self.batches,
+            "last_seq": self.last_seq,
+            "held": {str(key): [t, press] for key, (t, press) in self._held.items()},
+            "next_press": {str(press): t for press, t in self._next_press.items()},
+            "released": list(self._released) if self._released is not None else None,
+            "presses": self._presses,
+            "recent": {"t": [t for t, _ in self._recent], "key": [key for _, key in self._recent]},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "KeystrokeSession":
+        session = cls(data["id_student"])
+        session.profile = KeystrokeProfile.from_dict(data.get("profile"))
+        session.events = int(data.get("events") or 0)
+        session.batches = int(data.get("batches") or 0)
+        session.last_seq = data.get("last_seq")
+        session._held = {int(key): (float(t), int(press)) for key, (t, press) in (data.get("held") or {}).items()}
+        session._next_press = {int(press): float(t) for press, t in (data.get("next_press") or {}).items()}
+        released = data.get("released")
+        session._released = (int(released[0]), float(released[1])) if released else None
+        session._presses = int(data.get("presses") or 0)
+        recent = data.get("recent") or {}
+        session._recent = list(zip((float(t) for t in recent.get("t", [])), (int(key) for key in recent.get("key", []))))
+        return session
+
+    def _pair(self, times: List[float], keys: List[int], downs: List[int]):
+        held, next_press = self._held, self._next_press
+        released, presses = self._released, self._presses
+        press_t, press_key, dwell, flight = [], [], [], []
+        for t, key, down in zip(times, keys, downs):
+            if down:
+                if key in held:
+                    continue  # auto-repeat
+                if released is not None and released[0] == presses - 1:
+                    flight.append(t - released[1])
+                    released = None
+                elif presses:
+                    next_press[presses - 1] = t  # previous key still held
+                held[key] = (t, presses)
+                press_t.append(t)
+                press_key.append(key)
+                presses += 1
+            else:
+                pressed = held.pop(key, None)
+                if pressed is None:
+                    continue  # released before the session started
+                dwell.append(t - pressed[0])
+                following = next_press.pop(pressed[1], None)
+                if following is not None:
+                    flight.append(following - t)
+                elif pressed[1] == presses - 1:
+                    released = (pressed[1], t)
+        self._released, self._presses = released, presses
+        return press_t, press_key, dwell, [value for value in flight if value <= MAX_GAP_MS]
+
+    def _add_latencies(self, press_t: List[float], press_key: List[int]):
+        recent = self._recent
+        times = np.array([t for t, _ in recent] + press_t, dtype=np.float64)
+        keys = np.array([key for _, key in recent] + press_key, dtype=np.int64)
+        self._recent = list(zip(times[-2:].tolist(), keys[-2:].tolist()))
+        if len(times) < 2:
+            return
+        gaps = np.diff(times)
+        rhythm = gaps <= MAX_GAP_MS
+        # Only the gaps of this batch's presses count (the carried ones were counted already)
+        new = np.zeros(len(gaps), dtype=bool)
+        new[len(recent) - 1 if recent else 0:] = True
+        self.profile.typing_ms += float(gaps[rhythm & new].sum())
+        digraphs = rhythm & new
+        self.profile.add_ngrams(2, (keys[:-1] << 16 | keys[1:])[digraphs], gaps[digraphs])
+        if len(times) >= 3:
+            trigraphs = rhythm[:-1] & rhythm[1:] & new[1:]
+            codes = keys[:-2] << 32 | keys[1:-1] << 16 | keys[2:]
+            self.profile.add_ngrams(3, codes[trigraphs], (times[2:] - times[:-2])[trigraphs])
+
+
+class KeystrokeIngestor:
+    """Writing sessions kept in Firestore, and their merge into student signatures"""
+
+    def __init__(self, db):
+        self.db = db
+        self._tokens: Dict[str, Tuple[str, str, float]] = {}  # session -> (student, token, verified at)
+        self._lock = threading.Lock()
+        self.events = 0
+        self.batches = 0
+        self.duplicates = 0
+
+    def owner(self, session_id: str, token: str) -> Optional[str]:
+        """Student of a session recently verified with this token, None when it must be checked again"""
+        cached = self._tokens.get(session_id)
+        if cached is None or cached[1] != token or time.monotonic() - cached[2] > TOKEN_RECHECK_SECONDS:
+            return None
+        return cached[0]
+
+    def verified(self, session_id: str, student_id: str, token: str):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._tokens) > 10000:
+                self._tokens = {key: value for key, value in self._tokens.items() if now - value[2] <= TOKEN_RECHECK_SECONDS}
+            self._tokens[session_id] = (student_id, token, now)
+
+    def ingest(self, session_id: str, student_id: str, events: np.ndarray, seq: Optional[int] = None) -> Tuple[KeystrokeSession, bool]:
+        """Apply a batch to the session document, False when batch `seq` was already applied.
+        Raises PermissionError for another student's session"""
+        if len(events) > MAX_BATCH_EVENTS:
+            raise ValueError(f"At most {MAX_BATCH_EVENTS} events per batch")
+        session_ref = self.db.collection(SESSIONS_COLLECTION).document(session_id)
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def apply(transaction):
+            snapshot = session_ref.get(transaction=transaction)
+            if snapshot.exists:
+                session = KeystrokeSession.from_dict(snapshot.to_dict())
+                if session.student_id != student_id:
+                    raise PermissionError("Session of another student")
+            else:
+                session = KeystrokeSession(student_id)
+            if seq is not None and session.last_seq is not None and seq <= session.last_seq:
+                return session, False
+            session.ingest(events)
+            if seq is not None:
+                session.last_seq = seq
+            now = datetime.now(timezone.utc)
+            transaction.set(session_ref, {
+                **session.to_dict(),
+                "updated_at": now,
+                "expires_at": now + timedelta(seconds=SESSION_IDLE_SECONDS),
+            })
+            return session, True
+
+        session, applied = apply(transaction)
+        if not applied:
+            self.duplicates += 1
+            return session, False
+        self.events += len(events)
+        self.batches += 1
+        return session, True
+
+    def finish(self, session_id: str, student_id: str) -> Optional[Dict[str, Any]]:
+        """Merge the session into the student's signature and close it, returns the signature summary"""
+        session_ref = self.db.collection(SESSIONS_COLLECTION).document(session_id)
+        signature_ref = self.db.collection(SIGNATURES_COLLECTION).document(student_id)
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def merge(transaction):
+            session_snapshot = session_ref.get(transaction=transaction)
+            if not session_snapshot.exists:
+                return None
+            session = KeystrokeSession.from_dict(session_snapshot.to_dict())
+            if session.student_id != student_id:
+                raise PermissionError("Session of another student")
+            snapshot = signature_ref.get(transaction=transaction)
+            current = snapshot.to_dict() if snapshot.exists else None
+            profile = KeystrokeProfile.from_dict(current).merge(session.profile)
+            sessions = int((current or {}).get("sessions") or 0) + 1
+            now = datetime.now(timezone.utc)
+            transaction.set(signature_ref, {
+                "id_student": student_id,
+                **profile.to_dict(),
+                "sessions": sessions,
+                "created_at": (current or {}).get("created_at") or now,
+                "updated_at": now,
+            })
+            transaction.delete(session_ref)
+            return profile, sessions
+
+        merged = merge(transaction)
+        self._tokens.pop(session_id, None)
+        if merged is None:
+            return None
+        profile, sessions = merged
+        return {"id_student": student_id, "sessions": sessions, **profile.summary()}
+
+    def signature(self, student_id: str) -> Optional[Dict[str, Any]]:
+        doc = self.db.collection(SIGNATURES_COLLECTION).document(student_id).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        return {
+            "id_student": student_id,
+            "sessions": data.get("sessions", 0),
+            "updated_at": data.get("updated_at"),
+            **KeystrokeProfile.from_dict(data).summary(),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {"batches": self.batches, "events": self.events, "duplicates": self.duplicates}
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+
+    def typing(count: int, start: float = 0.0) -> np.ndarray:
+        keys = rng.integers(65, 91, count)
+        downs = start + np.cumsum(rng.gamma(4.0, 40.0, count))
+        ups = downs + rng.normal(95, 20, count).clip(20)
+        events = np.zeros(2 * count, dtype=EVENT_DTYPE)
+        events["t"] = np.concatenate([downs, ups])
+        events["key"] = np.concatenate([keys, keys])
+        events["down"] = np.concatenate([np.ones(count), np.zeros(count)])
+        return events[np.argsort(events["t"], kind="stable")]
+
+    session = KeystrokeSession("bench")
+    batches = [typing(250, 250 * 200.0 * i).tobytes() for i in range(400)]  # 200k events
+    start = time.perf_counter()
+    for body in batches:
+        session.ingest(decode_events(body))
+    elapsed = time.perf_counter() - start
+    print(f"{session.events} events in {elapsed * 1000:.0f} ms ({session.events / elapsed:,.0f} events/s, "
+          f"{elapsed / len(batches) * 1e6:.0f} us per 500-event batch)")
+    roundtrip = KeystrokeProfile.from_dict(session.profile.to_dict())
+    print(f"signature: {len(str(session.profile.to_dict()))} chars, summary: {roundtrip.summary(top=3)}")
@@ -0,0 +1,322 @@
+"""
+Live analytics aggregates maintained from Firestore snapshot listeners.
+
+LiveAggregator subscribes with on_snapshot to the collections behind
+/analytics/dashboard and /analytics/field/{field}. The first snapshot of a
+listener is the bulk load, every later one only carries the changed
+documents, which are applied as deltas to in-memory counters and
+cognitive-type distributions. The analytics endpoints then read the
+aggregates in O(1).
+
+A supervisor thread re-subscribes (and rebuilds the collection from its
+initial snapshot) when a listener dies. Clients without on_snapshot, such
+as local stand-ins, are polled and diffed instead.
+"""
+import logging
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+WATCHED_COLLECTIONS = ["students", "teachers", "modules", "exams", "quizzes", "proof_identity", "fraude"]
+SUPERVISOR_INTERVAL_SECONDS = 10
+POLL_INTERVAL_SECONDS = 5
+
+ADDED = "ADDED"
+MODIFIED = "MODIFIED"
+REMOVED = "REMOVED"
+
+
+class _PollingWatch:
+    """on_snapshot stand-in: re-reads the collection and reports the diff"""
+
+    def __init__(self, collection_ref, callback: Callable, interval: float = POLL_INTERVAL_SECONDS):
+        self._collection_ref = collection_ref
+        self._callback = callback
+        self._interval = interval
+        self._known: Dict[str, Any] = {}
+        self._stop = threading.Event()
+        self.is_active = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def poll(self):
+        current = {doc.id: doc for doc in self._collection_ref.stream()}
+        changes = []
+        for doc_id, doc in current.items():
+            if doc_id not in self._known:
+                changes.append((ADDED, doc))
+            elif doc.to_dict() != self._known[doc_id].to_dict():
+                changes.append((MODIFIED, doc))
+        for doc_id, doc in self._known.items():
+            if doc_id not in current:
+                changes.append((REMOVED, doc))
+        self._known = current
+        return changes
+
+    def _run(self):
+        first = True
+        while not self._stop.is_set():
+            try:
+                changes = self.poll()
+                if changes or first:
+                    self._callback(changes)
+                first = False
+            except Exception:
+                logger.exception("Polling watch failed")
+                self.is_active = False
+                return
+            self._stop.wait(self._interval)
+
+    def unsubscribe(self):
+        self._stop.set()
+        self.is_active = False
+
+
+def _proof_time(proof: Dict[str, Any]) -> float:
+    created_at = proof.get('created_at')
+    if isinstance(created_at, str):
+        try:
+            created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+        except ValueError:
+            return 0.0
+    if isinstance(created_at, datetime):
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return created_at.timestamp()
+    return 0.0
+
+
+class LiveAggregator:
+    """In-memory counters kept current by snapshot listener deltas"""
+
+    def __init__(self, db, collections=None):
+        self.db = db
+        self.collections = collections or WATCHED_COLLECTIONS
+        self._lock = threading.RLock()
+        self._watches: Dict[str, Any] = {}
+        self._loaded = set()
+        self._stop = threading.Event()
+        self._supervisor = None
+        self._failed = set()
+        self.resyncs = 0
+        self._reset()
+
+    # -- state -----------------------------------------------------------------
+
+    def _reset(self, collection: Optional[str] = None):
+        with self._lock:
+            if collection is None:
+                self.counts = Counter()
+                self._student_fields: Dict[str, str] = {}
+                self._proofs: Dict[str, Dict[str, Any]] = {}
+                self._student_proofs: Dict[str, set] = {}
+                self._contributions: Dict[str, tuple] = {}
+                self.cognitive_types = Counter()
+                self.field_students = Counter()
+                self.field_completed = Counter()
+                self.field_accuracy = Counter()
+                self.field_cognitive_types: Dict[str, Counter] = {}
+                self._loaded = set()
+                return
+
+            self._loaded.discard(collection)
+            self.counts[collection] = 0
+            if collection == 'students':
+                for student_id in list(self._student_fields):
+                    self._remove_student(student_id)
+            elif collection == 'proof_identity':
+                for proof_id in list(self._proofs):
+                    self._remove_proof(proof_id)
+
+    def _contribution(self, student_id: str) -> Optional[tuple]:
+        """(field, has_proof, accuracy, cognitive type) of a student, from its latest proof"""
+        field = self._student_fields.get(student_id)
+        if field is None:
+            return None
+        proof_ids = self._student_proofs.get(student_id)
+        if not proof_ids:
+            return (field, False, 0.0, None)
+        latest = max((self._proofs[proof_id] for proof_id in proof_ids), key=lambda proof: proof['time'])
+        return (field, True, latest['accuracy'], latest['type_cognitive'])
+
+    def _apply_contribution(self, contribution: Optional[tuple], sign: int):
+        if contribution is None:
+            return
+        field, has_proof, accuracy, cognitive_type = contribution
+        self.field_students[field] += sign
+        if has_proof:
+            self.field_completed[field] += sign
+            self.field_accuracy[field] += sign * accuracy
+            self.field_cognitive_types.setdefault(field, Counter())[cognitive_type] += sign
+
+    def _refresh_student(self, student_id: str):
+        """Swap the old field contribution of a student for the current one"""
+        self._apply_contribution(self._contributions.pop(student_id, None), -1)
+        contribution = self._contribution(student_id)
+        if contribution is not None:
+            self._contributions[student_id] = contribution
+            self._apply_contribution(contribution, +1)
+
+    def _remove_student(self, student_id: str):
+        self._student_fields.pop(student_id, None)
+        self._refresh_student(student_id)
+
+    def _remove_proof(self, proof_id: str):
+        proof = self._proofs.pop(proof_id, None)
+        if proof is None:
+            return
+        self.cognitive_types[proof['type_cognitive']] -= 1
+        self._student_proofs.get(proof['id_student'], set()).discard(proof_id)
+        self._refresh_student(proof['id_student'])
+
+    def _apply_change(self, collection: str, change_type: str, doc):
+        if change_type == REMOVED:
+            self.counts[collection] -= 1
+        elif change_type == ADDED:
+            self.counts[collection] += 1
+
+        if collection == 'students':
+            if change_type == REMOVED:
+                self._remove_student(doc.id)
+            else:
+                self._student_fields[doc.id] = (doc.to_dict() or {}).get('field')
+                self._refresh_student(doc.id)
+
+        elif collection == 'proof_identity':
+            self._remove_proof(doc.id)
+            if change_type != REMOVED:
+                data = doc.to_dict() or {}
+                proof = {
+                    'id_student': data.get('id_student'),
+                    'accuracy': data.get('accuracy') or 0,
+                    'type_cognitive': data.get('type_cognitive', 'Unknown'),
+                    'time': _proof_time(data),
+                }
+                self._proofs[doc.id] = proof
+                self.cognitive_types[proof['type_cognitive']] += 1
+                self._student_proofs.setdefault(proof['id_student'], set()).add(doc.id)
+                self._refresh_student(proof['id_student'])
+
+    def _on_changes(self, collection: str, changes):
+        """Apply (change type, document) pairs from one snapshot"""
+        with self._lock:
+            for change_type, doc in changes:
+                self._apply_change(collection, change_type, doc)
+            self._loaded.add(collection)
+
+    # -- listeners ---------------------------------------------------------------
+
+    def _subscribe(self, collection: str):
+        collection_ref = self.db.collection(collection)
+
+        def callback(*args):
+            # Firestore listeners call (docs, changes, read_time), the poller (changes)
+            if len(args) == 1:
+                changes = args[0]
+            else:
+                changes = [(change.type.name, change.document) for change in args[1]]
+            try:
+                self._on_changes(collection, changes)
+            except Exception:
+                # Never unsubscribe from the listener's own thread, the supervisor resyncs it
+                logger.exception("Failed to apply %s changes", collection)
+                self._failed.add(collection)
+
+        if hasattr(collection_ref, 'on_snapshot'):
+            self._watches[collection] = collection_ref.on_snapshot(callback)
+        else:
+            self._watches[collection] = _PollingWatch(collection_ref, callback)
+
+    def _resync(self, collection: str):
+        """Drop a collection's state and rebuild it from a fresh listener"""
+        watch = self._watches.pop(collection, None)
+        if watch is not None:
+            try:
+                watch.unsubscribe()
+            except Exception:
+                pass
+        self._reset(collection)
+        self._failed.discard(collection)
+        self.resyncs += 1
+        if not self._stop.is_set():
+            self._subscribe(collection)
+
+    def _supervise(self):
+        while not self._stop.wait(SUPERVISOR_INTERVAL_SECONDS):
+            for collection in self.collections:
+                watch = self._watches.get(collection)
+                if watch is None or not watch.is_active or collection in self._failed:
+                    logger.warning("Listener on %s is down, resyncing", collection)
+                    try:
+                        self._resync(collection)
+                    except Exception:
+                        logger.exception("Resync of %s failed", collection)
+
+    def start(self):
+        self._stop.clear()
+        for collection in self.collections:
+            self._subscribe(collection)
+        self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self._supervisor.start()
+
+    def stop(self):
+        self._stop.set()
+        for watch in self._watches.values():
+            try:
+                watch.unsubscribe()
+            except Exception:
+                pass
+        self._watches = {}
+
+    def ready(self) -> bool:
+        return not self._failed and all(collection in self._loaded for collection in self.collections)
+
+    # -- reads -------------------------------------------------------------------
+
+    def dashboard(self) -> Dict[str, Any]:
+        with self._lock:
+            students_count = self.counts['students']
+            completed_tests = self.counts['proof_identity']
+            completion_rate = (completed_tests / students_count * 100) if students_count > 0 else 0
+            return {
+                "counts": {
+                    "students": students_count,
+                    "teachers": self.counts['teachers'],
+                    "modules": self.counts['modules'],
+                    "exams": self.counts['exams'],
+                    "quizzes": self.counts['quizzes'],
+                    "completed_tests": completed_tests,
+                    "fraudes": self.counts['fraude']
+                },
+                "metrics": {
+                    "completion_rate": round(completion_rate, 2),
+                    "cognitive_type_distribution": {key: count for key, count in self.cognitive_types.items() if count > 0}
+                }
+            }
+
+    def field(self, field: str) -> Dict[str, Any]:
+        with self._lock:
+            total_students = self.field_students[field]
+            completed_tests = self.field_completed[field]
+            avg_accuracy = (self.field_accuracy[field] / completed_tests) if completed_tests > 0 else 0
+            completion_rate = (completed_tests / total_students * 100) if total_students > 0 else 0
+            distribution = self.field_cognitive_types.get(field, Counter())
+            return {
+                "field": field,
+                "total_students": total_students,
+                "completed_tests": completed_tests,
+                "completion_rate": round(completion_rate, 2),
+                "avg_accuracy": round(avg_accuracy * 100, 2),
+                "cognitive_type_distribution": {key: count for key, count in distribution.items() if count > 0}
+            }
+
+
+def get_aggregator(db) -> Optional[LiveAggregator]:
+    """Live aggregator unless LIVE_AGGREGATES=0"""
+    if os.getenv("LIVE_AGGREGATES", "1") == "0":
+        return None
+    return LiveAggregator(db)
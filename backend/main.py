@@ -1,10 +1,14 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import Callable, List, Optional, Dict, Any
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import NotFound
+import asyncio
 import hashlib
 import time
 from datetime import datetime, timedelta, timezone
@@ -14,6 +18,30 @@ import string
 from pydantic import BaseModel
 from typing import Literal
 
+import analytics_snapshots
+import autosave
+import collusion
+import evidence
+import exam_stats
+import exports
+import finalizer
+import frame_analysis
+import grading
+import http_cache
+import identity_index
+import journal
+import keystrokes
+import live_aggregates
+import question_bank
+import raw_store
+import schedule
+import scoring
+import surveillance
+import text_grading
+import voice_activity
+from dates import to_utc
+from responses import CompressionMiddleware, FastJSONResponse
+
 
 # Initialize Firebase
 if not firebase_admin._apps:
@@ -21,7 +49,28 @@ if not firebase_admin._apps:
     firebase_admin.initialize_app(cred)
 
 db = firestore.client()
-app = FastAPI(title="EDGUARD API", version="2.0.0")
+raw_data_store = raw_store.get_raw_store(db)
+evidence_store = evidence.get_evidence_store()
+analytics_engine = analytics_snapshots.get_engine()
+analytics_exporter = analytics_snapshots.get_exporter(db)
+live_aggregator = live_aggregates.get_aggregator(db)
+response_cache = http_cache.ResponseCache()
+questions_bank = question_bank.load_bank(db)
+schedule_index = schedule.ScheduleIndex(db)
+submission_journal = journal.get_journal()
+attempt_finalizer = finalizer.get_finalizer(db, schedule_index, submission_journal)
+answer_autosave = autosave.AutosaveBuffer(db)
+answer_keys = grading.AnswerKeyCache(db)
+exam_results = exam_stats.ExamStatsAggregator(db)
+collusion_analyzer = collusion.CollusionAnalyzer(db, answer_keys)
+identity_profiles = identity_index.IdentityIndex(db)
+keystroke_sessions = keystrokes.KeystrokeIngestor(db)
+surveillance_store = surveillance.SurveillanceStore(db)
+frame_analyzer = frame_analysis.FrameAnalyzer(db)
+voice_detector = voice_activity.VoiceActivityDetector(db)
+if attempt_finalizer:
+    attempt_finalizer.on_window_closed.append(collusion_analyzer.schedule)
+app = FastAPI(title="EDGUARD API", version="2.0.0", default_response_class=FastJSONResponse)
 security = HTTPBearer()
 
 # CORS middleware
@@ -33,6 +82,117 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large bodies (student listings, reports, exports)
+app.add_middleware(CompressionMiddleware)
+
+@app.on_event("startup")
+async def start_live_aggregates():
+    # Listeners load the analytics collections once, then apply deltas
+    if live_aggregator:
+        live_aggregator.start()
+
+@app.on_event("shutdown")
+async def stop_live_aggregates():
+    if live_aggregator:
+        live_aggregator.stop()
+
+@app.on_event("startup")
+async def start_attempt_finalizer():
+    # Expires attempts left in progress when their window closes
+    if attempt_finalizer:
+        attempt_finalizer.start()
+
+@app.on_event("shutdown")
+async def stop_attempt_finalizer():
+    if attempt_finalizer:
+        await attempt_finalizer.stop()
+
+@app.on_event("startup")
+async def start_submission_journal():
+    # Drains journaled submissions to Firestore in batches
+    submission_journal.start(db, prepare=grade_journaled_attempts)
+
+@app.on_event("shutdown")
+async def stop_submission_journal():
+    await submission_journal.stop(db)
+
+@app.on_event("startup")
+async def start_answer_autosave():
+    # Writes buffered answer changes as field-path updates
+    answer_autosave.start()
+
+@app.on_event("shutdown")
+async def stop_answer_autosave():
+    await answer_autosave.stop()
+
+@app.on_event("startup")
+async def start_surveillance_store():
+    # Appends surveillance samples to minute buckets and downsamples closed attempts
+    surveillance_store.start()
+
+@app.on_event("shutdown")
+async def stop_surveillance_store():
+    await surveillance_store.stop()
+
+@app.on_event("shutdown")
+async def stop_text_grading():
+    text_grading.shutdown_pool()
+
+@app.on_event("shutdown")
+async def stop_frame_analysis():
+    frame_analyzer.shutdown()
+
+@app.on_event("shutdown")
+async def stop_voice_activity():
+    voice_detector.shutdown()
+
+@app.on_event("startup")
+async def start_analytics_export():
+    # Incremental Parquet export read by the analytics endpoints
+    if analytics_exporter:
+        analytics_exporter.start()
+
+@app.on_event("shutdown")
+async def stop_analytics_export():
+    if analytics_exporter:
+        await analytics_exporter.stop()
+
+@app.on_event("startup")
+async def start_exam_stats():
+    # Merges the statistics of graded attempts into exam_stats
+    exam_results.start()
+
+@app.on_event("shutdown")
+async def stop_exam_stats():
+    await exam_results.stop()
+
+@app.on_event("startup")
+async def start_collusion_analyzer():
+    # Compares the answers of an exam's students once its window is closed
+    collusion_analyzer.start()
+
+@app.on_event("shutdown")
+async def stop_collusion_analyzer():
+    await collusion_analyzer.stop()
+
+@app.on_event("startup")
+async def start_schedule_index():
+    # Reloads the exam and quiz windows written by other workers every minute
+    schedule_index.start()
+
+@app.on_event("shutdown")
+async def stop_schedule_index():
+    await schedule_index.stop()
+
+@app.on_event("startup")
+async def start_identity_index():
+    # Loads the cognitive profiles, then the proofs written by other workers every minute
+    identity_profiles.start()
+
+@app.on_event("shutdown")
+async def stop_identity_index():
+    await identity_profiles.stop()
+
 # =============================================================================
 # PYDANTIC MODELS
 # =============================================================================
@@ -84,6 +244,7 @@ class FraudeReport(BaseModel):
     nombre_fraude: int
     type_fraude: str
     date_fraude: Optional[datetime] = None
+    evidence: List[str] = []  # SHA-256 of files uploaded to /evidence
 
 class ProofIdentityData(BaseModel):
     id_student: str
@@ -142,6 +303,10 @@ class Question(BaseModel):
     options: List[str]
     correctAnswer: int
     points: int
+    # short_answer: réponses acceptées et seuils de similarité (text_grading)
+    accepted_answers: List[str] = []
+    full_credit_threshold: Optional[float] = None
+    partial_credit_threshold: Optional[float] = None
 
 class ExamCreateComplete(BaseModel):
     id_teacher: str
@@ -292,6 +457,15 @@ def get_exam_status_for_student(exam_id: str, student_id: str) -> Dict[str, Any]
                     "can_take": True,
                     "message": "Examen en cours"
                 }
+            elif attempt.get('status') in ('completed', 'expired'):
+                return {
+                    "status": "completed",
+                    "completed_at": attempt.get('completed_at'),
+                    "score": attempt.get('score'),
+                    "max_score": attempt.get('max_score'),
+                    "can_take": False,
+                    "message": "Examen déjà complété"
+                }
         
         return {
             "status": "available",
@@ -308,26 +482,25 @@ def get_exam_status_for_student(exam_id: str, student_id: str) -> Dict[str, Any]
 
 
 
-def check_exam_time_availability(exam_data: Dict[str, Any]) -> Dict[str, Any]:
+def check_time_window(start_time, end_time, label: str) -> Dict[str, Any]:
+    """Check that now is within [start_time, end_time]"""
     try:
         now = datetime.now(timezone.utc)
-        start_time = exam_data.get('date_debut_exame')
-        end_time = exam_data.get('date_fin_exame')
-        
-        if isinstance(start_time, str):
-            start_time = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
-        if isinstance(end_time, str):
-            end_time = datetime.fromisoformat(end_time.replace('Z', '+00:00'))
+        # Dates are stored as UTC timestamps, older documents may hold naive values or ISO strings
+        start_time = to_utc(start_time)
+        end_time = to_utc(end_time)
+        if start_time is None or end_time is None:
+            raise ValueError("dates de disponibilité invalides")
         
         if now < start_time:
             return {
                 "time_available": False,
-                "message": f"Examen commence le {start_time.strftime('%d/%m/%Y à %H:%M')}"
+                "message": f"{label} commence le {start_time.strftime('%d/%m/%Y à %H:%M')}"
             }
         elif now > end_time:
             return {
                 "time_available": False,
-                "message": f"Examen terminé le {end_time.strftime('%d/%m/%Y à %H:%M')}"
+                "message": f"{label} terminé le {end_time.strftime('%d/%m/%Y à %H:%M')}"
             }
         else:
             return {
@@ -340,38 +513,13 @@ def check_exam_time_availability(exam_data: Dict[str, Any]) -> Dict[str, Any]:
             "message": f"Erreur de vérification temporelle: {str(e)}"
         }
 
+def check_exam_time_availability(exam_data: Dict[str, Any]) -> Dict[str, Any]:
+    return check_time_window(exam_data.get('date_debut_exame'), exam_data.get('date_fin_exame'), "Examen")
+
 def check_quiz_time_availability(quiz_data: Dict[str, Any]) -> Dict[str, Any]:
     """Check if quiz is within the allowed time window"""
-    try:
-        now = datetime.now(timezone.utc)
-        start_time = quiz_data.get('date_debut_quiz')
-        end_time = quiz_data.get('date_fin_quiz')
-        
-        if isinstance(start_time, str):
-            start_time = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
-        if isinstance(end_time, str):
-            end_time = datetime.fromisoformat(end_time.replace('Z', '+00:00'))
-        
-        if now < start_time:
-            return {
-                "time_available": False,
-                "message": f"Quiz commence le {start_time.strftime('%d/%m/%Y à %H:%M')}"
-            }
-        elif now > end_time:
-            return {
-                "time_available": False,
-                "message": f"Quiz terminé le {end_time.strftime('%d/%m/%Y à %H:%M')}"
-            }
-        else:
-            return {
-                "time_available": True,
-                "message": f"Disponible jusqu'au {end_time.strftime('%d/%m/%Y à %H:%M')}"
-            }
-    except Exception as e:
-        return {
-            "time_available": False,
-            "message": f"Erreur de vérification temporelle: {str(e)}"
-        }
+    return check_time_window(quiz_data.get('date_debut_quiz'), quiz_data.get('date_fin_quiz'), "Quiz")
+
 @app.get("/student/{student_id}/quizzes")
 async def get_student_quizzes(student_id: str):
     """Récupérer tous les quizzes assignés à un étudiant avec leur statut"""
@@ -451,6 +599,81 @@ async def get_student_exams(student_id: str):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Erreur lors de la récupération des examens: {str(e)}"
         )
+
+@app.get("/schedule")
+async def get_schedule(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    hours: float = 1,
+    student_id: Optional[str] = None,
+    teacher_id: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Calendrier des examens et quiz: ouverts maintenant et sur [start, end) (par défaut l'heure qui vient)"""
+    session_data = verify_token(credentials.credentials)
+    
+    # Students and teachers only see their own schedule
+    if session_data['role'] == 'student':
+        student_id, teacher_id = session_data['user_id'], None
+    elif session_data['role'] == 'teacher':
+        student_id, teacher_id = None, session_data['user_id']
+    
+    try:
+        now = datetime.now(timezone.utc)
+        start = to_utc(start) if start else now
+        end = to_utc(end) if end else start + timedelta(hours=hours)
+        if end <= start:
+            raise HTTPException(status_code=400, detail="La fin doit être après le début")
+        
+        def public(window):
+            return {
+                "id": window["id"],
+                "type": window["type"],
+                "title": window["title"],
+                "module_name": window["module_name"],
+                "id_teacher": window["id_teacher"],
+                "status": window["status"],
+                "start": window["start"],
+                "end": window["end"],
+                "is_open": window["start"] <= now <= window["end"]
+            }
+        
+        open_now = schedule_index.windows(now, now + timedelta(microseconds=1), student_id, teacher_id)
+        events = schedule_index.windows(start, end, student_id, teacher_id)
+        
+        return {
+            "start": start,
+            "end": end,
+            "open_now": [public(window) for window in open_now],
+            "events": [public(window) for window in events],
+            "count": len(events)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/schedule/finalizer")
+async def get_finalizer_status(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Status of the background attempt finalizer (Admin only)"""
+    verify_token(credentials.credentials, 'admin')
+    
+    if not attempt_finalizer:
+        return {"enabled": False}
+    return {"enabled": True, **attempt_finalizer.status()}
+
+@app.get("/submissions/journal")
+async def get_submission_journal_status(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Pending / flushed / failed submissions of the write-behind journal (Admin only)"""
+    verify_token(credentials.credentials, 'admin')
+    return {
+        **submission_journal.stats(),
+        "autosave": answer_autosave.stats(),
+        "surveillance": surveillance_store.stats(),
+        "frames": frame_analyzer.stats(),
+        "audio": voice_detector.stats()
+    }
+
 @app.post("/quiz/{quiz_id}/start")
 async def start_quiz(quiz_id: str, student_data: dict):
     """Démarrer un quiz avec vérification de statut"""
@@ -653,9 +876,9 @@ async def get_student_exams(student_id: str):
 
 # 3. Récupérer les questions d'un quiz
 @app.get("/quiz/{quiz_id}/questions")
-async def get_quiz_questions(quiz_id: str):
+async def get_quiz_questions(quiz_id: str, request: Request):
     """Récupérer toutes les questions d'un quiz"""
-    try:
+    def build():
         questions_query = db.collection('quiz_questions').where('quiz_id', '==', quiz_id)
         questions_docs = questions_query.stream()
         
@@ -664,8 +887,8 @@ async def get_quiz_questions(quiz_id: str):
             question = doc.to_dict()
             question['id'] = doc.id
             # Ne pas envoyer la bonne réponse au frontend
-            if 'correct_answer' in question:
-                del question['correct_answer']
+            for field in ('correct_answer', 'accepted_answers'):
+                question.pop(field, None)
             questions.append(question)
         
         # Trier par numéro de question
@@ -676,6 +899,9 @@ async def get_quiz_questions(quiz_id: str):
             "questions": questions,
             "count": len(questions)
         }
+    
+    try:
+        return http_cache.cached_response(request, response_cache, f"quiz_questions:{quiz_id}", build, "questions")
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -684,9 +910,9 @@ async def get_quiz_questions(quiz_id: str):
 
 # 4. Récupérer les questions d'un examen
 @app.get("/exam/{exam_id}/questions")
-async def get_exam_questions(exam_id: str):
+async def get_exam_questions(exam_id: str, request: Request):
     """Récupérer toutes les questions d'un examen"""
-    try:
+    def build():
         questions_query = db.collection('exam_questions').where('exam_id', '==', exam_id)
         questions_docs = questions_query.stream()
         
@@ -695,8 +921,8 @@ async def get_exam_questions(exam_id: str):
             question = doc.to_dict()
             question['id'] = doc.id
             # Ne pas envoyer la bonne réponse au frontend
-            if 'correct_answer' in question:
-                del question['correct_answer']
+            for field in ('correct_answer', 'accepted_answers'):
+                question.pop(field, None)
             questions.append(question)
         
         questions.sort(key=lambda x: x.get('question_number', 0))
@@ -706,12 +932,44 @@ async def get_exam_questions(exam_id: str):
             "questions": questions,
             "count": len(questions)
         }
+    
+    try:
+        return http_cache.cached_response(request, response_cache, f"exam_questions:{exam_id}", build, "questions")
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Erreur lors de la récupération des questions: {str(e)}"
         )
 
+def grade_answers(kind: str, assessment_id: str, answers: Dict[str, Any]) -> Dict[str, Any]:
+    """Champs de note (score, max_score, ...) d'une soumission, vide sans corrigé"""
+    key = answer_keys.get(kind, assessment_id)
+    if key is None:
+        return {}
+    return {**key.grade(answers), "graded_at": datetime.now(timezone.utc)}
+
+def grade_journaled_attempts(entries: List[Dict[str, Any]]):
+    """Noter les tentatives d'examen journalisées (réponses enregistrées par l'autosave
+    et celles journalisées à la soumission) avant leur écriture dans Firestore,
+    et les ajouter aux statistiques de l'examen. Exécuté par le flusher du journal."""
+    entries = [
+        entry for entry in entries
+        if entry["kind"] == "exam" and entry["payload"].get("exam_id")
+        and answer_keys.get('exam', entry["payload"]["exam_id"]) is not None
+    ]
+    if not entries:
+        return
+    refs = [db.collection('exam_attempts').document(entry["payload"]["attempt_id"]) for entry in entries]
+    attempts = {doc.id: doc.to_dict() for doc in db.get_all(refs) if doc.exists}
+    for entry in entries:
+        payload = entry["payload"]
+        attempt = attempts.get(payload["attempt_id"])
+        if attempt is None:
+            continue  # the update fails and is retried by the journal
+        answers = {**(attempt.get('answers') or {}), **payload.get("answers", {})}
+        payload["update"].update(grade_answers('exam', payload["exam_id"], answers))
+        exam_results.record(payload["exam_id"], payload["attempt_id"], {**attempt, **payload["update"]})
+
 # 5. Soumettre un quiz (pas de surveillance)
 @app.post("/quiz/{quiz_id}/submit")
 async def submit_quiz(quiz_id: str, submission: Dict[str, Any]):
@@ -719,23 +977,33 @@ async def submit_quiz(quiz_id: str, submission: Dict[str, Any]):
     try:
         student_id = submission.get('student_id')
         answers = submission.get('answers', {})
+        if not student_id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="student_id requis"
+            )
         
-        # Créer la soumission
+        # Créer la soumission, notée avec le corrigé en cache
         submission_doc = {
             "quiz_id": quiz_id,
             "student_id": student_id,
             "answers": answers,
-            "submitted_at": datetime.now(),
-            "status": "completed"
+            "submitted_at": datetime.now(timezone.utc),
+            "status": "completed",
+            **await asyncio.to_thread(grade_answers, 'quiz', quiz_id, answers)
         }
         
-        # Sauvegarder la soumission
-        db.collection('quiz_submissions').add(submission_doc)
+        # Journalisée localement, écrite dans Firestore par le flusher
+        await submission_journal.append_async(
+            journal.submission_key("quiz", quiz_id, student_id), "quiz", {"submission": submission_doc}
+        )
         
         return {
             "success": True,
             "message": "Quiz soumis avec succès"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -815,12 +1083,16 @@ async def report_fraud(fraud_data: Dict[str, Any]):
             "fraud_attempts": fraud_attempts,
             "last_fraud_detection": datetime.now()
         }
+        evidence_ids = [digest for digest in fraud_data.get('evidence') or [] if evidence_store.exists(digest)]
+        if evidence_ids:
+            update_data["fraud_evidence"] = firestore.ArrayUnion(evidence_ids)
         
         # Si 2 tentatives de fraude, terminer l'examen
         if fraud_attempts >= 2:
             update_data["status"] = "terminated"
             update_data["terminated_at"] = datetime.now()
             update_data["termination_reason"] = "fraud_detected"
+            surveillance_store.close(attempt_id)
             
             # Notifier l'enseignant
             exam_ref = db.collection('exams').document(attempt_data['exam_id'])
@@ -853,6 +1125,258 @@ async def report_fraud(fraud_data: Dict[str, Any]):
             detail=f"Erreur lors du signalement: {str(e)}"
         )
 
+# 7b. Sauvegarde automatique des réponses
+@app.patch("/exam/{exam_id}/attempt/{attempt_id}/answers")
+async def autosave_exam_answers(exam_id: str, attempt_id: str, payload: Dict[str, Any]):
+    """Enregistrer uniquement les réponses modifiées depuis la dernière sauvegarde"""
+    try:
+        answers = payload.get('answers')
+        if not isinstance(answers, dict) or not answers:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="answers doit contenir au moins une réponse"
+            )
+        
+        attempt = await asyncio.to_thread(answer_autosave.attempt, attempt_id)
+        if attempt is None or attempt.get('exam_id') != exam_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Tentative non trouvée"
+            )
+        if attempt.get('status') != 'in_progress':
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="La tentative n'est plus en cours"
+            )
+        # Le statut est en cache: la fin de la fenêtre est vérifiée à chaque sauvegarde
+        window = await asyncio.to_thread(schedule_index.window, 'exam', exam_id)
+        if window is not None and datetime.now(timezone.utc) >= window['end']:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="La période de l'examen est terminée"
+            )
+        
+        pending = answer_autosave.add(attempt_id, answers)
+        return {
+            "success": True,
+            "saved": len(answers),
+            "pending": pending
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la sauvegarde: {str(e)}"
+        )
+
+# 7c. Échantillons de surveillance (chronologie des violations)
+@app.post("/exam/{exam_id}/attempt/{attempt_id}/surveillance")
+async def record_surveillance_samples(exam_id: str, attempt_id: str, payload: Dict[str, Any]):
+    """Enregistrer les contrôles de surveillance (t, faces, position_ok, speech) d'une tentative"""
+    try:
+        try:
+            times, faces, flags = surveillance.parse_samples(payload)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Échantillons invalides: {str(e)}"
+            )
+        
+        attempt = await asyncio.to_thread(answer_autosave.attempt, attempt_id)
+        if attempt is None or attempt.get('exam_id') != exam_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Tentative non trouvée"
+            )
+        if attempt.get('status') != 'in_progress':
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="La tentative n'est plus en cours"
+            )
+        
+        kept = surveillance_store.add(
+            attempt_id, exam_id, times, faces, flags,
+            not_before=to_utc(attempt.get('started_at'))
+        )
+        return {"success": True, "received": len(times), "kept": kept}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de l'enregistrement de la surveillance: {str(e)}"
+        )
+
+@app.get("/exam/{exam_id}/attempt/{attempt_id}/surveillance")
+async def get_surveillance_timeline(exam_id: str, attempt_id: str, resolution: int = surveillance.BIN_SECONDS,
+                                    credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Chronologie des violations d'une tentative, par intervalles de `resolution` secondes"""
+    verify_assessment_owner(credentials.credentials, 'exam', exam_id)
+    if resolution not in surveillance.RESOLUTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"resolution doit être parmi {list(surveillance.RESOLUTIONS)}"
+        )
+    try:
+        attempt = await asyncio.to_thread(answer_autosave.attempt, attempt_id)
+        if attempt is None or attempt.get('exam_id') != exam_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Tentative non trouvée"
+            )
+        timeline = await asyncio.to_thread(surveillance_store.timeline, attempt_id, resolution)
+        return {"exam_id": exam_id, "student_id": attempt.get('student_id'), "status": attempt.get('status'), **timeline}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la récupération de la surveillance: {str(e)}"
+        )
+
+async def read_body_limited(request: Request, max_bytes: int) -> Optional[bytes]:
+    """Corps de la requête, None s'il dépasse max_bytes (sans le lire en entier)"""
+    try:
+        if int(request.headers.get('content-length') or 0) > max_bytes:
+            return None
+    except ValueError:
+        return None
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            return None
+    return bytes(body)
+
+# 7d. Analyse serveur des images de la webcam
+@app.post("/exam/{exam_id}/attempt/{attempt_id}/frames")
+async def analyze_exam_frame(exam_id: str, attempt_id: str, request: Request):
+    """Compter les visages d'une image JPEG de la webcam; les violations répétées sont signalées comme fraude"""
+    if not frame_analysis.available():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Analyse d'image indisponible sur le serveur"
+        )
+    try:
+        attempt = await asyncio.to_thread(answer_autosave.attempt, attempt_id)
+        if attempt is None or attempt.get('exam_id') != exam_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Tentative non trouvée"
+            )
+        if attempt.get('status') != 'in_progress':
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="La tentative n'est plus en cours"
+            )
+        # Limite par tentative, partagée par les workers (frame_checks)
+        if not await asyncio.to_thread(frame_analyzer.admit, attempt_id):
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Trop d'images envoyées",
+                headers={"Retry-After": str(int(frame_analysis.MIN_FRAME_INTERVAL_SECONDS))}
+            )
+        
+        frame = await read_body_limited(request, frame_analysis.MAX_FRAME_BYTES)
+        if not frame:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Image JPEG requise (au plus {frame_analysis.MAX_FRAME_BYTES // 1024} Ko)"
+            )
+        
+        result = await frame_analyzer.analyze(frame)
+        if result is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Analyse d'image saturée, réessayer plus tard",
+                headers={"Retry-After": str(int(frame_analysis.MIN_FRAME_INTERVAL_SECONDS))}
+            )
+        if result["faces"] is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=result["error"])
+        
+        # Violations consécutives: même traitement qu'une détection du navigateur
+        violation, report = await asyncio.to_thread(frame_analyzer.observe, attempt_id, result["faces"])
+        fraud = None
+        if report:
+            stored = await asyncio.to_thread(evidence_store.put_bytes, frame, 'image/jpeg')
+            fraud = await report_fraud({
+                "attempt_id": attempt_id,
+                "detection_result": {"source": "server", "type": violation, "faces": result["faces"]},
+                "evidence": [stored["sha256"]]
+            })
+            if fraud["status"] == "terminated":
+                answer_autosave.close(attempt_id, 'terminated')
+        
+        return {"success": True, **result, "violation": violation, "fraud": fraud}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de l'analyse de l'image: {str(e)}"
+        )
+
+# 7e. Détection de parole sur le flux audio
+@app.post("/exam/{exam_id}/attempt/{attempt_id}/audio")
+async def analyze_exam_audio(exam_id: str, attempt_id: str, request: Request, sample_rate: int = 16000):
+    """Analyser un segment audio (PCM 16 bits mono little-endian); une parole prolongée est signalée comme fraude"""
+    if sample_rate not in voice_activity.SAMPLE_RATES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"sample_rate doit être parmi {list(voice_activity.SAMPLE_RATES)}"
+        )
+    try:
+        attempt = await asyncio.to_thread(answer_autosave.attempt, attempt_id)
+        if attempt is None or attempt.get('exam_id') != exam_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Tentative non trouvée"
+            )
+        if attempt.get('status') != 'in_progress':
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="La tentative n'est plus en cours"
+            )
+        
+        pcm = await read_body_limited(request, voice_activity.MAX_CHUNK_SECONDS * sample_rate * 2)
+        if not pcm or len(pcm) % 2:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Segment PCM 16 bits requis (au plus {voice_activity.MAX_CHUNK_SECONDS} s)"
+            )
+        
+        result = await voice_detector.process(attempt_id, pcm, sample_rate)
+        if result is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Analyse audio saturée, réessayer plus tard",
+                headers={"Retry-After": "1"}
+            )
+        
+        fraud = None
+        if result["report"]:
+            stored = await asyncio.to_thread(
+                evidence_store.put_bytes, voice_activity.to_wav(pcm, sample_rate), 'audio/wav'
+            )
+            fraud = await report_fraud({
+                "attempt_id": attempt_id,
+                "detection_result": {"source": "server", "type": "speech", **result["report"]},
+                "evidence": [stored["sha256"]]
+            })
+            if fraud["status"] == "terminated":
+                answer_autosave.close(attempt_id, 'terminated')
+                voice_detector.forget(attempt_id)
+        
+        return {"success": True, **result, "fraud": fraud}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de l'analyse audio: {str(e)}"
+        )
+
 # 8. Soumettre un examen
 @app.post("/exam/{exam_id}/submit")
 async def submit_exam(exam_id: str, submission: Dict[str, Any]):
@@ -860,19 +1384,62 @@ async def submit_exam(exam_id: str, submission: Dict[str, Any]):
     try:
         attempt_id = submission.get('attempt_id')
         answers = submission.get('answers', {})
+        if not attempt_id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="attempt_id requis"
+            )
         
-        # Mettre à jour la tentative
-        attempt_ref = db.collection('exam_attempts').document(attempt_id)
-        attempt_ref.update({
-            "answers": answers,
-            "completed_at": datetime.now(),
+        # La soumission est acquittée dès qu'elle est journalisée: vérifier la tentative avant
+        attempt = await asyncio.to_thread(answer_autosave.attempt, attempt_id)
+        if attempt is None or attempt.get('exam_id') != exam_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Tentative non trouvée"
+            )
+        if attempt.get('status') == 'completed':
+            # Nouvel essai du client: la soumission est déjà journalisée
+            return {
+                "success": True,
+                "message": "Examen déjà soumis"
+            }
+        if attempt.get('status') != 'in_progress':
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="La tentative n'est plus en cours"
+            )
+        
+        # Les réponses sont déjà enregistrées par l'autosave: celles encore en attente
+        # (avec celles envoyées à la soumission par les anciens clients) sont journalisées
+        # avec le statut, la note est calculée par le flusher du journal
+        if answers:
+            answer_autosave.add(attempt_id, answers)
+        pending_answers = answer_autosave.take(attempt_id)
+        answer_autosave.close(attempt_id)
+        surveillance_store.close(attempt_id)
+        voice_detector.forget(attempt_id)
+        completed_at = datetime.now(timezone.utc)
+        update = {
+            **{autosave.answer_field_path(key): value for key, value in pending_answers.items()},
+            "completed_at": completed_at,
             "status": "completed"
-        })
+        }
+        
+        # Mettre à jour la tentative (journalisée localement, écrite dans Firestore par le flusher),
+        # après les réponses encore en attente dans l'autosave des autres workers
+        await submission_journal.append_async(journal.submission_key("exam", attempt_id), "exam", {
+            "attempt_id": attempt_id,
+            "exam_id": exam_id,
+            "answers": pending_answers,
+            "update": update
+        }, delay=autosave.SUBMIT_SETTLE_SECONDS)
         
         return {
             "success": True,
             "message": "Examen soumis avec succès"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -913,11 +1480,11 @@ async def create_exam(exam_data: ExamCreateComplete):
             "module_name": exam_data.module_name,
             "title": exam_data.title,
             "description": exam_data.description,
-            "date_debut_exame": exam_data.date_debut_exame,
-            "date_fin_exame": exam_data.date_fin_exame,
+            "date_debut_exame": to_utc(exam_data.date_debut_exame),
+            "date_fin_exame": to_utc(exam_data.date_fin_exame),
             "students": exam_data.students,
             "status": "active",
-            "created_at": datetime.now()
+            "created_at": datetime.now(timezone.utc)
         }
         
         # Sauvegarder l'examen
@@ -934,11 +1501,20 @@ async def create_exam(exam_data: ExamCreateComplete):
                 "options": question.options,
                 "correct_answer": question.correctAnswer,
                 "correct_answer": question.correctAnswer,
-                "points": question.points
+                "points": question.points,
+                "accepted_answers": question.accepted_answers,
+                "full_credit_threshold": question.full_credit_threshold,
+                "partial_credit_threshold": question.partial_credit_threshold
             }
             questions_data.append(question_doc)
             db.collection('exam_questions').add(question_doc)
         
+        response_cache.invalidate(f"exam:{exam_id}", f"exam_questions:{exam_id}")
+        answer_keys.invalidate('exam', exam_id)
+        schedule_index.invalidate()
+        if attempt_finalizer:
+            attempt_finalizer.wake()
+        
         return {
             "success": True,
             "exam_id": exam_id,
@@ -955,9 +1531,9 @@ async def create_exam(exam_data: ExamCreateComplete):
         )
 
 @app.get("/exams/{exam_id}")
-async def get_exam(exam_id: str):
+async def get_exam(exam_id: str, request: Request):
     """Récupérer un examen par ID"""
-    try:
+    def build():
         exam_ref = db.collection('exams').document(exam_id)
         exam_doc = exam_ref.get()
         
@@ -982,7 +1558,8 @@ async def get_exam(exam_id: str):
                 "type": question_data.get("type"),
                 "options": question_data.get("options"),
                 "correct_answer": question_data.get("correct_answer"),
-                "points": question_data.get("points")
+                "points": question_data.get("points"),
+                "accepted_answers": question_data.get("accepted_answers", [])
             })
         
         # Trier les questions par numéro
@@ -990,7 +1567,9 @@ async def get_exam(exam_id: str):
         
         exam_data["questions"] = questions
         return exam_data
-        
+    
+    try:
+        return http_cache.cached_response(request, response_cache, f"exam:{exam_id}", build, "exam")
     except HTTPException:
         raise
     except Exception as e:
@@ -999,6 +1578,10 @@ async def get_exam(exam_id: str):
             detail=f"Erreur lors de la récupération de l'examen: {str(e)}"
         )
 
+def created_at_key(item: Dict[str, Any]) -> datetime:
+    """Sort key on created_at, stored as an ISO string before the UTC datetimes"""
+    return to_utc(item.get("created_at")) or datetime.min.replace(tzinfo=timezone.utc)
+
 @app.get("/teacher/{teacher_id}/exams")
 async def get_teacher_exams(teacher_id: str):
     """Récupérer tous les examens d'un professeur"""
@@ -1012,7 +1595,7 @@ async def get_teacher_exams(teacher_id: str):
             exams.append(exam_data)
         
         # Trier par date de création (plus récent d'abord)
-        exams.sort(key=lambda x: x.get("created_at", datetime.min), reverse=True)
+        exams.sort(key=created_at_key, reverse=True)
         
         return {"exams": exams}
         
@@ -1060,11 +1643,11 @@ async def create_quiz(quiz_data: QuizCreateComplete):
             "module_name": quiz_data.module_name,
             "title": quiz_data.title,
             "description": quiz_data.description,
-            "date_debut_quiz": quiz_data.date_debut_quiz,
-            "date_fin_quiz": quiz_data.date_fin_quiz,
+            "date_debut_quiz": to_utc(quiz_data.date_debut_quiz),
+            "date_fin_quiz": to_utc(quiz_data.date_fin_quiz),
             "students": quiz_data.students,
             "status": "active",
-            "created_at": datetime.now().isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
         
         # Sauvegarder le quiz
@@ -1079,10 +1662,19 @@ async def create_quiz(quiz_data: QuizCreateComplete):
                 "type": question.type,
                 "options": question.options,
                 "correct_answer": question.correctAnswer,
-                "points": question.points
+                "points": question.points,
+                "accepted_answers": question.accepted_answers,
+                "full_credit_threshold": question.full_credit_threshold,
+                "partial_credit_threshold": question.partial_credit_threshold
             }
             db.collection('quiz_questions').add(question_doc)
         
+        response_cache.invalidate(f"quiz_questions:{quiz_id}")
+        answer_keys.invalidate('quiz', quiz_id)
+        schedule_index.invalidate()
+        if attempt_finalizer:
+            attempt_finalizer.wake()
+        
         return QuizResponse(
             success=True,
             quiz_id=quiz_id,
@@ -1126,7 +1718,8 @@ async def get_quiz(quiz_id: str):
                 "type": question_data.get("type"),
                 "options": question_data.get("options"),
                 "correct_answer": question_data.get("correct_answer"),
-                "points": question_data.get("points")
+                "points": question_data.get("points"),
+                "accepted_answers": question_data.get("accepted_answers", [])
             })
         
         # Trier les questions par numéro
@@ -1156,7 +1749,7 @@ async def get_teacher_quizzes(teacher_id: str):
             quizzes.append(quiz_data)
         
         # Trier par date de création (plus récent d'abord)
-        quizzes.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+        quizzes.sort(key=created_at_key, reverse=True)
         
         return {"quizzes": quizzes}
         
@@ -1312,9 +1905,9 @@ async def get_teacher_exams(teacher_id: str):
         )
 
 @app.get("/modules")
-async def get_modules():
+async def get_modules(request: Request):
     """Récupérer tous les modules disponibles"""
-    try:
+    def build():
         modules_query = db.collection('modules')
         modules_docs = modules_query.stream()
         
@@ -1338,7 +1931,9 @@ async def get_modules():
             ]
         
         return {"modules": modules}
-        
+    
+    try:
+        return http_cache.cached_response(request, response_cache, "modules", build, "modules")
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -1359,6 +1954,8 @@ async def create_module(module_data: ModuleCreate):
         
         db.collection('modules').document(module_id).set(module_doc)
         
+        response_cache.invalidate("modules")
+        
         return {
             "success": True,
             "module_id": module_id,
@@ -1397,6 +1994,11 @@ async def delete_exam(exam_id: str):
         
         for doc in questions_docs:
             doc.reference.delete()
+        db.collection(exam_stats.STATS_COLLECTION).document(exam_id).delete()
+        
+        response_cache.invalidate(f"exam:{exam_id}", f"exam_questions:{exam_id}")
+        answer_keys.invalidate('exam', exam_id)
+        schedule_index.invalidate()
         
         return {"success": True, "message": "Examen supprimé avec succès"}
         
@@ -1431,6 +2033,10 @@ async def delete_quiz(quiz_id: str):
         for doc in questions_docs:
             doc.reference.delete()
         
+        response_cache.invalidate(f"quiz_questions:{quiz_id}")
+        answer_keys.invalidate('quiz', quiz_id)
+        schedule_index.invalidate()
+        
         return {"success": True, "message": "Quiz supprimé avec succès"}
         
     except HTTPException:
@@ -1442,19 +2048,170 @@ async def delete_quiz(quiz_id: str):
         )
 
 # =============================================================================
-# ENDPOINTS POUR STATISTIQUES
+# ENDPOINTS DE CORRECTION
 # =============================================================================
 
-@app.get("/teacher/{teacher_id}/dashboard")
-async def get_teacher_dashboard(teacher_id: str):
-    """Récupérer les statistiques du tableau de bord professeur"""
+# kind -> (collection, libellé)
+ASSESSMENT_COLLECTIONS = {"exam": ("exams", "Examen"), "quiz": ("quizzes", "Quiz")}
+ANSWER_KEY_FIELDS = ('correct_answer', 'points', 'accepted_answers', 'full_credit_threshold', 'partial_credit_threshold')
+
+def verify_assessment_owner(token: str, kind: str, assessment_id: str) -> Dict[str, Any]:
+    """Admin, ou enseignant propriétaire de l'examen / du quiz"""
+    session_data = verify_token(token)
+    if session_data['role'] not in ('admin', 'teacher'):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    
+    collection, label = ASSESSMENT_COLLECTIONS[kind]
+    assessment_doc = db.collection(collection).document(assessment_id).get()
+    if not assessment_doc.exists:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"{label} non trouvé")
+    assessment = assessment_doc.to_dict()
+    if session_data['role'] == 'teacher' and assessment.get('id_teacher') != session_data['user_id']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    return assessment
+
+def regrade(kind: str, assessment_id: str) -> Dict[str, Any]:
+    key = answer_keys.get(kind, assessment_id)
+    if key is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Aucune question à corriger")
+    if kind != 'exam':
+        return grading.grade_assessment(db, key, kind, assessment_id)
+    
+    # Les statistiques de l'examen sont recalculées avec les nouvelles notes
+    def rebuild_stats(rows, results):
+        exam_results.rebuild(assessment_id, {
+            attempt_id: {**row, **result} for (attempt_id, row), result in zip(rows.items(), results)
+        })
+    return grading.grade_assessment(
+        db, key, kind, assessment_id,
+        extra_fields=['started_at', 'completed_at', 'fraud_attempts'], observe=rebuild_stats
+    )
+
+def correct_answer_key(kind: str, assessment_id: str, corrections: List[Dict[str, Any]]) -> int:
+    """Corriger le corrigé de questions (ANSWER_KEY_FIELDS), puis le recharger"""
+    questions_collection, _, id_field, _ = grading.GRADED[kind]
+    by_number = {
+        doc.to_dict().get('question_number'): doc.reference
+        for doc in db.collection(questions_collection).where(id_field, '==', assessment_id).stream()
+    }
+    batch = db.batch()
+    for correction in corrections:
+        ref = by_number.get(correction.get('question_number'))
+        if ref is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Question {correction.get('question_number')} non trouvée"
+            )
+        update = {field: correction[field] for field in ANSWER_KEY_FIELDS if field in correction}
+        if not update:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Un des champs {', '.join(ANSWER_KEY_FIELDS)} requis"
+            )
+        batch.update(ref, update)
+    batch.commit()
+    
+    answer_keys.invalidate(kind, assessment_id)
+    if kind == 'exam':
+        response_cache.invalidate(f"exam:{assessment_id}", f"exam_questions:{assessment_id}")
+    else:
+        response_cache.invalidate(f"quiz_questions:{assessment_id}")
+    return len(corrections)
+
+async def grade_endpoint(kind: str, assessment_id: str, credentials: HTTPAuthorizationCredentials, corrections=None):
+    verify_assessment_owner(credentials.credentials, kind, assessment_id)
     try:
-        # Compter les examens
-        exams_query = db.collection('exams').where('id_teacher', '==', teacher_id)
-        exams_count = len(list(exams_query.stream()))
-        
-        # Compter les quiz
-        quizzes_query = db.collection('quizzes').where('id_teacher', '==', teacher_id)
+        corrected = 0
+        if corrections is not None:
+            if not isinstance(corrections, list) or not corrections:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="corrections requises")
+            corrected = await asyncio.to_thread(correct_answer_key, kind, assessment_id, corrections)
+        result = await asyncio.to_thread(regrade, kind, assessment_id)
+        return {"success": True, "corrected_questions": corrected, **result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la correction: {str(e)}"
+        )
+
+@app.post("/exams/{exam_id}/grade")
+async def grade_exam(exam_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Noter toutes les tentatives terminées d'un examen"""
+    return await grade_endpoint('exam', exam_id, credentials)
+
+@app.post("/quizzes/{quiz_id}/grade")
+async def grade_quiz(quiz_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Noter toutes les soumissions d'un quiz"""
+    return await grade_endpoint('quiz', quiz_id, credentials)
+
+@app.patch("/exams/{exam_id}/answer-key")
+async def correct_exam_answer_key(exam_id: str, payload: Dict[str, Any], credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Corriger le corrigé ({"corrections": [{"question_number", "correct_answer", "accepted_answers", ...}]}) et renoter"""
+    return await grade_endpoint('exam', exam_id, credentials, payload.get('corrections'))
+
+@app.patch("/quizzes/{quiz_id}/answer-key")
+async def correct_quiz_answer_key(quiz_id: str, payload: Dict[str, Any], credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Corriger le corrigé d'un quiz et renoter"""
+    return await grade_endpoint('quiz', quiz_id, credentials, payload.get('corrections'))
+
+@app.post("/exams/{exam_id}/collusion")
+async def analyze_exam_collusion(exam_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Détecter les copies entre étudiants d'un examen (fait aussi automatiquement à la clôture)"""
+    verify_assessment_owner(credentials.credentials, 'exam', exam_id)
+    try:
+        return await asyncio.to_thread(collusion_analyzer.analyze, exam_id)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de l'analyse des copies: {str(e)}"
+        )
+
+# =============================================================================
+# ENDPOINTS POUR STATISTIQUES
+# =============================================================================
+
+@app.get("/exams/{exam_id}/stats")
+async def get_exam_stats(exam_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Distribution des notes, durées et fraudes d'un examen (percentiles et histogrammes)"""
+    verify_assessment_owner(credentials.credentials, 'exam', exam_id)
+    try:
+        stats = await asyncio.to_thread(exam_results.exam, exam_id)
+        if stats is None:
+            return {"exam_id": exam_id, "count": 0, "metrics": {}}
+        return stats
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la récupération des statistiques: {str(e)}"
+        )
+
+@app.get("/modules/{module_name}/stats")
+async def get_module_stats(module_name: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Statistiques des examens d'un module (ceux de l'enseignant, ou tous pour l'admin)"""
+    session_data = verify_token(credentials.credentials)
+    if session_data['role'] not in ('admin', 'teacher'):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    try:
+        teacher_id = session_data['user_id'] if session_data['role'] == 'teacher' else None
+        return await asyncio.to_thread(exam_results.module, module_name, teacher_id)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la récupération des statistiques: {str(e)}"
+        )
+
+@app.get("/teacher/{teacher_id}/dashboard")
+async def get_teacher_dashboard(teacher_id: str):
+    """Récupérer les statistiques du tableau de bord professeur"""
+    try:
+        # Compter les examens
+        exams_query = db.collection('exams').where('id_teacher', '==', teacher_id)
+        exams_count = len(list(exams_query.stream()))
+        
+        # Compter les quiz
+        quizzes_query = db.collection('quizzes').where('id_teacher', '==', teacher_id)
         quizzes_count = len(list(quizzes_query.stream()))
         
         # Récupérer les examens et quiz récents
@@ -1552,69 +2309,109 @@ def verify_token(token: str, required_role: Optional[str] = None):
     
     return session_data
 
-# Sample questions data
-QUESTIONS_DATA = {
-    "Informatique": [
-        {
-            "question": "Quel est le principe fondamental de la programmation orientée objet ?",
-            "options": ["Encapsulation", "Compilation", "Débogage", "Documentation"],
-            "correct": 0
-        },
-        {
-            "question": "Quelle structure de données utilise le principe LIFO ?",
-            "options": ["Queue", "Stack", "Array", "Tree"],
-            "correct": 1
-        },
-        {
-            "question": "Que signifie 'Big O' en algorithmique ?",
-            "options": ["Taille mémoire", "Complexité temporelle", "Nombre de bugs", "Version du code"],
-            "correct": 1
-        },
-        {
-            "question": "Quel protocole est utilisé pour les pages web sécurisées ?",
-            "options": ["HTTP", "HTTPS", "FTP", "SMTP"],
-            "correct": 1
-        },
-        {
-            "question": "En base de données, que signifie CRUD ?",
-            "options": ["Create Read Update Delete", "Copy Run Update Deploy", "Code Review Unit Debug", "Cache Runtime User Data"],
-            "correct": 0
-        }
-    ],
-    "Génie Civil": [
-        {
-            "question": "Quel est le module d'élasticité de l'acier ?",
-            "options": ["200 GPa", "300 GPa", "100 GPa", "150 GPa"],
-            "correct": 0
-        },
-        {
-            "question": "Quelle est l'unité de la contrainte ?",
-            "options": ["N", "Pa", "m", "kg"],
-            "correct": 1
-        }
-    ],
-    "Électromécanique": [
-        {
-            "question": "Quelle est l'unité de la puissance électrique ?",
-            "options": ["Volt", "Ampère", "Watt", "Ohm"],
-            "correct": 2
-        }
-    ],
-    "Gestion": [
-        {
-            "question": "Que signifie ROI en gestion ?",
-            "options": ["Return on Investment", "Rate of Interest", "Risk of Investment", "Revenue of Industry"],
-            "correct": 0
-        }
-    ],
-    "Biologie": [
-        {
-            "question": "Combien de chromosomes a l'être humain ?",
-            "options": ["44", "46", "48", "50"],
-            "correct": 1
-        }
-    ]
-}
+# Student profiles are joined onto listings (proofs, reports...), cache them in-process
+STUDENT_CACHE_TTL_SECONDS = 300
+GET_ALL_CHUNK_SIZE = 100
+_student_cache: Dict[str, Dict[str, Any]] = {}
+
+def get_students_by_ids(student_ids, use_cache: bool = True) -> Dict[str, Dict[str, Any]]:
+    """Fetch students by ID with chunked get_all calls, served from the cache when fresh"""
+    now = time.time()
+    students = {}
+    missing = []
+
+    for student_id in set(student_ids):
+        cached = _student_cache.get(student_id) if use_cache else None
+        if cached and now - cached['cached_at'] < STUDENT_CACHE_TTL_SECONDS:
+            students[student_id] = cached['data']
+        else:
+            missing.append(student_id)
+
+    for i in range(0, len(missing), GET_ALL_CHUNK_SIZE):
+        refs = [db.collection('students').document(student_id) for student_id in missing[i:i + GET_ALL_CHUNK_SIZE]]
+        for doc in db.get_all(refs):
+            if not doc.exists:
+                continue
+            student_data = doc.to_dict()
+            student_data.pop('password', None)
+            students[doc.id] = student_data
+            _student_cache[doc.id] = {'data': student_data, 'cached_at': now}
+
+    return students
+
+def invalidate_student_cache(student_id: str):
+    """Drop a student from the profile cache after a write"""
+    _student_cache.pop(student_id, None)
+
+# Summary fields returned by listings, raw_data is only sent on ?include=raw
+PROOF_SUMMARY_FIELDS = [
+    "id_student",
+    "accuracy",
+    "precision",
+    "type_cognitive",
+    "temp_moyen_question",
+    "niveau_focus",
+    "violation",
+    "score_consistante",
+    "patern_dominante",
+    "score_integrité",
+    "statistics",
+    "scoring_version",
+    "identity_check",
+    "created_at"
+]
+
+def select_proof_fields(query, include: Optional[str] = None):
+    """Project a proof_identity query to its summary fields unless raw_data is requested"""
+    if include == 'raw':
+        return query
+    # Field paths with non-ASCII characters (score_integrité) must be backquoted
+    return query.select([FieldPath(field).to_api_repr() for field in PROOF_SUMMARY_FIELDS])
+
+def attach_raw_data(proofs: Dict[str, Dict[str, Any]]):
+    """Load raw_data from the side store into {proof_id: proof_data}"""
+    # Proofs written before the side store still embed raw_data
+    missing = [proof_id for proof_id, proof_data in proofs.items() if 'raw_data' not in proof_data]
+    for proof_id, raw_data in raw_data_store.get_many(missing).items():
+        proofs[proof_id]['raw_data'] = raw_data
+
+def get_student_proof(student_id: str, include: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Get the proof identity of a student, with raw_data only on include=raw"""
+    proof_query = select_proof_fields(
+        db.collection('proof_identity').where('id_student', '==', student_id),
+        include
+    )
+    proof_docs = list(proof_query.limit(1).stream())
+    if not proof_docs:
+        return None
+    
+    proof_data = proof_docs[0].to_dict()
+    proof_data['document_id'] = proof_docs[0].id
+    if include == 'raw':
+        attach_raw_data({proof_docs[0].id: proof_data})
+    return proof_data
+
+def join_student_info(rows: List[Dict[str, Any]], key: str, field: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Add student_name/student_field to rows whose `key` is a student ID, keeping only `field` when given"""
+    students = get_students_by_ids(row[key] for row in rows if row.get(key))
+    joined = []
+    for row in rows:
+        student_data = students.get(row.get(key))
+        if student_data:
+            row['student_name'] = student_data.get('name', 'Unknown')
+            row['student_field'] = student_data.get('field', 'Unknown')
+        if field and row.get('student_field') != field:
+            continue
+        joined.append(row)
+    return joined
+
+def export_response(rows, export_format: str, columns: List[str], filename: str) -> StreamingResponse:
+    """Stream rows as NDJSON or CSV"""
+    return StreamingResponse(
+        exports.encode(exports.prime(rows), export_format, columns),
+        media_type=exports.EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'}
+    )
 
 # =============================================================================
 # AUTHENTICATION ENDPOINTS
@@ -1781,7 +2578,7 @@ async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
 # =============================================================================
 
 @app.get("/students")
-async def get_students(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_students(include: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get all students (Admin/Teacher only)"""
     session_data = verify_token(credentials.credentials)
     
@@ -1800,18 +2597,12 @@ async def get_students(credentials: HTTPAuthorizationCredentials = Depends(secur
             student_data['document_id'] = doc.id
             
             # Get proof identity data if exists
-            proof_ref = db.collection('proof_identity').where('id_student', '==', doc.id).limit(1)
-            proof_docs = list(proof_ref.stream())
-            
-            if proof_docs:
-                proof_data = proof_docs[0].to_dict()
-                student_data['proof_identity'] = proof_data
-            else:
-                student_data['proof_identity'] = None
+            student_data['proof_identity'] = get_student_proof(doc.id, include)
             
             students.append(student_data)
         
-        return {"students": students}
+        # Returned directly to skip jsonable_encoder on the full listing
+        return FastJSONResponse({"students": students})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1841,7 +2632,7 @@ async def create_student(student: StudentCreate, credentials: HTTPAuthorizationC
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/student/{student_id}")
-async def get_student(student_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_student(student_id: str, include: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get student by ID"""
     session_data = verify_token(credentials.credentials)
     
@@ -1863,11 +2654,9 @@ async def get_student(student_id: str, credentials: HTTPAuthorizationCredentials
         del student_data['password']  # Remove password from response
         
         # Get proof identity data
-        proof_ref = db.collection('proof_identity').where('id_student', '==', student_id).limit(1)
-        proof_docs = list(proof_ref.stream())
-        
-        if proof_docs:
-            student_data['proof_identity'] = proof_docs[0].to_dict()
+        proof_data = get_student_proof(student_id, include)
+        if proof_data:
+            student_data['proof_identity'] = proof_data
         
         return student_data
     except Exception as e:
@@ -1886,6 +2675,7 @@ async def update_student(student_id: str, updates: Dict[str, Any], credentials:
         updates['updated_at'] = datetime.now()
         
         db.collection('students').document(student_id).update(updates)
+        invalidate_student_cache(student_id)
         return {"message": "Étudiant mis à jour avec succès"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1901,10 +2691,12 @@ async def delete_student(student_id: str, credentials: HTTPAuthorizationCredenti
         proof_docs = proof_ref.stream()
         
         for doc in proof_docs:
+            raw_data_store.delete(doc.id)
             doc.reference.delete()
         
         # Delete student
         db.collection('students').document(student_id).delete()
+        invalidate_student_cache(student_id)
         
         return {"message": "Étudiant supprimé avec succès"}
     except Exception as e:
@@ -1956,14 +2748,18 @@ async def create_teacher(teacher: TeacherCreate, credentials: HTTPAuthorizationC
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/teacher/{teacher_id}")
-def get_teacher_by_id(teacher_id: str):
-    teacher_ref = db.collection("teachers").document(teacher_id)
-    teacher_doc = teacher_ref.get()
+def get_teacher_by_id(teacher_id: str, request: Request):
+    def build():
+        teacher_ref = db.collection("teachers").document(teacher_id)
+        teacher_doc = teacher_ref.get()
+
+        if not teacher_doc.exists:
+            raise HTTPException(status_code=404, detail="Teacher not found")
+
+        return teacher_doc.to_dict()
 
-    if not teacher_doc.exists:
-        raise HTTPException(status_code=404, detail="Teacher not found")
+    return http_cache.cached_response(request, response_cache, f"teacher:{teacher_id}", build, "teacher")
 
-    return teacher_doc.to_dict()
 @app.get("/teacher/{teacher_id}/assignments")
 async def get_teacher_assignments(teacher_id: str):
     """Récupérer tous les examens et quiz d'un professeur"""
@@ -2024,15 +2820,12 @@ async def get_teacher_assignments(teacher_id: str):
         # Sort by created_at (all datetime objects are now timezone-aware)
         assignments.sort(key=lambda x: x["created_at"], reverse=True)
         
-        # Convert datetime objects to ISO format strings for JSON response
-        for item in assignments:
-            item["created_at"] = item["created_at"].isoformat()
-        
-        return {
+        # orjson writes the datetimes as ISO strings
+        return FastJSONResponse({
             "teacher_id": teacher_id,
             "assignments": assignments,
             "count": len(assignments)
-        }
+        })
         
     except Exception as e:
         print(f"Error in get_teacher_assignments: {str(e)}")  # For debugging
@@ -2304,11 +3097,44 @@ async def get_fraude_reports(credentials: HTTPAuthorizationCredentials = Depends
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/fraude/export")
+def export_fraude_reports(
+    format: str = "ndjson",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    ref_type: Optional[str] = None,
+    field: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Stream fraud reports as NDJSON or CSV (field only matches reports on a student)"""
+    session_data = verify_token(credentials.credentials)
+    
+    if session_data['role'] not in ['admin', 'teacher']:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Accès non autorisé"
+        )
+    
+    if format not in exports.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Format d'export invalide (ndjson ou csv)")
+    
+    try:
+        query = exports.build_query(db.collection('fraude'), 'date_fraude', start, end, {'ref_type': ref_type})
+        transform = (lambda rows: join_student_info(rows, 'id_ref', field)) if field else None
+        rows = exports.stream_rows(exports.iter_pages(query), transform)
+        return export_response(rows, format, exports.FRAUDE_COLUMNS, "fraudes")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/fraude")
 async def create_fraude_report(fraude: FraudeReport, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Create fraud report"""
     verify_token(credentials.credentials)
     
+    missing = [digest for digest in fraude.evidence if not evidence_store.exists(digest)]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Preuves inconnues: {', '.join(missing)}")
+    
     try:
         fraude_id = generate_id("fraude")
         fraude_data = {
@@ -2319,19 +3145,181 @@ async def create_fraude_report(fraude: FraudeReport, credentials: HTTPAuthorizat
             "type_fraude": fraude.type_fraude,
             "date_fraude": fraude.date_fraude or datetime.now()
         }
+        if fraude.evidence:
+            fraude_data["evidence"] = list(dict.fromkeys(fraude.evidence))
         
         db.collection('fraude').document(fraude_id).set(fraude_data)
         return {"message": "Rapport de fraude créé avec succès", "fraude": fraude_data}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def receive_evidence(request: Request, max_bytes: Optional[int] = None,
+                           charge: Optional[Callable[[int], None]] = None) -> List[Dict[str, Any]]:
+    """Store the files of a streamed multipart upload, chunk by chunk (at most max_bytes of body)
+    
+    charge(size) is called with the total size of the stored files, also when a
+    later part fails: the files of the earlier parts are already on disk.
+    """
+    too_large = HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Quota de preuves dépassé")
+    try:
+        if max_bytes is not None and int(request.headers.get('content-length') or 0) > max_bytes:
+            raise too_large
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Content-Length invalide")
+    try:
+        upload = evidence_store.upload(request.headers.get('content-type', ''))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    received = 0
+    try:
+        try:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if max_bytes is not None and received > max_bytes:
+                    raise too_large
+                await asyncio.to_thread(upload.write, chunk)
+            files = await asyncio.to_thread(upload.finish)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        except BaseException:
+            upload.abort()
+            raise
+    finally:
+        if charge is not None and upload.files:
+            await asyncio.to_thread(charge, sum(file["size"] for file in upload.files))
+    if not files:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Aucun fichier reçu")
+    return files
+
+@app.post("/evidence")
+async def upload_evidence(request: Request, attempt_id: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Upload evidence files (multipart/form-data), returns their SHA-256 to reference in reports
+    
+    Admin/Teacher, or a student for their own exam attempt in progress, within
+    evidence.MAX_ATTEMPT_EVIDENCE_BYTES per attempt.
+    """
+    session_data = verify_token(credentials.credentials)
+    if session_data['role'] in ['admin', 'teacher']:
+        attempt_ref = None
+    elif session_data['role'] == 'student' and attempt_id:
+        attempt_ref = db.collection('exam_attempts').document(attempt_id)
+    else:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    
+    try:
+        max_bytes, charge = None, None
+        if attempt_ref is not None:
+            attempt_doc = await asyncio.to_thread(attempt_ref.get)
+            attempt = attempt_doc.to_dict() if attempt_doc.exists else None
+            if attempt is None or attempt.get('student_id') != session_data['user_id']:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+            if attempt.get('status') != 'in_progress':
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="La tentative n'est plus en cours")
+            max_bytes = evidence.MAX_ATTEMPT_EVIDENCE_BYTES - attempt.get('evidence_bytes', 0)
+            if max_bytes <= 0:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Quota de preuves dépassé")
+            
+            # Concurrent uploads may each pass the check once, the counter still catches up
+            def charge(size: int):
+                attempt_ref.update({"evidence_bytes": firestore.Increment(size)})
+        
+        files = await receive_evidence(request, max_bytes, charge)
+        return {"evidence": files}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de l'enregistrement des preuves: {str(e)}"
+        )
+
+@app.post("/fraude/{fraude_id}/evidence")
+async def add_fraude_evidence(fraude_id: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Upload evidence files and link them to a fraud report (Admin/Teacher only)"""
+    session_data = verify_token(credentials.credentials)
+    if session_data['role'] not in ['admin', 'teacher']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    
+    try:
+        fraude_ref = db.collection('fraude').document(fraude_id)
+        if not fraude_ref.get().exists:
+            raise HTTPException(status_code=404, detail="Rapport de fraude non trouvé")
+        files = await receive_evidence(request)
+        fraude_ref.update({"evidence": firestore.ArrayUnion([file["sha256"] for file in files])})
+        return {"fraude_id": fraude_id, "evidence": files}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de l'enregistrement des preuves: {str(e)}"
+        )
+
+@app.get("/evidence/{digest}")
+async def get_evidence(digest: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Evidence file by SHA-256, with Range support for audio/video seeking (Admin/Teacher only)"""
+    session_data = verify_token(credentials.credentials)
+    if session_data['role'] not in ['admin', 'teacher']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    
+    info = evidence_store.info(digest)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Preuve non trouvée")
+    
+    # Content-addressed: the bytes behind a digest never change
+    headers = {
+        "ETag": f'"{digest}"',
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if request.headers.get('if-none-match') == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    
+    size = info["size"]
+    try:
+        byte_range = evidence.parse_range(request.headers.get('range'), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    start, end = byte_range or (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        evidence_store.read(digest, start, end),
+        status_code=206 if byte_range else 200,
+        media_type=info["content_type"],
+        headers=headers
+    )
+
+@app.get("/evidence/{digest}/thumbnail")
+async def get_evidence_thumbnail(digest: str, size: int = 256, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """JPEG thumbnail of an image evidence, generated on first request (Admin/Teacher only)"""
+    session_data = verify_token(credentials.credentials)
+    if session_data['role'] not in ['admin', 'teacher']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    if size not in evidence.THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"size doit être parmi {list(evidence.THUMBNAIL_SIZES)}")
+    
+    try:
+        path = await asyncio.to_thread(evidence_store.thumbnail, digest, size)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if path is None:
+        raise HTTPException(status_code=404, detail="Miniature indisponible")
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
 # =============================================================================
 # PROOF IDENTITY ENDPOINTS
 # =============================================================================
 
 @app.get("/proof-identity")
-async def get_proof_identities(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get all proof identities"""
+async def get_proof_identities(
+    limit: int = 50,
+    start_after: Optional[str] = None,
+    include: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Get proof identities, paginated by document ID"""
     session_data = verify_token(credentials.credentials)
     
     if session_data['role'] not in ['admin', 'teacher']:
@@ -2341,30 +3329,68 @@ async def get_proof_identities(credentials: HTTPAuthorizationCredentials = Depen
         )
     
     try:
-        proofs = []
-        proofs_ref = db.collection('proof_identity').stream()
+        limit = max(1, min(limit, 500))
+        proofs_query = db.collection('proof_identity').order_by(FieldPath.document_id())
+        
+        # Project away raw_data so it never leaves Firestore unless asked for
+        proofs_query = select_proof_fields(proofs_query, include)
+        if start_after:
+            proofs_query = proofs_query.start_after({FieldPath.document_id(): start_after})
         
-        for doc in proofs_ref:
+        proof_docs = list(proofs_query.limit(limit).stream())
+        
+        proofs = []
+        for doc in proof_docs:
             proof_data = doc.to_dict()
             proof_data['document_id'] = doc.id
-            
-            # Get student info
-            if 'id_student' in proof_data:
-                student_ref = db.collection('students').document(proof_data['id_student'])
-                student_doc = student_ref.get()
-                if student_doc.exists:
-                    student_data = student_doc.to_dict()
-                    proof_data['student_name'] = student_data.get('name', 'Unknown')
-                    proof_data['student_field'] = student_data.get('field', 'Unknown')
-            
             proofs.append(proof_data)
         
-        return {"proof_identities": proofs}
+        if include == 'raw':
+            attach_raw_data({proof['document_id']: proof for proof in proofs})
+        
+        # Join student info in memory from one batched read
+        proofs = join_student_info(proofs, 'id_student')
+        
+        return FastJSONResponse({
+            "proof_identities": proofs,
+            "count": len(proofs),
+            "next_cursor": proof_docs[-1].id if len(proof_docs) == limit else None
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/proof-identity/export")
+def export_proof_identities(
+    format: str = "ndjson",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    field: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Stream proof identities (summary fields and student info) as NDJSON or CSV"""
+    session_data = verify_token(credentials.credentials)
+    
+    if session_data['role'] not in ['admin', 'teacher']:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Accès non autorisé"
+        )
+    
+    if format not in exports.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Format d'export invalide (ndjson ou csv)")
+    
+    try:
+        query = exports.build_query(select_proof_fields(db.collection('proof_identity')), 'created_at', start, end)
+        rows = exports.stream_rows(
+            exports.iter_pages(query),
+            lambda rows: join_student_info(rows, 'id_student', field)
+        )
+        return export_response(rows, format, exports.PROOF_COLUMNS, "proof_identities")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/proof-identity/student/{student_id}")
-async def get_student_proof_identity(student_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_student_proof_identity(student_id: str, include: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get proof identity for specific student"""
     session_data = verify_token(credentials.credentials)
     
@@ -2376,16 +3402,44 @@ async def get_student_proof_identity(student_id: str, credentials: HTTPAuthoriza
         )
     
     try:
-        proof_ref = db.collection('proof_identity').where('id_student', '==', student_id).limit(1)
-        proof_docs = list(proof_ref.stream())
+        proof_data = get_student_proof(student_id, include)
         
-        if not proof_docs:
+        if not proof_data:
             raise HTTPException(status_code=404, detail="Preuve d'identité non trouvée")
         
-        proof_data = proof_docs[0].to_dict()
-        proof_data['document_id'] = proof_docs[0].id
-        
         return proof_data
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/proof-identity/{proof_id}/raw")
+async def get_proof_raw_data(proof_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get the raw test data behind a proof identity"""
+    session_data = verify_token(credentials.credentials)
+    
+    try:
+        proof_doc = db.collection('proof_identity').document(proof_id).get()
+        
+        if not proof_doc.exists:
+            raise HTTPException(status_code=404, detail="Preuve d'identité non trouvée")
+        
+        proof_data = proof_doc.to_dict()
+        
+        # Students can only access their own data
+        if session_data['role'] == 'student' and session_data['user_id'] != proof_data.get('id_student'):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Accès non autorisé"
+            )
+        
+        raw_data = proof_data.get('raw_data') or raw_data_store.get(proof_id)
+        if raw_data is None:
+            raise HTTPException(status_code=404, detail="Données brutes non trouvées")
+        
+        return {"proof_id": proof_id, "raw_data": raw_data}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2411,61 +3465,197 @@ async def create_proof_identity(proof: ProofIdentityData, credentials: HTTPAutho
         }
         
         db.collection('proof_identity').document(proof_id).set(proof_data)
+        await asyncio.to_thread(identity_profiles.add, proof.id_student, proof_data)
         return {"message": "Preuve d'identité créée avec succès", "proof": proof_data}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/identity/verify")
+async def verify_identity(payload: Dict[str, Any], credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Is a session profile ({"student_id", "profile": {accuracy, niveau_focus, ...}}) consistent
+    with the student's enrolled cognitive profile? (Admin/Teacher only)"""
+    session_data = verify_token(credentials.credentials)
+    if session_data['role'] not in ['admin', 'teacher']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    
+    student_id = payload.get('student_id')
+    profile = payload.get('profile')
+    if not student_id or not isinstance(profile, dict):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="student_id et profile requis")
+    try:
+        result = await asyncio.to_thread(identity_profiles.verify, student_id, profile)
+        if result is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Aucune preuve d'identité pour cet étudiant")
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la vérification d'identité: {str(e)}"
+        )
+
+@app.get("/identity/similar/{student_id}")
+async def get_similar_students(student_id: str, k: int = 10, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Students whose cognitive profiles are the closest to this one (Admin/Teacher only)"""
+    session_data = verify_token(credentials.credentials)
+    if session_data['role'] not in ['admin', 'teacher']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    try:
+        similar = await asyncio.to_thread(identity_profiles.similar, student_id, min(max(k, 1), 100))
+        if similar is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Aucune preuve d'identité pour cet étudiant")
+        return {"student_id": student_id, "similar": similar, "index": identity_profiles.stats()}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la recherche de profils similaires: {str(e)}"
+        )
+
+@app.post("/keystrokes/{session_id}")
+async def ingest_keystrokes(session_id: str, request: Request, seq: Optional[int] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Batch of key events of the writing step: binary records (application/octet-stream)
+    or JSON arrays {"t", "key", "down"}. Only the timing features are kept.
+    `seq` numbers the batches of a session, so that a retried batch is counted once."""
+    token = credentials.credentials
+    student_id = keystroke_sessions.owner(session_id, token)
+    if student_id is None:
+        session_data = verify_token(token, 'student')
+        student_id = session_data['user_id']
+        keystroke_sessions.verified(session_id, student_id, token)
+    
+    try:
+        binary = request.headers.get('content-type', '').startswith('application/octet-stream')
+        body = await read_body_limited(request, keystrokes.MAX_BATCH_BYTES if binary else keystrokes.MAX_JSON_BATCH_BYTES)
+        if body is None:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Au plus {keystrokes.MAX_BATCH_EVENTS} événements par lot"
+            )
+        if binary:
+            events = keystrokes.decode_events(body)
+        else:
+            events = keystrokes.events_from_arrays(json.loads(body or b'{}'))
+        session, applied = await asyncio.to_thread(keystroke_sessions.ingest, session_id, student_id, events, seq)
+        return {
+            "success": True,
+            "received": len(events),
+            "duplicate": not applied,
+            "events": session.events,
+            "keystrokes": session.profile.keystrokes
+        }
+    except HTTPException:
+        raise
+    except PermissionError:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    except (ValueError, TypeError, AttributeError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Événements invalides: {str(e)}")
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de l'enregistrement des frappes: {str(e)}"
+        )
+
+@app.post("/keystrokes/{session_id}/finish")
+async def finish_keystrokes(session_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Close a writing session and merge it into the student's keystroke signature"""
+    session_data = verify_token(credentials.credentials, 'student')
+    
+    try:
+        signature = await asyncio.to_thread(keystroke_sessions.finish, session_id, session_data['user_id'])
+        if signature is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session de frappe non trouvée")
+        return {"success": True, "signature": signature}
+    except HTTPException:
+        raise
+    except PermissionError:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de l'enregistrement de la signature de frappe: {str(e)}"
+        )
+
+@app.get("/proof-identity/student/{student_id}/keystrokes")
+async def get_keystroke_signature(student_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Typing-rhythm signature of a student (dwell/flight percentiles, frequent digraphs)"""
+    session_data = verify_token(credentials.credentials)
+    
+    # Students can only access their own data
+    if session_data['role'] == 'student' and session_data['user_id'] != student_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accès non autorisé")
+    
+    try:
+        signature = keystroke_sessions.signature(student_id)
+        if signature is None:
+            raise HTTPException(status_code=404, detail="Signature de frappe non trouvée")
+        return signature
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # =============================================================================
 # COGNITIVE TEST ENDPOINTS
 # =============================================================================
 
 @app.get("/questions/{field}")
-async def get_questions(field: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get questions for specific field"""
-    verify_token(credentials.credentials, 'student')
+async def get_questions(
+    field: str,
+    request: Request,
+    count: Optional[int] = None,
+    difficulty: Optional[str] = None,
+    tag: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Get this student's questions for a field (sampled and shuffled per session)"""
+    session_data = verify_token(credentials.credentials, 'student')
+    bank = questions_bank
     
-    if field not in QUESTIONS_DATA:
+    if not bank.has_field(field):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Domaine non trouvé"
         )
     
-    return {"questions": QUESTIONS_DATA[field]}
+    # Same student and session always get the same questions, nothing is stored
+    session_id = hashlib.sha256(credentials.credentials.encode()).hexdigest()
+    seed = bank.seed(field, session_data['user_id'], session_id, count, difficulty, tag)
+    headers = {
+        "ETag": f'"{seed}"',
+        "Cache-Control": http_cache.CACHE_POLICIES["questions"]
+    }
+    if http_cache.etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    sampled = bank.sample(bank.candidates(field, difficulty, tag), seed, count)
+    return Response(content=bank.render(sampled), media_type="application/json", headers=headers)
+
+@app.post("/questions/reload")
+async def reload_questions(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Reload the question bank from its source (Admin only)"""
+    verify_token(credentials.credentials, 'admin')
+    global questions_bank
+    
+    try:
+        questions_bank = question_bank.load_bank(db)
+        return {
+            "message": "Banque de questions rechargée",
+            "version": questions_bank.version,
+            "questions": len(questions_bank.questions)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 def determine_cognitive_type(avg_response_time: float, accuracy: float, focus: float) -> str:
     """Determine cognitive type based on performance metrics"""
-    if accuracy >= 80 and avg_response_time <= 3000 and focus >= 0.7:
-        return "Analytique"
-    elif accuracy >= 70 and avg_response_time <= 4000:
-        return "Auditif"
-    elif accuracy >= 60 and avg_response_time > 4000:
-        return "Kinesthésique"
-    elif avg_response_time <= 2000:
-        return "Visuel"
-    elif focus < 0.3:
-        return "Auditif"
-    else:
-        return "Visuel"
+    return scoring.classify_cognitive_type(avg_response_time, accuracy, focus)
 
 def determine_pattern_dominante(cognitive_data: CognitiveData) -> str:
     """Determine dominant pattern"""
-    if not cognitive_data.response_patterns:
-        return "aléatoire"
-    
-    # Calculate pattern consistency
-    pattern_counts = {}
-    for pattern in cognitive_data.response_patterns:
-        pattern_counts[pattern] = pattern_counts.get(pattern, 0) + 1
-    
-    most_common = max(pattern_counts.values())
-    total_patterns = len(cognitive_data.response_patterns)
-    
-    if most_common / total_patterns > 0.7:
-        return "sérieux"
-    elif most_common / total_patterns > 0.4:
-        return "stratégique"
-    else:
-        return "aléatoire"
+    return scoring.dominant_pattern(cognitive_data.response_patterns or [])
 
 @app.post("/test/submit")
 async def submit_test(
@@ -2482,101 +3672,73 @@ async def submit_test(
         )
     
     try:
-        # Verify student exists
         student_ref = db.collection('students').document(submission.student_id)
-        student_doc = student_ref.get()
-        
-        if not student_doc.exists:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Étudiant non trouvé"
-            )
         
-        # Calculate metrics
-        correct_answers = sum(1 for answer in submission.answers if answer.is_correct)
-        total_questions = len(submission.answers)
-        accuracy = (correct_answers / total_questions) if total_questions > 0 else 0
-        precision = accuracy  # For this context, precision equals accuracy
-        
-        avg_response_time = sum(answer.response_time for answer in submission.answers) / total_questions if total_questions > 0 else 0
-        temp_moyen_question = avg_response_time / 1000  # Convert to seconds
-        
-        # Calculate focus level (average of focus metrics)
-        niveau_focus = sum(submission.cognitive_data.focus_metrics) / len(submission.cognitive_data.focus_metrics) if submission.cognitive_data.focus_metrics else 0
-        
-        # Calculate consistency score
-        score_consistante = sum(submission.cognitive_data.consistency_scores) / len(submission.cognitive_data.consistency_scores) if submission.cognitive_data.consistency_scores else 0
-        
-        # Determine cognitive type
-        type_cognitive = determine_cognitive_type(avg_response_time, accuracy * 100, niveau_focus)
-        
-        # Determine dominant pattern
-        patern_dominante = determine_pattern_dominante(submission.cognitive_data)
-        
-        # Calculate violations
-        total_violations = (
-            submission.surveillance_metrics.position_violations +
-            submission.surveillance_metrics.speech_detections +
-            submission.surveillance_metrics.multiple_persons_detected
-        )
-        
-        # Calculate integrity score (1 - violation_penalty)
-        violation_penalty = min(total_violations * 0.1, 1.0)  # Max penalty of 100%
-        score_integrité = max(0, 1 - violation_penalty)
+        # Calculate all metrics in one vectorized pass
+        metrics = scoring.score_submission(submission)
+        accuracy = metrics["accuracy"]
+        type_cognitive = metrics["type_cognitive"]
+        patern_dominante = metrics["patern_dominante"]
+        total_violations = metrics["violation"]
+        score_integrité = metrics["score_integrité"]
         
         # Create proof of identity
         proof_id = generate_id("proof")
         proof_data = {
             "id_student": submission.student_id,
-            "accuracy": round(accuracy, 2),
-            "precision": round(precision, 2),
-            "type_cognitive": type_cognitive,
-            "temp_moyen_question": round(temp_moyen_question, 2),
-            "niveau_focus": round(niveau_focus, 2),
-            "violation": total_violations,
-            "score_consistante": round(score_consistante, 2),
-            "patern_dominante": patern_dominante,
-            "score_integrité": round(score_integrité, 2),
-            "created_at": datetime.now(),
-            "raw_data": {
-                "answers": [
-                    {
-                        "question_index": ans.question_index,
-                        "answer": ans.answer,
-                        "response_time": ans.response_time,
-                        "is_correct": ans.is_correct
-                    }
-                    for ans in submission.answers
-                ],
-                "cognitive_data": {
-                    "response_patterns": submission.cognitive_data.response_patterns,
-                    "hesitation_times": submission.cognitive_data.hesitation_times,
-                    "consistency_scores": submission.cognitive_data.consistency_scores,
-                    "focus_metrics": submission.cognitive_data.focus_metrics
-                },
-                "surveillance_metrics": {
-                    "face_detections": submission.surveillance_metrics.face_detections,
-                    "position_violations": submission.surveillance_metrics.position_violations,
-                    "speech_detections": submission.surveillance_metrics.speech_detections,
-                    "multiple_persons_detected": submission.surveillance_metrics.multiple_persons_detected,
-                    "total_checks": submission.surveillance_metrics.total_checks
-                },
-                "alerts_history": [
-                    {
-                        "message": alert.message,
-                        "type": alert.type,
-                        "timestamp": alert.timestamp
-                    }
-                    for alert in submission.alerts_history
-                ]
-            }
+            **scoring.proof_fields(metrics),
+            "created_at": datetime.now()
         }
         
-        # Save proof of identity
-        db.collection('proof_identity').document(proof_id).set(proof_data)
+        # Comparer la session au profil déjà enregistré de l'étudiant
+        identity_check = await asyncio.to_thread(identity_profiles.verify, submission.student_id, proof_data)
+        if identity_check is not None:
+            proof_data["identity_check"] = identity_check
+        
+        # Raw test data is kept out of the proof document, see raw_store.py
+        raw_data = {
+            "answers": [
+                {
+                    "question_index": ans.question_index,
+                    "answer": ans.answer,
+                    "response_time": ans.response_time,
+                    "is_correct": ans.is_correct
+                }
+                for ans in submission.answers
+            ],
+            "cognitive_data": {
+                "response_patterns": submission.cognitive_data.response_patterns,
+                "hesitation_times": submission.cognitive_data.hesitation_times,
+                "consistency_scores": submission.cognitive_data.consistency_scores,
+                "focus_metrics": submission.cognitive_data.focus_metrics
+            },
+            "surveillance_metrics": {
+                "face_detections": submission.surveillance_metrics.face_detections,
+                "position_violations": submission.surveillance_metrics.position_violations,
+                "speech_detections": submission.surveillance_metrics.speech_detections,
+                "multiple_persons_detected": submission.surveillance_metrics.multiple_persons_detected,
+                "total_checks": submission.surveillance_metrics.total_checks
+            },
+            "alerts_history": [
+                {
+                    "message": alert.message,
+                    "type": alert.type,
+                    "timestamp": alert.timestamp
+                }
+                for alert in submission.alerts_history
+            ]
+        }
         
-        # Update student record
-        student_ref.update({
+        # All writes go out in one atomic commit: the proof and its raw data
+        # (a local raw store publishes its file after it, see raw_store.py),
+        # the student update, the optional fraud report and the session cleanup
+        batch = db.batch()
+        batch.set(db.collection('proof_identity').document(proof_id), proof_data)
+        raw_data_store.put(proof_id, raw_data, batch=batch)
+        
+        # update() requires the document to exist, so it doubles as the student
+        # existence check and fails the whole commit otherwise
+        batch.update(student_ref, {
             'has_completed_test': True,
             'last_test_date': datetime.now(),
             'last_accuracy': accuracy,
@@ -2599,10 +3761,26 @@ async def submit_test(
                     "multiple_persons_detected": submission.surveillance_metrics.multiple_persons_detected
                 }
             }
-            db.collection('fraude').document(fraude_id).set(fraude_data)
+            batch.set(db.collection('fraude').document(fraude_id), fraude_data)
         
         # Clean up session
-        db.collection('sessions').document(credentials.credentials).delete()
+        batch.delete(db.collection('sessions').document(credentials.credentials))
+        
+        try:
+            batch.commit()
+        except NotFound:
+            raw_data_store.discard(proof_id)
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Étudiant non trouvé"
+            )
+        except Exception:
+            raw_data_store.discard(proof_id)
+            raise
+        # A local raw store only writes its file once the proof is committed
+        raw_data_store.publish(proof_id)
+        invalidate_student_cache(submission.student_id)
+        await asyncio.to_thread(identity_profiles.add, submission.student_id, proof_data)
         
         return {
             "success": True,
@@ -2617,6 +3795,8 @@ async def submit_test(
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -2639,30 +3819,42 @@ async def get_dashboard_analytics(credentials: HTTPAuthorizationCredentials = De
         )
     
     try:
+        if live_aggregator and live_aggregator.ready():
+            return live_aggregator.dashboard()
+        
         # Count collections
-        students_count = len(list(db.collection('students').stream()))
         teachers_count = len(list(db.collection('teachers').stream()))
         modules_count = len(list(db.collection('modules').stream()))
         exams_count = len(list(db.collection('exams').stream()))
         quizzes_count = len(list(db.collection('quizzes').stream()))
         
-        # Count completed tests
-        completed_tests = len(list(db.collection('proof_identity').stream()))
-        
-        # Count frauds
-        fraudes_count = len(list(db.collection('fraude').stream()))
+        if analytics_engine and analytics_engine.available():
+            # Students, proofs and frauds are read from the Parquet snapshots
+            snapshot = analytics_engine.dashboard()
+            students_count = snapshot['students']
+            completed_tests = snapshot['completed_tests']
+            fraudes_count = snapshot['fraudes']
+            cognitive_types = snapshot['cognitive_type_distribution']
+        else:
+            students_count = len(list(db.collection('students').stream()))
+            
+            # Count completed tests
+            completed_tests = len(list(db.collection('proof_identity').stream()))
+            
+            # Count frauds
+            fraudes_count = len(list(db.collection('fraude').stream()))
+            
+            # Get cognitive type distribution
+            cognitive_types = {}
+            proof_docs = select_proof_fields(db.collection('proof_identity')).stream()
+            for doc in proof_docs:
+                data = doc.to_dict()
+                cog_type = data.get('type_cognitive', 'Unknown')
+                cognitive_types[cog_type] = cognitive_types.get(cog_type, 0) + 1
         
         # Calculate test completion rate
         completion_rate = (completed_tests / students_count * 100) if students_count > 0 else 0
         
-        # Get cognitive type distribution
-        cognitive_types = {}
-        proof_docs = db.collection('proof_identity').stream()
-        for doc in proof_docs:
-            data = doc.to_dict()
-            cog_type = data.get('type_cognitive', 'Unknown')
-            cognitive_types[cog_type] = cognitive_types.get(cog_type, 0) + 1
-        
         return {
             "counts": {
                 "students": students_count,
@@ -2682,7 +3874,7 @@ async def get_dashboard_analytics(credentials: HTTPAuthorizationCredentials = De
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/analytics/student/{student_id}")
-async def get_student_analytics(student_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_student_analytics(student_id: str, include: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get analytics for specific student"""
     session_data = verify_token(credentials.credentials)
     
@@ -2703,18 +3895,19 @@ async def get_student_analytics(student_id: str, credentials: HTTPAuthorizationC
         
         student_data = student_doc.to_dict()
         
-        # Get proof identity
-        proof_ref = db.collection('proof_identity').where('id_student', '==', student_id).limit(1)
-        proof_docs = list(proof_ref.stream())
-        
-        proof_data = None
-        if proof_docs:
-            proof_data = proof_docs[0].to_dict()
-        
-        # Get fraud reports
-        fraude_ref = db.collection('fraude').where('id_ref', '==', student_id)
-        fraude_docs = list(fraude_ref.stream())
-        fraudes = [doc.to_dict() for doc in fraude_docs]
+        if analytics_engine and analytics_engine.available() and include != 'raw':
+            # Proof summary and fraud reports from the Parquet snapshots, plus those written since the export
+            snapshot = analytics_engine.student(student_id, db)
+            proof_data = snapshot['proof_identity']
+            fraudes = snapshot['fraudes']
+        else:
+            # Get proof identity
+            proof_data = get_student_proof(student_id, include)
+            
+            # Get fraud reports
+            fraude_ref = db.collection('fraude').where('id_ref', '==', student_id)
+            fraude_docs = list(fraude_ref.stream())
+            fraudes = [doc.to_dict() for doc in fraude_docs]
         
         return {
             "student": {
@@ -2742,6 +3935,12 @@ async def get_field_analytics(field: str, credentials: HTTPAuthorizationCredenti
         )
     
     try:
+        if live_aggregator and live_aggregator.ready():
+            return live_aggregator.field(field)
+        
+        if analytics_engine and analytics_engine.available():
+            return analytics_engine.field(field)
+        
         # Get students in field
         students_ref = db.collection('students').where('field', '==', field)
         students = list(students_ref.stream())
@@ -2783,6 +3982,28 @@ async def get_field_analytics(field: str, credentials: HTTPAuthorizationCredenti
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/analytics/cohorts")
+async def get_cohort_analytics(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Compare fields (completion, accuracy, integrity, frauds) from the analytics snapshots"""
+    session_data = verify_token(credentials.credentials)
+    
+    if session_data['role'] not in ['admin', 'teacher']:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Accès non autorisé"
+        )
+    
+    if not (analytics_engine and analytics_engine.available()):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Snapshots analytiques non disponibles"
+        )
+    
+    try:
+        return {"cohorts": analytics_engine.cohorts()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # =============================================================================
 # UTILITY ENDPOINTS
 # =============================================================================
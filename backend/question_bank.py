@@ -0,0 +1,145 @@
+"""
+In-memory question bank for the cognitive identity test (/questions/{field}).
+
+Questions are loaded once, from questions.json (or QUESTION_BANK_PATH, a
+file or a directory of JSON files) or from the Firestore `question_bank`
+collection when QUESTION_BANK_SOURCE=firestore, and indexed by field,
+difficulty and tag.
+
+Each student gets a deterministic sample with shuffled options, seeded by
+student, session and bank version, so nothing per student is stored: the
+same session always sees the same test. Responses are assembled from
+pre-serialized question fragments cached per bank version.
+"""
+import glob
+import hashlib
+import json
+import os
+import random
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from responses import dumps
+
+DEFAULT_BANK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "questions.json")
+FIRESTORE_COLLECTION = "question_bank"
+DEFAULT_DIFFICULTY = "medium"
+
+# Fields sent to the client (the test page grades on `correct`)
+PUBLIC_FIELDS = ["id", "question", "options", "correct", "difficulty", "tags"]
+
+
+def _normalize(question: Dict[str, Any], position: int) -> Dict[str, Any]:
+    field = question.get("field")
+    if not field or not question.get("options"):
+        raise ValueError(f"Question {position}: 'field' et 'options' sont obligatoires")
+    return {
+        "id": str(question.get("id") or f"{field}-{position}"),
+        "field": field,
+        "difficulty": question.get("difficulty") or DEFAULT_DIFFICULTY,
+        "tags": list(question.get("tags") or []),
+        "question": question["question"],
+        "options": list(question["options"]),
+        "correct": int(question.get("correct", 0)),
+    }
+
+
+def load_from_files(path: str) -> List[Dict[str, Any]]:
+    """Questions from a JSON file, or every *.json file of a directory"""
+    paths = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+    questions = []
+    for file_path in paths:
+        with open(file_path, encoding="utf-8") as f:
+            data = json.load(f)
+        questions.extend(data["questions"] if isinstance(data, dict) else data)
+    return questions
+
+
+def load_from_firestore(db) -> List[Dict[str, Any]]:
+    questions = []
+    for doc in db.collection(FIRESTORE_COLLECTION).stream():
+        question = doc.to_dict()
+        question.setdefault("id", doc.id)
+        questions.append(question)
+    return questions
+
+
+class QuestionBank:
+    """Questions indexed by field, (field, difficulty) and (field, tag)"""
+
+    def __init__(self, questions: List[Dict[str, Any]]):
+        self.questions = [_normalize(question, i) for i, question in enumerate(questions)]
+        self.version = hashlib.blake2b(
+            json.dumps(self.questions, sort_keys=True, ensure_ascii=False).encode(), digest_size=8
+        ).hexdigest()
+
+        self.by_field: Dict[str, List[int]] = {}
+        self.by_difficulty: Dict[Tuple[str, str], List[int]] = {}
+        self.by_tag: Dict[Tuple[str, str], List[int]] = {}
+        for i, question in enumerate(self.questions):
+            self.by_field.setdefault(question["field"], []).append(i)
+            self.by_difficulty.setdefault((question["field"], question["difficulty"]), []).append(i)
+            for tag in question["tags"]:
+                self.by_tag.setdefault((question["field"], tag), []).append(i)
+
+        # (question position, option order) -> serialized question
+        self._fragments: Dict[Tuple[int, Tuple[int, ...]], bytes] = {}
+        self._lock = threading.Lock()
+
+    def has_field(self, field: str) -> bool:
+        return field in self.by_field
+
+    def candidates(self, field: str, difficulty: Optional[str] = None, tag: Optional[str] = None) -> List[int]:
+        positions = self.by_field.get(field, [])
+        if difficulty:
+            positions = self.by_difficulty.get((field, difficulty), [])
+        if tag:
+            tagged = set(self.by_tag.get((field, tag), []))
+            positions = [i for i in positions if i in tagged]
+        return positions
+
+    def seed(self, field: str, student_id: str, session_id: str, *params) -> str:
+        """Stable per-student seed; also identifies the response for ETags"""
+        key = "|".join([self.version, field, student_id, session_id] + [str(param) for param in params])
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def sample(self, positions: List[int], seed: str, count: Optional[int] = None) -> List[Tuple[int, Tuple[int, ...]]]:
+        """Pick count questions and an option order for each, deterministically from seed"""
+        rng = random.Random(seed)
+        count = len(positions) if count is None else max(0, min(count, len(positions)))
+        picked = rng.sample(positions, count)
+        sampled = []
+        for i in picked:
+            order = list(range(len(self.questions[i]["options"])))
+            rng.shuffle(order)
+            sampled.append((i, tuple(order)))
+        return sampled
+
+    def _fragment(self, position: int, order: Tuple[int, ...]) -> bytes:
+        fragment = self._fragments.get((position, order))
+        if fragment is None:
+            question = self.questions[position]
+            public = {key: question[key] for key in PUBLIC_FIELDS}
+            public["options"] = [question["options"][j] for j in order]
+            public["correct"] = order.index(question["correct"])
+            fragment = dumps(public)
+            with self._lock:
+                self._fragments[(position, order)] = fragment
+        return fragment
+
+    def render(self, sampled: List[Tuple[int, Tuple[int, ...]]]) -> bytes:
+        """{"questions": [...], "version": ...} from cached fragments"""
+        return b"".join([
+            b'{"questions":[',
+            b",".join(self._fragment(position, order) for position, order in sampled),
+            b'],"version":',
+            dumps(self.version),
+            b"}",
+        ])
+
+
+def load_bank(db=None) -> QuestionBank:
+    """Bank from Firestore when QUESTION_BANK_SOURCE=firestore, from files otherwise"""
+    if os.getenv("QUESTION_BANK_SOURCE") == "firestore" and db is not None:
+        return QuestionBank(load_from_firestore(db))
+    return QuestionBank(load_from_files(os.getenv("QUESTION_BANK_PATH", DEFAULT_BANK_PATH)))
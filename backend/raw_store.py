@@ -0,0 +1,272 @@
+"""
+Side storage for the proof_identity raw_data blob.
+
+raw_data (every answer, hesitation time, focus metric and alert of the
+identity test) is only needed for audits and re-scoring, so it is kept out
+of the proof document. It is encoded as packed numeric arrays, compressed
+(zstd when installed, zlib otherwise) and stored either in a
+``proof_identity/{id}/raw/data`` sub-document or, when RAW_STORE_DIR is
+set, as one file per proof on local disk.
+
+Both stores take the batch of the proof commit in put(). Firestore stages
+the sub-document on it; the local store can't join a Firestore commit, so it
+writes a temporary file and only renames it into place on publish(), called
+once the batch has committed (discard() drops it when the commit fails). A
+crash between the two leaves a proof without raw_data, never raw_data
+without a proof; readers already treat missing raw_data as absent. The
+migration of embedded raw_data publishes first instead: its proofs exist,
+and the embedded copy is only deleted once the file is on disk.
+
+    python raw_store.py   # move raw_data still embedded in proofs to the store
+"""
+import json
+import os
+import struct
+import tempfile
+import zlib
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used instead
+    zstandard = None
+
+MAGIC = b"RD"
+FORMAT_VERSION = 1
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+GET_ALL_CHUNK_SIZE = 100
+
+# (path in raw_data, dtype) of every packed array, in storage order
+ARRAY_FIELDS = [
+    (("answers", "question_index"), np.int32),
+    (("answers", "answer"), np.int32),
+    (("answers", "response_time"), np.int64),
+    (("answers", "is_correct"), np.uint8),
+    (("cognitive_data", "response_patterns"), np.int64),
+    (("cognitive_data", "hesitation_times"), np.int64),
+    (("cognitive_data", "consistency_scores"), np.float64),
+    (("cognitive_data", "focus_metrics"), np.float64),
+]
+
+
+def _compress(payload: bytes) -> tuple:
+    if zstandard is not None:
+        return CODEC_ZSTD, zstandard.ZstdCompressor(level=3).compress(payload)
+    return CODEC_ZLIB, zlib.compress(payload, 6)
+
+
+def _decompress(codec: int, data: bytes) -> bytes:
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("raw_data blob is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_raw_data(raw_data: Dict[str, Any]) -> bytes:
+    """Pack raw_data into a compact binary blob"""
+    answers = raw_data.get("answers") or []
+    cognitive = raw_data.get("cognitive_data") or {}
+
+    arrays = []
+    for (section, key), dtype in ARRAY_FIELDS:
+        if section == "answers":
+            values = [answer.get(key, 0) for answer in answers]
+        else:
+            values = cognitive.get(key) or []
+        arrays.append(np.asarray(values, dtype=dtype))
+
+    header = json.dumps({
+        "lengths": [len(array) for array in arrays],
+        "surveillance_metrics": raw_data.get("surveillance_metrics") or {},
+        "alerts_history": raw_data.get("alerts_history") or [],
+    }, ensure_ascii=False, separators=(",", ":")).encode()
+
+    payload = b"".join([struct.pack("<I", len(header)), header] + [array.astype(array.dtype.newbyteorder("<")).tobytes() for array in arrays])
+    codec, compressed = _compress(payload)
+    return MAGIC + bytes([FORMAT_VERSION, codec]) + compressed
+
+
+def decode_raw_data(blob: bytes) -> Dict[str, Any]:
+    """Unpack a blob produced by encode_raw_data"""
+    if blob[:2] != MAGIC or blob[2] != FORMAT_VERSION:
+        raise ValueError("Format raw_data inconnu")
+    payload = _decompress(blob[3], blob[4:])
+
+    header_length = struct.unpack_from("<I", payload)[0]
+    header = json.loads(payload[4:4 + header_length])
+    offset = 4 + header_length
+
+    values = {}
+    for ((section, key), dtype), length in zip(ARRAY_FIELDS, header["lengths"]):
+        dtype = np.dtype(dtype).newbyteorder("<")
+        array = np.frombuffer(payload, dtype=dtype, count=length, offset=offset)
+        offset += length * dtype.itemsize
+        values[(section, key)] = array.tolist()
+
+    answer_count = header["lengths"][0]
+    return {
+        "answers": [
+            {
+                "question_index": values[("answers", "question_index")][i],
+                "answer": values[("answers", "answer")][i],
+                "response_time": values[("answers", "response_time")][i],
+                "is_correct": bool(values[("answers", "is_correct")][i]),
+            }
+            for i in range(answer_count)
+        ],
+        "cognitive_data": {
+            key: values[("cognitive_data", key)]
+            for (section, key), _ in ARRAY_FIELDS if section == "cognitive_data"
+        },
+        "surveillance_metrics": header["surveillance_metrics"],
+        "alerts_history": header["alerts_history"],
+    }
+
+
+class FirestoreRawStore:
+    """Keeps each blob in a proof_identity/{id}/raw/data sub-document"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def _ref(self, proof_id: str):
+        return self.db.collection('proof_identity').document(proof_id).collection('raw').document('data')
+
+    def put(self, proof_id: str, raw_data: Dict[str, Any], batch=None):
+        """Store raw_data, staged on batch when given so it commits with the proof"""
+        data = {"blob": encode_raw_data(raw_data), "format": FORMAT_VERSION}
+        if batch is not None:
+            batch.set(self._ref(proof_id), data)
+        else:
+            self._ref(proof_id).set(data)
+
+    def publish(self, proof_id: str):
+        """Nothing to do: the staged write committed with the batch"""
+
+    def discard(self, proof_id: str):
+        """Nothing to do: the staged write was dropped with the batch"""
+
+    def get(self, proof_id: str) -> Optional[Dict[str, Any]]:
+        doc = self._ref(proof_id).get()
+        return decode_raw_data(doc.to_dict()["blob"]) if doc.exists else None
+
+    def get_many(self, proof_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        proof_ids = list(proof_ids)
+        result = {}
+        for i in range(0, len(proof_ids), GET_ALL_CHUNK_SIZE):
+            refs = [self._ref(proof_id) for proof_id in proof_ids[i:i + GET_ALL_CHUNK_SIZE]]
+            for doc in self.db.get_all(refs):
+                if doc.exists:
+                    # raw/data lives under proof_identity/{proof_id}
+                    result[doc.reference.parent.parent.id] = decode_raw_data(doc.to_dict()["blob"])
+        return result
+
+    def delete(self, proof_id: str, batch=None):
+        if batch is not None:
+            batch.delete(self._ref(proof_id))
+        else:
+            self._ref(proof_id).delete()
+
+
+class LocalRawStore:
+    """Local-disk stand-in: one {proof_id}.bin file per proof"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._staged: Dict[str, str] = {}
+
+    def _path(self, proof_id: str) -> str:
+        return os.path.join(self.directory, f"{os.path.basename(proof_id)}.bin")
+
+    def put(self, proof_id: str, raw_data: Dict[str, Any], batch=None):
+        """Store raw_data; with a batch, only stage it until publish() after the commit"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(encode_raw_data(raw_data))
+            f.flush()
+            os.fsync(f.fileno())
+        if batch is not None:
+            self.discard(proof_id)
+            self._staged[proof_id] = tmp_path
+        else:
+            os.replace(tmp_path, self._path(proof_id))
+
+    def publish(self, proof_id: str):
+        tmp_path = self._staged.pop(proof_id, None)
+        if tmp_path is not None:
+            os.replace(tmp_path, self._path(proof_id))
+
+    def discard(self, proof_id: str):
+        tmp_path = self._staged.pop(proof_id, None)
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, proof_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(proof_id), "rb") as f:
+                return decode_raw_data(f.read())
+        except FileNotFoundError:
+            return None
+
+    def get_many(self, proof_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for proof_id in proof_ids:
+            raw_data = self.get(proof_id)
+            if raw_data is not None:
+                result[proof_id] = raw_data
+        return result
+
+    def delete(self, proof_id: str, batch=None):
+        try:
+            os.remove(self._path(proof_id))
+        except FileNotFoundError:
+            pass
+
+
+def get_raw_store(db):
+    """Local-disk store when RAW_STORE_DIR is set, Firestore otherwise"""
+    directory = os.getenv("RAW_STORE_DIR")
+    if directory:
+        return LocalRawStore(directory)
+    return FirestoreRawStore(db)
+
+
+def migrate_embedded_raw_data(db, store, page_size: int = 200) -> int:
+    """Move raw_data still embedded in proof documents to the store"""
+    from firebase_admin import firestore
+
+    moved = 0
+    while True:
+        docs = list(db.collection('proof_identity').where('raw_data', '!=', None).limit(page_size).stream())
+        if not docs:
+            return moved
+        batch = db.batch()
+        for doc in docs:
+            store.put(doc.id, doc.to_dict()['raw_data'], batch=batch)
+            batch.update(doc.reference, {'raw_data': firestore.DELETE_FIELD})
+        # The proofs already exist: local files are published before the embedded
+        # copy is deleted, a failed commit only leaves both (the next run redoes it)
+        for doc in docs:
+            store.publish(doc.id)
+        batch.commit()
+        moved += len(docs)
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    if not firebase_admin._apps:
+        cred = credentials.Certificate("./serviceAccountKey.json")
+        firebase_admin.initialize_app(cred)
+
+    client = firestore.client()
+    print(f"{migrate_embedded_raw_data(client, get_raw_store(client))} proofs migrated")
@@ -0,0 +1,247 @@
+"""
+Bulk re-scoring of proof_identity documents.
+
+When the rules in scoring.py change (bump SCORING_VERSION), existing proofs
+keep their stale type_cognitive, patern_dominante and score_integrité. This
+job streams every proof in pages ordered by document ID, recomputes the
+metrics from raw_data (embedded, or in the raw_store side storage) across
+a process pool and writes the changed fields back in batched commits.
+Progress is checkpointed after every page so an interrupted run resumes
+where it stopped.
+
+    python rescore.py                 # re-score proofs older than SCORING_VERSION
+    python rescore.py --dry-run       # print the diff, write nothing
+    python rescore.py --all --restart # re-score everything from the start
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from google.cloud.firestore_v1.field_path import FieldPath
+
+import raw_store
+import scoring
+from dates import to_utc
+
+PAGE_SIZE = 1000
+WRITE_BATCH_SIZE = 500  # Firestore limit per commit
+CHECKPOINT_PATH = "rescore_checkpoint.json"
+
+# Fields compared to decide whether a proof needs to be written back
+COMPARED_FIELDS = [
+    "accuracy",
+    "precision",
+    "type_cognitive",
+    "temp_moyen_question",
+    "niveau_focus",
+    "violation",
+    "score_consistante",
+    "patern_dominante",
+    "score_integrité",
+    "statistics",
+    "scoring_version"
+]
+
+
+def _score_chunk(raw_items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Worker entry point: score a chunk of raw_data dicts"""
+    return [scoring.proof_fields(metrics) for metrics in scoring.score_batch(raw_items)]
+
+
+def diff_proof(stored: Dict[str, Any], rescored: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the fields whose value changed, as {field: (old, new)}"""
+    return {
+        field: (stored.get(field), rescored[field])
+        for field in COMPARED_FIELDS
+        if stored.get(field) != rescored[field]
+    }
+
+
+def _new_checkpoint() -> Dict[str, Any]:
+    return {
+        "cursor": None,
+        "scanned": 0,
+        "rescored": 0,
+        "updated": 0,
+        "completed": False,
+        "scoring_version": scoring.SCORING_VERSION
+    }
+
+
+def load_checkpoint(path: str) -> Optional[Dict[str, Any]]:
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def _stream_pages(db, cursor: Optional[str], page_size: int):
+    """Yield pages of proof snapshots ordered by document ID"""
+    while True:
+        query = db.collection('proof_identity').order_by(FieldPath.document_id())
+        if cursor:
+            query = query.start_after({FieldPath.document_id(): cursor})
+        page = list(query.limit(page_size).stream())
+        if not page:
+            return
+        yield page
+        cursor = page[-1].id
+        if len(page) < page_size:
+            return
+
+
+def _latest_proof_ids(db, student_ids) -> Dict[str, str]:
+    """student ID -> ID of their newest proof (by created_at)"""
+    latest = {}
+    for student_id in student_ids:
+        proofs = db.collection('proof_identity').where('id_student', '==', student_id).select(['created_at']).stream()
+        newest = max(proofs, key=lambda doc: to_utc(doc.to_dict().get('created_at')) or datetime.min.replace(tzinfo=timezone.utc), default=None)
+        if newest is not None:
+            latest[student_id] = newest.id
+    return latest
+
+
+def _commit_updates(db, updates: List[tuple]):
+    """Write (proof_ref, changes, student_id) updates in batches of WRITE_BATCH_SIZE"""
+    # Keep the student's denormalized last_cognitive_type in sync, from their newest
+    # proof only (proof IDs are not chronological): when its type changed in this page
+    type_changes = {
+        proof_ref.id: changes['type_cognitive']
+        for proof_ref, changes, student_id in updates if student_id and 'type_cognitive' in changes
+    }
+    student_ids = {student_id for proof_ref, _, student_id in updates if proof_ref.id in type_changes}
+    latest = _latest_proof_ids(db, student_ids)
+    student_types = {
+        student_id: type_changes[proof_id] for student_id, proof_id in latest.items() if proof_id in type_changes
+    }
+    student_refs = [db.collection('students').document(student_id) for student_id in student_types]
+    existing_students = {doc.id for doc in db.get_all(student_refs) if doc.exists} if student_refs else set()
+
+    operations = [(proof_ref, changes) for proof_ref, changes, _ in updates]
+    for student_id in existing_students:
+        operations.append((
+            db.collection('students').document(student_id),
+            {'last_cognitive_type': student_types[student_id]}
+        ))
+
+    for i in range(0, len(operations), WRITE_BATCH_SIZE):
+        batch = db.batch()
+        for ref, data in operations[i:i + WRITE_BATCH_SIZE]:
+            batch.update(ref, data)
+        batch.commit()
+
+
+def rescore_proofs(
+    db,
+    store=None,
+    dry_run: bool = False,
+    rescore_all: bool = False,
+    workers: Optional[int] = None,
+    page_size: int = PAGE_SIZE,
+    checkpoint_path: str = CHECKPOINT_PATH,
+    restart: bool = False,
+    out=sys.stdout
+) -> Dict[str, Any]:
+    """Re-score proofs from raw_data and write back the changed fields"""
+    checkpoint = _new_checkpoint()
+    if not restart and not dry_run:
+        saved = load_checkpoint(checkpoint_path)
+        # A finished run or a run for older rules starts over
+        if saved and not saved.get("completed") and saved.get("scoring_version") == scoring.SCORING_VERSION:
+            checkpoint = saved
+
+    store = store or raw_store.get_raw_store(db)
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for page in _stream_pages(db, checkpoint["cursor"], page_size):
+            candidates = []
+            for doc in page:
+                proof = doc.to_dict()
+                if not rescore_all and proof.get('scoring_version') == scoring.SCORING_VERSION:
+                    continue
+                candidates.append((doc, proof))
+            
+            # Proofs written since the side store was introduced keep raw_data there
+            stored_raw = store.get_many(doc.id for doc, proof in candidates if 'raw_data' not in proof)
+            for doc, proof in candidates:
+                if doc.id in stored_raw:
+                    proof['raw_data'] = stored_raw[doc.id]
+            candidates = [(doc, proof) for doc, proof in candidates if proof.get('raw_data')]
+
+            # Split the page evenly across the pool
+            chunk_size = max(1, -(-len(candidates) // workers))
+            chunks = [
+                [proof['raw_data'] for _, proof in candidates[i:i + chunk_size]]
+                for i in range(0, len(candidates), chunk_size)
+            ]
+            rescored = [fields for chunk in executor.map(_score_chunk, chunks) for fields in chunk]
+
+            updates = []
+            for (doc, proof), fields in zip(candidates, rescored):
+                changes = diff_proof(proof, fields)
+                if not changes:
+                    continue
+                if dry_run:
+                    out.write(json.dumps({"proof_id": doc.id, "changes": changes}, default=str, ensure_ascii=False) + "\n")
+                updates.append((doc.reference, {field: new for field, (_, new) in changes.items()}, proof.get('id_student')))
+
+            if not dry_run and updates:
+                _commit_updates(db, updates)
+
+            checkpoint["cursor"] = page[-1].id
+            checkpoint["scanned"] += len(page)
+            checkpoint["rescored"] += len(candidates)
+            checkpoint["updated"] += len(updates)
+            if not dry_run:
+                save_checkpoint(checkpoint_path, checkpoint)
+
+    checkpoint["completed"] = True
+    if not dry_run:
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    checkpoint["elapsed_seconds"] = round(time.perf_counter() - started, 2)
+    checkpoint["dry_run"] = dry_run
+    return checkpoint
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    parser = argparse.ArgumentParser(description="Re-score proof_identity documents from raw_data")
+    parser.add_argument("--dry-run", action="store_true", help="print the diff without writing")
+    parser.add_argument("--all", action="store_true", help="re-score proofs already at SCORING_VERSION")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start over")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    args = parser.parse_args()
+
+    if not firebase_admin._apps:
+        cred = credentials.Certificate("./serviceAccountKey.json")
+        firebase_admin.initialize_app(cred)
+
+    summary = rescore_proofs(
+        firestore.client(),
+        dry_run=args.dry_run,
+        rescore_all=args.all,
+        workers=args.workers,
+        page_size=args.page_size,
+        checkpoint_path=args.checkpoint,
+        restart=args.restart
+    )
+    print(json.dumps(summary), file=sys.stderr)
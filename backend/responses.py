@@ -0,0 +1,242 @@
+"""
+JSON serialization and compression for API responses.
+
+FastJSONResponse renders with orjson, which handles datetimes natively;
+Firestore timestamps (DatetimeWithNanoseconds, a datetime subclass orjson
+refuses) and anything else unusual go through the default hook. Endpoints
+with large payloads return it directly to skip FastAPI's jsonable_encoder
+pass.
+
+CompressionMiddleware compresses bodies above a size threshold with brotli
+when the client accepts it and the brotli package is installed, gzip
+otherwise. Streaming responses are flushed chunk by chunk so they keep
+streaming.
+
+    python responses.py   # serialization / wire size benchmark
+"""
+import zlib
+from datetime import date, datetime
+from typing import Any
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is used instead
+    brotli = None
+
+COMPRESSION_MINIMUM_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return jsonable_encoder(value)
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default, option=ORJSON_OPTIONS)
+
+
+class FastJSONResponse(ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class _GzipEncoder:
+    name = "gzip"
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class _BrotliEncoder:
+    name = "br"
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    encodings = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accepted = _accepted_encodings(Headers(scope=scope).get("Accept-Encoding", ""))
+        if brotli is not None and "br" in accepted:
+            encoder = _BrotliEncoder
+        elif "gzip" in accepted:
+            encoder = _GzipEncoder
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        await _CompressionResponder(self.app, encoder, self.minimum_size)(scope, receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, app: ASGIApp, encoder, minimum_size: int):
+        self.app = app
+        self.encoder_class = encoder
+        self.encoder = None
+        self.minimum_size = minimum_size
+        self.initial_message: Message = {}
+        self.started = False
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    def _start(self, streaming: bool):
+        self.encoder = self.encoder_class()
+        headers = MutableHeaders(raw=self.initial_message["headers"])
+        headers["Content-Encoding"] = self.encoder.name
+        headers.add_vary_header("Accept-Encoding")
+        if streaming:
+            del headers["Content-Length"]
+
+    async def send_compressed(self, message: Message):
+        if message["type"] == "http.response.start":
+            # Held back until the first body chunk decides the headers
+            self.initial_message = message
+            headers = Headers(raw=message["headers"])
+            # Media is already compressed, and a byte range must stay a range of the file
+            self.passthrough = (
+                "content-encoding" in headers or "content-range" in headers
+                or message.get("status") in (204, 206, 304)
+                or headers.get("content-type", "").startswith(("image/", "audio/", "video/"))
+            )
+            return
+
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if not self.started:
+            self.started = True
+            if self.passthrough or (not more_body and len(body) < self.minimum_size):
+                self.passthrough = True
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+            self._start(streaming=more_body)
+            if more_body:
+                message["body"] = self.encoder.compress(body)
+            else:
+                message["body"] = self.encoder.finish(body)
+                MutableHeaders(raw=self.initial_message["headers"])["Content-Length"] = str(len(message["body"]))
+            await self.send(self.initial_message)
+            await self.send(message)
+            return
+
+        if not self.passthrough:
+            message["body"] = self.encoder.compress(body) if more_body else self.encoder.finish(body)
+        await self.send(message)
+
+
+if __name__ == "__main__":
+    import gzip
+    import json
+    import random
+    import time
+    from datetime import timedelta, timezone
+
+    from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+
+    rng = random.Random(0)
+    now = datetime.now(timezone.utc)
+
+    def timestamp(days: int):
+        value = now - timedelta(days=days, seconds=rng.randint(0, 86400))
+        return DatetimeWithNanoseconds(*value.timetuple()[:6], value.microsecond, tzinfo=timezone.utc)
+
+    students = []
+    for i in range(2000):
+        students.append({
+            "id": f"stu_{i:06d}",
+            "document_id": f"stu_{i:06d}",
+            "name": f"Étudiant {i}",
+            "email": f"student{i}@enset.ma",
+            "field": rng.choice(["Informatique", "Génie Électrique", "Génie Mécanique"]),
+            "has_completed_test": True,
+            "created_at": timestamp(rng.randint(30, 300)),
+            "last_test_date": timestamp(rng.randint(0, 30)),
+            "last_accuracy": rng.random(),
+            "last_cognitive_type": rng.choice(["Analytique", "Intuitif", "Réfléchi", "Impulsif"]),
+            "proof_identity": {
+                "document_id": f"proof_{i:06d}",
+                "id_student": f"stu_{i:06d}",
+                "accuracy": rng.random(),
+                "precision": rng.random(),
+                "type_cognitive": "Analytique",
+                "temp_moyen_question": rng.uniform(2, 20),
+                "niveau_focus": rng.random(),
+                "violation": rng.randint(0, 5),
+                "score_consistante": rng.random(),
+                "patern_dominante": "Consistent",
+                "score_integrité": rng.random(),
+                "statistics": {"hesitation_p50": rng.uniform(1, 5), "hesitation_p90": rng.uniform(5, 15)},
+                "scoring_version": 1,
+                "created_at": timestamp(rng.randint(0, 30)),
+            },
+        })
+    payload = {"students": students}
+
+    def bench(label, fn, runs=20):
+        fn()
+        started = time.perf_counter()
+        for _ in range(runs):
+            body = fn()
+        print(f"{label:<32} {(time.perf_counter() - started) / runs * 1000:8.2f} ms  {len(body):>9} bytes")
+        return body
+
+    # FastAPI's default path: jsonable_encoder then stdlib json (JSONResponse.render)
+    stdlib_body = bench("jsonable_encoder + json", lambda: json.dumps(
+        jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode())
+    body = bench("orjson (FastJSONResponse)", lambda: dumps(payload))
+    bench("gzip level %d" % GZIP_LEVEL, lambda: gzip.compress(body, GZIP_LEVEL))
+    if brotli is not None:
+        bench("brotli quality %d" % BROTLI_QUALITY, lambda: brotli.compress(body, quality=BROTLI_QUALITY))
+    else:
+        print("brotli not installed, skipped")
+    assert json.loads(stdlib_body) == json.loads(body)
@@ -0,0 +1,195 @@
+"""
+In-memory index of exam and quiz availability windows.
+
+Every window is kept in an IntervalIndex (sorted by start, with a max-end
+segment tree) per student, per teacher and globally. "What overlaps
+[start, end)" is then O(log n + k) instead of a scan that parses dates for
+every assessment. The index is rebuilt on first use and after a
+create/delete of this worker invalidates it; a background task reloads it
+every REFRESH_SECONDS, off the request path, which bounds staleness when
+another instance did the write. Windows are also kept sorted by end for the
+attempt finalizer.
+"""
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from dates import to_utc
+
+logger = logging.getLogger(__name__)
+
+REFRESH_SECONDS = 60
+
+# kind -> (collection, start field, end field)
+ASSESSMENTS = {
+    "exam": ("exams", "date_debut_exame", "date_fin_exame"),
+    "quiz": ("quizzes", "date_debut_quiz", "date_fin_quiz"),
+}
+WINDOW_FIELDS = ["id_teacher", "title", "module_name", "students", "status"]
+
+
+class IntervalIndex:
+    """Static interval index: windows sorted by start, segment tree of max end"""
+
+    def __init__(self, windows: List[Dict[str, Any]]):
+        self.windows = sorted(windows, key=lambda window: window["start_ts"])
+        self.starts = [window["start_ts"] for window in self.windows]
+        self.size = 1
+        while self.size < max(1, len(self.windows)):
+            self.size *= 2
+        self.max_end = [float("-inf")] * (2 * self.size)
+        for i, window in enumerate(self.windows):
+            self.max_end[self.size + i] = window["end_ts"]
+        for node in range(self.size - 1, 0, -1):
+            self.max_end[node] = max(self.max_end[2 * node], self.max_end[2 * node + 1])
+
+    def overlapping(self, start_ts: float, end_ts: float) -> List[Dict[str, Any]]:
+        """Windows with start < end_ts and end > start_ts, ordered by start"""
+        limit = bisect.bisect_left(self.starts, end_ts)
+        result = []
+        self._collect(1, 0, self.size, limit, start_ts, result)
+        return result
+
+    def _collect(self, node: int, low: int, high: int, limit: int, start_ts: float, result: list):
+        # Skip subtrees past the start bound or whose windows all end before start_ts
+        if low >= limit or self.max_end[node] <= start_ts:
+            return
+        if node >= self.size:
+            result.append(self.windows[low])
+            return
+        middle = (low + high) // 2
+        self._collect(2 * node, low, middle, limit, start_ts, result)
+        self._collect(2 * node + 1, middle, high, limit, start_ts, result)
+
+
+class ScheduleIndex:
+    """Assessment windows indexed globally, by student and by teacher"""
+
+    def __init__(self, db, refresh_seconds: float = REFRESH_SECONDS):
+        self.db = db
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._generation = 0
+        self._task: Optional[asyncio.Task] = None
+        self._all = IntervalIndex([])
+        self._by_student: Dict[str, IntervalIndex] = {}
+        self._by_teacher: Dict[str, IntervalIndex] = {}
+        # Windows sorted by end and their end timestamps, swapped together
+        self._by_end: Tuple[List[Dict[str, Any]], List[float]] = ([], [])
+        self._by_id: Dict[tuple, Dict[str, Any]] = {}
+
+    def invalidate(self):
+        self._generation += 1
+        self._built_at = None
+
+    def _load_windows(self) -> List[Dict[str, Any]]:
+        windows = []
+        for kind, (collection, start_field, end_field) in ASSESSMENTS.items():
+            query = self.db.collection(collection).select(WINDOW_FIELDS + [start_field, end_field])
+            for doc in query.stream():
+                data = doc.to_dict()
+                # Legacy documents may still hold naive or ISO-string dates
+                start, end = to_utc(data.get(start_field)), to_utc(data.get(end_field))
+                if start is None or end is None:
+                    continue
+                windows.append({
+                    "id": doc.id,
+                    "type": kind,
+                    "title": data.get("title"),
+                    "module_name": data.get("module_name"),
+                    "id_teacher": data.get("id_teacher"),
+                    "students": data.get("students") or [],
+                    "status": data.get("status"),
+                    "start": start,
+                    "end": end,
+                    "start_ts": start.timestamp(),
+                    "end_ts": end.timestamp(),
+                })
+        return windows
+
+    def _ensure_fresh(self):
+        # Without the background task (scripts), the requests reload a stale index themselves
+        stale = self._task is None and self._built_at is not None and time.monotonic() - self._built_at >= self.refresh_seconds
+        if self._built_at is not None and not stale:
+            return
+        with self._lock:
+            if self._built_at is None or stale:
+                self.refresh()
+
+    def refresh(self):
+        """Reload every window from Firestore"""
+        generation = self._generation
+        windows = self._load_windows()
+        by_student: Dict[str, list] = {}
+        by_teacher: Dict[str, list] = {}
+        for window in windows:
+            for student_id in window["students"]:
+                by_student.setdefault(student_id, []).append(window)
+            by_teacher.setdefault(window["id_teacher"], []).append(window)
+        self._all = IntervalIndex(windows)
+        self._by_student = {key: IntervalIndex(value) for key, value in by_student.items()}
+        self._by_teacher = {key: IntervalIndex(value) for key, value in by_teacher.items()}
+        by_end = sorted(windows, key=lambda window: window["end_ts"])
+        self._by_end = (by_end, [window["end_ts"] for window in by_end])
+        self._by_id = {(window["type"], window["id"]): window for window in windows}
+        # Invalidated while loading: the next request reloads with the write
+        if generation == self._generation:
+            self._built_at = time.monotonic()
+
+    def windows(self, start: datetime, end: datetime, student_id: Optional[str] = None, teacher_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Windows overlapping [start, end) for a student, a teacher or everyone"""
+        self._ensure_fresh()
+        if student_id is not None:
+            index = self._by_student.get(student_id)
+        elif teacher_id is not None:
+            index = self._by_teacher.get(teacher_id)
+        else:
+            index = self._all
+        if index is None:
+            return []
+        return index.overlapping(to_utc(start).timestamp(), to_utc(end).timestamp())
+
+    def ended_between(self, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+        """Windows whose end falls in (start, end]"""
+        self._ensure_fresh()
+        by_end, ends = self._by_end
+        low = bisect.bisect_right(ends, to_utc(start).timestamp())
+        high = bisect.bisect_right(ends, to_utc(end).timestamp())
+        return by_end[low:high]
+
+    def window(self, kind: str, assessment_id: str) -> Optional[Dict[str, Any]]:
+        """Window of one exam or quiz, None when unknown or undated"""
+        self._ensure_fresh()
+        return self._by_id.get((kind, assessment_id))
+
+    def next_end(self, after: datetime) -> Optional[datetime]:
+        """First window end strictly after `after`"""
+        self._ensure_fresh()
+        by_end, ends = self._by_end
+        position = bisect.bisect_right(ends, to_utc(after).timestamp())
+        return by_end[position]["end"] if position < len(by_end) else None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception:
+                logger.exception("Schedule index refresh failed")
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
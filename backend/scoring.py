@@ -0,0 +1,430 @@
+"""
+Cognitive scoring for the identity test (/test/submit).
+
+score_batch converts submissions (TestSubmission models or stored
+``raw_data`` dicts) to NumPy arrays, then computes every metric of the
+proof of identity in a single pass over the concatenated arrays of the
+batch: that is the path for re-scoring stored proofs (rescore.py).
+
+A single submission of ~20 answers is too small for NumPy's per-call
+overhead to pay off, so score_submission computes the same metrics in plain
+Python. Both paths apply the same rules and agree up to float rounding.
+
+    python scoring.py   # per-submission cost of each path
+"""
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Sequence
+
+import numpy as np
+
+# Bump when the thresholds below change so stored proofs can be re-scored
+SCORING_VERSION = 1
+
+# Rules are evaluated in order, the first match wins
+COGNITIVE_TYPE_RULES = [
+    # (type, min accuracy %, max avg time ms, min avg time ms (exclusive), min focus, max focus (exclusive))
+    ("Analytique", 80, 3000, None, 0.7, None),
+    ("Auditif", 70, 4000, None, None, None),
+    ("Kinesthésique", 60, None, 4000, None, None),
+    ("Visuel", None, 2000, None, None, None),
+    ("Auditif", None, None, None, None, 0.3),
+]
+DEFAULT_COGNITIVE_TYPE = "Visuel"
+
+# Share of the most frequent response pattern
+PATTERN_RULES = [
+    ("sérieux", 0.7),
+    ("stratégique", 0.4),
+]
+DEFAULT_PATTERN = "aléatoire"
+
+VIOLATION_PENALTY = 0.1
+HESITATION_PERCENTILES = (50, 90, 95)
+
+
+def _get(obj: Any, name: str, default=None):
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def to_arrays(submission: Any) -> Dict[str, np.ndarray]:
+    """Convert a submission (model or raw_data dict) to flat NumPy arrays"""
+    answers = _get(submission, 'answers') or []
+    cognitive = _get(submission, 'cognitive_data') or {}
+    surveillance = _get(submission, 'surveillance_metrics') or {}
+
+    return {
+        "is_correct": np.fromiter((bool(_get(a, 'is_correct')) for a in answers), dtype=np.bool_, count=len(answers)),
+        "response_time": np.fromiter((_get(a, 'response_time', 0) for a in answers), dtype=np.float64, count=len(answers)),
+        "response_patterns": np.asarray(_get(cognitive, 'response_patterns') or [], dtype=np.int64),
+        "hesitation_times": np.asarray(_get(cognitive, 'hesitation_times') or [], dtype=np.float64),
+        "consistency_scores": np.asarray(_get(cognitive, 'consistency_scores') or [], dtype=np.float64),
+        "focus_metrics": np.asarray(_get(cognitive, 'focus_metrics') or [], dtype=np.float64),
+        "violations": np.array([
+            _get(surveillance, 'position_violations', 0) or 0,
+            _get(surveillance, 'speech_detections', 0) or 0,
+            _get(surveillance, 'multiple_persons_detected', 0) or 0,
+        ], dtype=np.int64),
+    }
+
+
+def _concat(batch: List[Dict[str, np.ndarray]], key: str):
+    """Concatenate one field across the batch, returning values, segment ids and lengths"""
+    parts = [arrays[key] for arrays in batch]
+    lengths = np.fromiter((len(p) for p in parts), dtype=np.int64, count=len(parts))
+    values = np.concatenate(parts) if parts else np.empty(0)
+    segments = np.repeat(np.arange(len(parts)), lengths)
+    return values, segments, lengths
+
+
+def _segment_sum(values, segments, n):
+    return np.bincount(segments, weights=values, minlength=n)
+
+
+def _segment_mean(values, segments, lengths):
+    sums = _segment_sum(values, segments, len(lengths))
+    return np.divide(sums, lengths, out=np.zeros(len(lengths)), where=lengths > 0)
+
+
+def _segment_variance(values, segments, lengths):
+    mean = _segment_mean(values, segments, lengths)
+    mean_sq = _segment_mean(values * values, segments, lengths)
+    return np.maximum(mean_sq - mean * mean, 0.0)
+
+
+def _segment_percentiles(values, segments, lengths, percentiles):
+    """Linear-interpolated percentiles of every segment from one sort"""
+    n = len(lengths)
+    result = np.zeros((len(percentiles), n))
+    if not len(values):
+        return result
+
+    order = np.lexsort((values, segments))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    has_values = lengths > 0
+    last = np.maximum(lengths - 1, 0)
+
+    for i, q in enumerate(percentiles):
+        position = last * (q / 100.0)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, last)
+        fraction = position - low
+        low_values = sorted_values[np.where(has_values, starts + low, 0)]
+        high_values = sorted_values[np.where(has_values, starts + high, 0)]
+        result[i] = np.where(has_values, low_values + (high_values - low_values) * fraction, 0.0)
+    return result
+
+
+def _segment_mode_share(values, segments, lengths):
+    """Share of the most frequent value in every segment"""
+    n = len(lengths)
+    max_counts = np.zeros(n, dtype=np.int64)
+    if len(values):
+        order = np.lexsort((values, segments))
+        sorted_segments = segments[order]
+        sorted_values = values[order]
+        run_starts = np.flatnonzero(np.concatenate((
+            [True],
+            (sorted_segments[1:] != sorted_segments[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+        )))
+        run_lengths = np.diff(np.append(run_starts, len(sorted_values)))
+        np.maximum.at(max_counts, sorted_segments[run_starts], run_lengths)
+    return np.divide(max_counts, lengths, out=np.zeros(n), where=lengths > 0)
+
+
+def classify_cognitive_types(avg_response_time, accuracy_pct, focus) -> np.ndarray:
+    """Apply COGNITIVE_TYPE_RULES element-wise"""
+    avg_response_time = np.asarray(avg_response_time, dtype=np.float64)
+    accuracy_pct = np.asarray(accuracy_pct, dtype=np.float64)
+    focus = np.asarray(focus, dtype=np.float64)
+
+    conditions = []
+    for _, min_accuracy, max_time, min_time, min_focus, max_focus in COGNITIVE_TYPE_RULES:
+        condition = np.ones(avg_response_time.shape, dtype=np.bool_)
+        if min_accuracy is not None:
+            condition &= accuracy_pct >= min_accuracy
+        if max_time is not None:
+            condition &= avg_response_time <= max_time
+        if min_time is not None:
+            condition &= avg_response_time > min_time
+        if min_focus is not None:
+            condition &= focus >= min_focus
+        if max_focus is not None:
+            condition &= focus < max_focus
+        conditions.append(condition)
+
+    choices = [rule[0] for rule in COGNITIVE_TYPE_RULES]
+    return np.select(conditions, choices, default=DEFAULT_COGNITIVE_TYPE)
+
+
+def classify_cognitive_type(avg_response_time: float, accuracy_pct: float, focus: float) -> str:
+    """COGNITIVE_TYPE_RULES for one submission"""
+    for name, min_accuracy, max_time, min_time, min_focus, max_focus in COGNITIVE_TYPE_RULES:
+        if min_accuracy is not None and not accuracy_pct >= min_accuracy:
+            continue
+        if max_time is not None and not avg_response_time <= max_time:
+            continue
+        if min_time is not None and not avg_response_time > min_time:
+            continue
+        if min_focus is not None and not focus >= min_focus:
+            continue
+        if max_focus is not None and not focus < max_focus:
+            continue
+        return name
+    return DEFAULT_COGNITIVE_TYPE
+
+
+def pattern_share(response_patterns: Sequence[int]) -> float:
+    """Share of the most frequent response pattern, 0 without patterns"""
+    if not response_patterns:
+        return 0.0
+    return max(Counter(response_patterns).values()) / len(response_patterns)
+
+
+def classify_pattern(share: float, has_patterns: bool) -> str:
+    """PATTERN_RULES for one submission"""
+    if has_patterns:
+        for name, threshold in PATTERN_RULES:
+            if share > threshold:
+                return name
+    return DEFAULT_PATTERN
+
+
+def dominant_pattern(response_patterns: Sequence[int]) -> str:
+    return classify_pattern(pattern_share(response_patterns), bool(response_patterns))
+
+
+def classify_patterns(mode_share, has_patterns) -> np.ndarray:
+    """Apply PATTERN_RULES element-wise, submissions without patterns are random"""
+    mode_share = np.asarray(mode_share, dtype=np.float64)
+    conditions = [(mode_share > threshold) & has_patterns for _, threshold in PATTERN_RULES]
+    choices = [name for name, _ in PATTERN_RULES]
+    return np.select(conditions, choices, default=DEFAULT_PATTERN)
+
+
+def score_arrays(batch: List[Dict[str, np.ndarray]]) -> List[Dict[str, Any]]:
+    """Score a batch of converted submissions in one vectorized pass"""
+    n = len(batch)
+    if not n:
+        return []
+
+    correct, correct_seg, question_counts = _concat(batch, 'is_correct')
+    accuracy = _segment_mean(correct.astype(np.float64), correct_seg, question_counts)
+
+    times, times_seg, _ = _concat(batch, 'response_time')
+    avg_response_time = _segment_mean(times, times_seg, question_counts)
+    response_time_variance = _segment_variance(times, times_seg, question_counts)
+
+    focus, focus_seg, focus_counts = _concat(batch, 'focus_metrics')
+    niveau_focus = _segment_mean(focus, focus_seg, focus_counts)
+
+    consistency, consistency_seg, consistency_counts = _concat(batch, 'consistency_scores')
+    score_consistante = _segment_mean(consistency, consistency_seg, consistency_counts)
+
+    hesitation, hesitation_seg, hesitation_counts = _concat(batch, 'hesitation_times')
+    hesitation_mean = _segment_mean(hesitation, hesitation_seg, hesitation_counts)
+    hesitation_percentiles = _segment_percentiles(hesitation, hesitation_seg, hesitation_counts, HESITATION_PERCENTILES)
+
+    patterns, patterns_seg, pattern_counts = _concat(batch, 'response_patterns')
+    pattern_share = _segment_mode_share(patterns, patterns_seg, pattern_counts)
+
+    violations = np.stack([arrays['violations'] for arrays in batch]).sum(axis=1)
+    score_integrite = np.maximum(0.0, 1.0 - np.minimum(violations * VIOLATION_PENALTY, 1.0))
+
+    cognitive_types = classify_cognitive_types(avg_response_time, accuracy * 100, niveau_focus)
+    dominant_patterns = classify_patterns(pattern_share, pattern_counts > 0)
+
+    results = []
+    for i in range(n):
+        statistics = {
+            "response_time_variance": float(response_time_variance[i]),
+            "response_time_std": float(np.sqrt(response_time_variance[i])),
+            "hesitation_mean": float(hesitation_mean[i]),
+            "pattern_dominance": float(pattern_share[i]),
+        }
+        for j, q in enumerate(HESITATION_PERCENTILES):
+            statistics[f"hesitation_p{q}"] = float(hesitation_percentiles[j, i])
+
+        results.append({
+            "accuracy": float(accuracy[i]),
+            "precision": float(accuracy[i]),  # For this context, precision equals accuracy
+            "avg_response_time": float(avg_response_time[i]),
+            "temp_moyen_question": float(avg_response_time[i]) / 1000,  # Convert to seconds
+            "niveau_focus": float(niveau_focus[i]),
+            "score_consistante": float(score_consistante[i]),
+            "type_cognitive": str(cognitive_types[i]),
+            "patern_dominante": str(dominant_patterns[i]),
+            "violation": int(violations[i]),
+            "score_integrité": float(score_integrite[i]),
+            "statistics": statistics,
+            "scoring_version": SCORING_VERSION,
+        })
+    return results
+
+
+def proof_fields(metrics: Dict[str, Any]) -> Dict[str, Any]:
+    """Rounded proof_identity fields, as stored by /test/submit"""
+    return {
+        "accuracy": round(metrics["accuracy"], 2),
+        "precision": round(metrics["precision"], 2),
+        "type_cognitive": metrics["type_cognitive"],
+        "temp_moyen_question": round(metrics["temp_moyen_question"], 2),
+        "niveau_focus": round(metrics["niveau_focus"], 2),
+        "violation": metrics["violation"],
+        "score_consistante": round(metrics["score_consistante"], 2),
+        "patern_dominante": metrics["patern_dominante"],
+        "score_integrité": round(metrics["score_integrité"], 2),
+        "statistics": {key: round(value, 2) for key, value in metrics["statistics"].items()},
+        "scoring_version": metrics["scoring_version"],
+    }
+
+
+def score_batch(submissions: Iterable[Any]) -> List[Dict[str, Any]]:
+    """Score N submissions (models or raw_data dicts) at once"""
+    return score_arrays([to_arrays(submission) for submission in submissions])
+
+
+def _values(items: Sequence[Any], name: str, default=None) -> List[Any]:
+    """One field of every item (all dicts or all models)"""
+    if items and isinstance(items[0], dict):
+        return [item.get(name, default) for item in items]
+    return [getattr(item, name, default) for item in items]
+
+
+def _mean(values: Sequence[float]) -> float:
+    return sum(values) / len(values) if values else 0.0
+
+
+def _percentile(sorted_values: Sequence[float], q: float) -> float:
+    """Linear-interpolated percentile, as np.percentile"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * (q / 100.0)
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def score_submission(submission: Any) -> Dict[str, Any]:
+    """Score a single submission (plain Python, same metrics as score_batch)"""
+    answers = _get(submission, 'answers') or []
+    cognitive = _get(submission, 'cognitive_data') or {}
+    surveillance = _get(submission, 'surveillance_metrics') or {}
+
+    accuracy = sum(map(bool, _values(answers, 'is_correct'))) / len(answers) if answers else 0.0
+    times = list(map(float, _values(answers, 'response_time', 0)))
+    avg_response_time = _mean(times)
+    # Same formula as the batch path (E[x²] - E[x]²) so both agree
+    squares = sum(t * t for t in times) / len(times) if times else 0.0
+    response_time_variance = max(squares - avg_response_time * avg_response_time, 0.0)
+    niveau_focus = _mean(list(map(float, _get(cognitive, 'focus_metrics') or [])))
+    score_consistante = _mean(list(map(float, _get(cognitive, 'consistency_scores') or [])))
+    hesitation = sorted(map(float, _get(cognitive, 'hesitation_times') or []))
+    patterns = list(map(int, _get(cognitive, 'response_patterns') or []))
+    share = pattern_share(patterns)
+    violations = sum(int(_get(surveillance, name, 0) or 0)
+                     for name in ('position_violations', 'speech_detections', 'multiple_persons_detected'))
+
+    statistics = {
+        "response_time_variance": response_time_variance,
+        "response_time_std": response_time_variance ** 0.5,
+        "hesitation_mean": _mean(hesitation),
+        "pattern_dominance": share,
+    }
+    for q in HESITATION_PERCENTILES:
+        statistics[f"hesitation_p{q}"] = _percentile(hesitation, q)
+
+    return {
+        "accuracy": accuracy,
+        "precision": accuracy,  # For this context, precision equals accuracy
+        "avg_response_time": avg_response_time,
+        "temp_moyen_question": avg_response_time / 1000,  # Convert to seconds
+        "niveau_focus": niveau_focus,
+        "score_consistante": score_consistante,
+        "type_cognitive": classify_cognitive_type(avg_response_time, accuracy * 100, niveau_focus),
+        "patern_dominante": classify_pattern(share, bool(patterns)),
+        "violation": violations,
+        "score_integrité": max(0.0, 1.0 - min(violations * VIOLATION_PENALTY, 1.0)),
+        "statistics": statistics,
+        "scoring_version": SCORING_VERSION,
+    }
+
+
+# =============================================================================
+# MICROBENCHMARK (python scoring.py)
+# =============================================================================
+
+def _legacy_score(submission: Dict[str, Any]) -> Dict[str, Any]:
+    """Generator-based scoring as previously done inline in submit_test (no statistics)"""
+    answers = submission['answers']
+    cognitive = submission['cognitive_data']
+    surveillance = submission['surveillance_metrics']
+    total_questions = len(answers)
+    accuracy = sum(1 for a in answers if a['is_correct']) / total_questions if total_questions else 0
+    avg_response_time = sum(a['response_time'] for a in answers) / total_questions if total_questions else 0
+    focus = cognitive['focus_metrics']
+    niveau_focus = sum(focus) / len(focus) if focus else 0
+    consistency = cognitive['consistency_scores']
+    score_consistante = sum(consistency) / len(consistency) if consistency else 0
+    pattern_counts = {}
+    for pattern in cognitive['response_patterns']:
+        pattern_counts[pattern] = pattern_counts.get(pattern, 0) + 1
+    share = max(pattern_counts.values()) / len(cognitive['response_patterns']) if pattern_counts else 0
+    violations = (surveillance['position_violations'] + surveillance['speech_detections']
+                  + surveillance['multiple_persons_detected'])
+    return {
+        "accuracy": accuracy,
+        "avg_response_time": avg_response_time,
+        "niveau_focus": niveau_focus,
+        "score_consistante": score_consistante,
+        "type_cognitive": classify_cognitive_type(avg_response_time, accuracy * 100, niveau_focus),
+        "patern_dominante": classify_pattern(share, bool(pattern_counts)),
+        "score_integrité": max(0, 1 - min(violations * VIOLATION_PENALTY, 1.0)),
+    }
+
+
+def _random_submission(rng, questions: int = 20) -> Dict[str, Any]:
+    return {
+        "answers": [
+            {
+                "question_index": i,
+                "answer": int(rng.integers(0, 4)),
+                "response_time": int(rng.integers(500, 8000)),
+                "is_correct": bool(rng.random() < 0.7),
+            }
+            for i in range(questions)
+        ],
+        "cognitive_data": {
+            "response_patterns": rng.integers(0, 4, questions).tolist(),
+            "hesitation_times": rng.integers(0, 3000, questions).tolist(),
+            "consistency_scores": rng.random(questions).tolist(),
+            "focus_metrics": rng.random(questions).tolist(),
+        },
+        "surveillance_metrics": {
+            "face_detections": int(rng.integers(0, 50)),
+            "position_violations": int(rng.integers(0, 3)),
+            "speech_detections": int(rng.integers(0, 3)),
+            "multiple_persons_detected": int(rng.integers(0, 2)),
+            "total_checks": 50,
+        },
+    }
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    submissions = [_random_submission(rng) for _ in range(5000)]
+
+    # The legacy code computed fewer metrics (no variance, hesitation percentiles or classification)
+    for label, func in [
+        ("legacy, one by one", lambda: [_legacy_score(s) for s in submissions]),
+        ("score_submission", lambda: [score_submission(s) for s in submissions]),
+        ("vectorized, one by one", lambda: [score_batch([s])[0] for s in submissions]),
+        ("vectorized, batch", lambda: score_batch(submissions)),
+    ]:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<24} {elapsed * 1000:8.1f} ms  ({elapsed / len(submissions) * 1e6:7.1f} us/submission)")
@@ -0,0 +1,403 @@
+"""
+Time-bucketed store of the webcam/microphone surveillance checks of exam
+attempts.
+
+The client posts its per-check samples (time, number of faces, position in
+frame, speech) in small batches. Samples are buffered in memory and every
+FLUSH_INTERVAL_SECONDS appended to one `surveillance_buckets` document per
+(attempt, minute) as a packed chunk (SAMPLE_DTYPE, 4 bytes per sample)
+with ArrayUnion, and the bucket's violation counters are incremented: no
+read, and several workers can write the same minute.
+
+Downsampling: once an attempt is closed (after COMPACT_GRACE_SECONDS, so
+late chunks have landed), or once its buckets are older than
+RAW_RETENTION_SECONDS, its minute buckets are folded into a single
+`surveillance_timelines` document of BIN_SECONDS bins (sparse, 14 bytes per
+non-empty bin) and deleted, in a transaction: workers sweeping the same
+attempt, or a late chunk landing in a bucket being folded, make it retry
+instead of losing samples. A timeline query reads that document plus any
+bucket not compacted yet, and returns per-bin counts and the violation
+intervals at the requested resolution.
+
+    python surveillance.py   # storage size and timeline query time for a 3-hour attempt
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_COLLECTION = 'surveillance_buckets'
+TIMELINES_COLLECTION = 'surveillance_timelines'
+FLUSH_INTERVAL_SECONDS = 2.0
+COMPACT_INTERVAL_SECONDS = 60.0
+COMPACT_GRACE_SECONDS = 120
+RAW_RETENTION_SECONDS = 3600
+WRITE_BATCH_SIZE = 500  # Firestore limit per commit
+BUCKET_MS = 60000
+BIN_SECONDS = 10
+RESOLUTIONS = (10, 30, 60, 300)
+CLOCK_SKEW_MS = 60000  # samples further than this in the future are dropped
+
+# Violation flags of a sample
+NO_FACE, MULTIPLE_FACES, POSITION, SPEECH = 1, 2, 4, 8
+VIOLATIONS = (("no_face", NO_FACE), ("multiple_faces", MULTIPLE_FACES), ("position", POSITION), ("speech", SPEECH))
+COUNTERS = ("samples",) + tuple(name for name, _ in VIOLATIONS)
+
+SAMPLE_DTYPE = np.dtype([("offset", "<u2"), ("faces", "u1"), ("flags", "u1")])  # offset: ms within the minute
+BIN_DTYPE = np.dtype([("bin", "<u4")] + [(name, "<u2") for name in COUNTERS])  # bin: BIN_SECONDS since start
+LEGACY_BIN_DTYPE = np.dtype([("bin", "<u4")] + [(name, "u1") for name in COUNTERS])  # timelines without counter_bytes
+MAX_BIN_COUNT = np.iinfo(np.uint16).max
+
+
+def parse_samples(payload: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Times (epoch ms), face counts and flags of a batch
+
+    Either {"samples": [{"t", "faces", "position_ok", "speech"}, ...]} or the
+    same fields as arrays ({"t": [...], "faces": [...], ...}).
+    """
+    if "samples" in payload:
+        samples = payload["samples"] or []
+        columns = {field: [sample.get(field) for sample in samples] for field in ("t", "faces", "position_ok", "speech")}
+    else:
+        columns = {field: payload.get(field) or [] for field in ("t", "faces", "position_ok", "speech")}
+    count = len(columns["t"])
+    if any(len(values) != count for values in columns.values()):
+        raise ValueError("t, faces, position_ok and speech must have the same length")
+    times = np.asarray(columns["t"], dtype=np.int64)
+    faces = np.clip(np.asarray([value if value is not None else 1 for value in columns["faces"]], dtype=np.int64), 0, 255)
+    position_ok = np.asarray([value is not False for value in columns["position_ok"]], dtype=bool)
+    speech = np.asarray([bool(value) for value in columns["speech"]], dtype=bool)
+    flags = (
+        np.where(faces == 0, NO_FACE, 0) | np.where(faces > 1, MULTIPLE_FACES, 0)
+        | np.where(position_ok, 0, POSITION) | np.where(speech, SPEECH, 0)
+    ).astype(np.uint8)
+    return times, faces.astype(np.uint8), flags
+
+
+def _counts(flags: np.ndarray) -> np.ndarray:
+    """Rows of COUNTERS (1, then one column per violation) for sample flags"""
+    return np.column_stack([np.ones(len(flags), dtype=np.int64)] + [(flags & flag) > 0 for _, flag in VIOLATIONS]).astype(np.int64)
+
+
+def _bucket_id(attempt_id: str, minute_ms: int) -> str:
+    return f"{attempt_id}_{minute_ms // BUCKET_MS}"
+
+
+def _to_ms(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+def _to_datetime(ms: int) -> datetime:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def _bucket_rows(bucket: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample times (epoch ms) and count rows of a minute bucket"""
+    samples = np.frombuffer(b"".join(bytes(chunk) for chunk in bucket.get("chunks") or []), dtype=SAMPLE_DTYPE)
+    times = _to_ms(bucket["minute"]) + samples["offset"].astype(np.int64)
+    return times, _counts(samples["flags"])
+
+
+def _timeline_rows(timeline: Optional[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Bin start times (epoch ms) and count rows of a compacted timeline"""
+    if not timeline:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, len(COUNTERS)), dtype=np.int64)
+    dtype = BIN_DTYPE if timeline.get("counter_bytes") == 2 else LEGACY_BIN_DTYPE
+    bins = np.frombuffer(bytes(timeline.get("bins") or b""), dtype=dtype)
+    times = _to_ms(timeline["start"]) + bins["bin"].astype(np.int64) * BIN_SECONDS * 1000
+    return times, np.column_stack([bins[name] for name in COUNTERS]).astype(np.int64).reshape(-1, len(COUNTERS))
+
+
+def aggregate(times: np.ndarray, rows: np.ndarray, start_ms: int, resolution: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Bin indexes (from start_ms) and summed counts of the non-empty bins"""
+    if not len(times):
+        return np.zeros(0, dtype=np.int64), np.zeros((0, len(COUNTERS)), dtype=np.int64)
+    index = (times - start_ms) // (resolution * 1000)
+    bins, inverse = np.unique(index, return_inverse=True)
+    counts = np.zeros((len(bins), len(COUNTERS)), dtype=np.int64)
+    np.add.at(counts, inverse, rows)
+    return bins, counts
+
+
+def violation_intervals(bins: np.ndarray, counts: np.ndarray, start_ms: int, resolution: int) -> List[Dict[str, Any]]:
+    """Runs of consecutive bins with a violation, per violation type"""
+    intervals = []
+    for column, (name, _) in enumerate(VIOLATIONS, start=1):
+        hit = counts[:, column] > 0
+        flagged, occurrences = bins[hit], counts[hit, column]
+        if not len(flagged):
+            continue
+        # A new run starts wherever the previous flagged bin is not adjacent
+        starts = np.flatnonzero(np.diff(flagged, prepend=flagged[0] - 2) > 1)
+        ends = np.append(starts[1:], len(flagged))
+        for first, last in zip(starts.tolist(), ends.tolist()):
+            intervals.append({
+                "type": name,
+                "start": _to_datetime(start_ms + int(flagged[first]) * resolution * 1000),
+                "end": _to_datetime(start_ms + (int(flagged[last - 1]) + 1) * resolution * 1000),
+                "samples": int(occurrences[first:last].sum()),
+            })
+    intervals.sort(key=lambda interval: interval["start"])
+    return intervals
+
+
+class SurveillanceStore:
+    def __init__(self, db):
+        self.db = db
+        # (attempt ID, minute start ms) -> [exam ID, [(times, faces, flags), ...]]
+        self._pending: Dict[Tuple[str, int], list] = {}
+        self._closed: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._last_sweep = 0.0
+        self.samples = 0
+        self.writes = 0
+        self.compactions = 0
+
+    # -- ingestion ---------------------------------------------------------------
+
+    def add(self, attempt_id: str, exam_id: str, times: np.ndarray, faces: np.ndarray, flags: np.ndarray,
+            not_before: Optional[datetime] = None) -> int:
+        """Buffer a batch of samples, returns how many were kept"""
+        now_ms = int(time.time() * 1000)
+        keep = times <= now_ms + CLOCK_SKEW_MS
+        if not_before is not None:
+            keep &= times >= _to_ms(not_before) - CLOCK_SKEW_MS
+        times, faces, flags = times[keep], faces[keep], flags[keep]
+        minutes = times - times % BUCKET_MS
+        with self._lock:
+            for minute in np.unique(minutes).tolist():
+                in_minute = minutes == minute
+                entry = self._pending.setdefault((attempt_id, minute), [exam_id, []])
+                entry[1].append((times[in_minute], faces[in_minute], flags[in_minute]))
+            self.samples += len(times)
+        return len(times)
+
+    def close(self, attempt_id: str):
+        """The attempt is over: downsample it once its last samples are written"""
+        with self._lock:
+            self._closed.setdefault(attempt_id, time.monotonic())
+
+    def flush(self) -> int:
+        """Append buffered samples to their minute buckets"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        writes = []
+        for (attempt_id, minute), (exam_id, parts) in pending.items():
+            times = np.concatenate([part[0] for part in parts])
+            samples = np.zeros(len(times), dtype=SAMPLE_DTYPE)
+            samples["offset"] = times - minute
+            samples["faces"] = np.concatenate([part[1] for part in parts])
+            samples["flags"] = np.concatenate([part[2] for part in parts])
+            totals = _counts(samples["flags"]).sum(axis=0).tolist()
+            writes.append(((attempt_id, minute), {
+                "attempt_id": attempt_id,
+                "exam_id": exam_id,
+                "minute": _to_datetime(minute),
+                "chunks": firestore.ArrayUnion([samples.tobytes()]),
+                **{name: firestore.Increment(value) for name, value in zip(COUNTERS, totals)},
+            }))
+
+        written = 0
+        for i in range(0, len(writes), WRITE_BATCH_SIZE):
+            chunk = writes[i:i + WRITE_BATCH_SIZE]
+            batch = self.db.batch()
+            for (attempt_id, minute), data in chunk:
+                batch.set(self.db.collection(BUCKETS_COLLECTION).document(_bucket_id(attempt_id, minute)), data, merge=True)
+            try:
+                batch.commit()
+                written += len(chunk)
+            except Exception:
+                logger.exception("Surveillance samples not written, kept for the next flush")
+                with self._lock:
+                    for key, _ in chunk:
+                        entry = self._pending.setdefault(key, [pending[key][0], []])
+                        entry[1][:0] = pending[key][1]
+        self.writes += written
+        return written
+
+    # -- downsampling ------------------------------------------------------------
+
+    def _buckets(self, attempt_id: str, transaction=None) -> List[Any]:
+        query = self.db.collection(BUCKETS_COLLECTION).where('attempt_id', '==', attempt_id)
+        return list(query.stream(transaction=transaction))
+
+    def compact(self, attempt_id: str) -> int:
+        """Fold the attempt's settled minute buckets into its BIN_SECONDS timeline"""
+        timeline_ref = self.db.collection(TIMELINES_COLLECTION).document(attempt_id)
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def fold(transaction):
+            cutoff_ms = int(time.time() * 1000) - COMPACT_GRACE_SECONDS * 1000
+            buckets = sorted(
+                (doc for doc in self._buckets(attempt_id, transaction) if _to_ms(doc.to_dict()["minute"]) + BUCKET_MS <= cutoff_ms),
+                key=lambda doc: doc.to_dict()["minute"]
+            )[:WRITE_BATCH_SIZE - 1]  # the timeline and the deletes fit one commit, the rest waits for the next sweep
+            if not buckets:
+                return 0
+            timeline_doc = timeline_ref.get(transaction=transaction)
+            timeline = timeline_doc.to_dict() if timeline_doc.exists else None
+
+            parts = [_timeline_rows(timeline)] + [_bucket_rows(doc.to_dict()) for doc in buckets]
+            times = np.concatenate([part[0] for part in parts])
+            rows = np.concatenate([part[1] for part in parts])
+            start_ms = int(times.min()) - int(times.min()) % (BIN_SECONDS * 1000)
+            if timeline:
+                start_ms = min(start_ms, _to_ms(timeline["start"]))
+            bins, counts = aggregate(times, rows, start_ms, BIN_SECONDS)
+            if counts.max(initial=0) > MAX_BIN_COUNT:
+                logger.warning("Surveillance timeline of %s: bin counts above %d clipped", attempt_id, MAX_BIN_COUNT)
+            packed = np.zeros(len(bins), dtype=BIN_DTYPE)
+            packed["bin"] = bins
+            for column, name in enumerate(COUNTERS):
+                packed[name] = np.minimum(counts[:, column], MAX_BIN_COUNT)
+
+            transaction.set(timeline_ref, {
+                "attempt_id": attempt_id,
+                "exam_id": buckets[0].to_dict().get("exam_id"),
+                "start": _to_datetime(start_ms),
+                "resolution": BIN_SECONDS,
+                "counter_bytes": 2,
+                "bins": packed.tobytes(),
+                **{name: int(total) for name, total in zip(COUNTERS, counts.sum(axis=0).tolist())},
+                "updated_at": datetime.now(timezone.utc),
+            })
+            for doc in buckets:
+                transaction.delete(doc.reference)
+            return len(buckets)
+
+        compacted = fold(transaction)
+        if compacted:
+            self.compactions += 1
+        return compacted
+
+    def sweep(self) -> int:
+        """Downsample closed attempts past the grace period and buckets older than the retention"""
+        now = time.monotonic()
+        with self._lock:
+            due = [attempt_id for attempt_id, closed_at in self._closed.items() if now - closed_at >= COMPACT_GRACE_SECONDS]
+            for attempt_id in due:
+                del self._closed[attempt_id]
+        old = self.db.collection(BUCKETS_COLLECTION).where(
+            'minute', '<', _to_datetime(int(time.time() * 1000) - RAW_RETENTION_SECONDS * 1000)
+        ).limit(WRITE_BATCH_SIZE).stream()
+        attempts = set(due) | {doc.to_dict().get('attempt_id') for doc in old}
+        compacted = 0
+        for attempt_id in filter(None, attempts):
+            try:
+                compacted += self.compact(attempt_id)
+            except Exception:
+                logger.exception("Surveillance timeline of %s not compacted", attempt_id)
+        return compacted
+
+    # -- queries -----------------------------------------------------------------
+
+    def timeline(self, attempt_id: str, resolution: int = BIN_SECONDS) -> Dict[str, Any]:
+        """Per-bin counts and violation intervals of an attempt"""
+        timeline_doc = self.db.collection(TIMELINES_COLLECTION).document(attempt_id).get()
+        parts = [_timeline_rows(timeline_doc.to_dict() if timeline_doc.exists else None)]
+        parts += [_bucket_rows(doc.to_dict()) for doc in self._buckets(attempt_id)]
+        times = np.concatenate([part[0] for part in parts])
+        rows = np.concatenate([part[1] for part in parts])
+        if not len(times):
+            return {"attempt_id": attempt_id, "resolution": resolution, "start": None,
+                    "totals": dict.fromkeys(COUNTERS, 0), "bins": [], "violations": []}
+        start_ms = int(times.min()) - int(times.min()) % (resolution * 1000)
+        bins, counts = aggregate(times, rows, start_ms, resolution)
+        return {
+            "attempt_id": attempt_id,
+            "resolution": resolution,
+            "start": _to_datetime(start_ms),
+            "end": _to_datetime(start_ms + (int(bins[-1]) + 1) * resolution * 1000),
+            "totals": dict(zip(COUNTERS, counts.sum(axis=0).tolist())),
+            "bins": [
+                {"t": _to_datetime(start_ms + index * resolution * 1000), **dict(zip(COUNTERS, row))}
+                for index, row in zip(bins.tolist(), counts.tolist())
+            ],
+            "violations": violation_intervals(bins, counts, start_ms, resolution),
+        }
+
+    # -- background --------------------------------------------------------------
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+                if time.monotonic() - self._last_sweep >= COMPACT_INTERVAL_SECONDS:
+                    self._last_sweep = time.monotonic()
+                    await asyncio.to_thread(self.sweep)
+            except Exception:
+                logger.exception("Surveillance flush failed")
+
+    def start(self, interval: float = FLUSH_INTERVAL_SECONDS):
+        self._last_sweep = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.to_thread(self.flush)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_buckets": len(self._pending),
+            "closed_attempts": len(self._closed),
+            "samples": self.samples,
+            "writes": self.writes,
+            "compactions": self.compactions,
+        }
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    start_ms = 1_700_000_000_000
+    times = start_ms + np.arange(0, 3 * 3600 * 1000, 2000)  # one check every 2 s for 3 hours
+    faces = np.where(rng.random(len(times)) < 0.02, 0, 1) + (rng.random(len(times)) < 0.005)
+    flags = parse_samples({"t": times.tolist(), "faces": faces.tolist(),
+                           "position_ok": (rng.random(len(times)) > 0.03).tolist(),
+                           "speech": (rng.random(len(times)) < 0.01).tolist()})[2]
+
+    minutes = times - times % BUCKET_MS
+    buckets = []
+    for minute in np.unique(minutes):
+        samples = np.zeros(int((minutes == minute).sum()), dtype=SAMPLE_DTYPE)
+        samples["offset"] = times[minutes == minute] - minute
+        samples["flags"] = flags[minutes == minute]
+        buckets.append({"minute": _to_datetime(int(minute)), "chunks": [samples.tobytes()]})
+    print(f"{len(times)} samples: {len(buckets)} minute buckets of {len(buckets[0]['chunks'][0])} bytes "
+          f"(vs. {len(times)} event documents)")
+
+    started = time.perf_counter()
+    parts = [_bucket_rows(bucket) for bucket in buckets]
+    bins, counts = aggregate(np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]), start_ms, BIN_SECONDS)
+    packed = np.zeros(len(bins), dtype=BIN_DTYPE)
+    packed["bin"] = bins
+    for column, name in enumerate(COUNTERS):
+        packed[name] = counts[:, column]
+    print(f"downsampled to {BIN_SECONDS} s bins: {packed.nbytes} bytes in one document, "
+          f"{(time.perf_counter() - started) * 1000:.1f} ms")
+
+    for resolution in RESOLUTIONS:
+        started = time.perf_counter()
+        timeline_times, rows = _timeline_rows({"start": _to_datetime(start_ms), "counter_bytes": 2, "bins": packed.tobytes()})
+        bins, counts = aggregate(timeline_times, rows, start_ms, resolution)
+        intervals = violation_intervals(bins, counts, start_ms, resolution)
+        print(f"timeline at {resolution:>3} s: {len(bins)} bins, {len(intervals)} violation intervals, "
+              f"{(time.perf_counter() - started) * 1000:.2f} ms")
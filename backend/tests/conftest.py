@@ -0,0 +1,15 @@
+import os
+import sys
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.firestore import Client
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# A real client (no network until a query runs) instead of the service account
+_client = Client(project="test-project", credentials=AnonymousCredentials())
+credentials.Certificate = lambda *args, **kwargs: None
+firebase_admin.initialize_app = lambda *args, **kwargs: firebase_admin._apps.setdefault("[DEFAULT]", object())
+firestore.client = lambda *args, **kwargs: _client
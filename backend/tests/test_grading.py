@@ -0,0 +1,26 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from grading import UNANSWERED, AnswerKey  # noqa: E402
+
+QUESTIONS = [
+    {"id": "q1", "question_number": 1, "type": "multiple_choice", "options": ["a", "b", "c"], "correct_answer": 2, "points": 1},
+    {"id": "q2", "question_number": 2, "type": "true_false", "options": [], "correct_answer": 0, "points": 1},
+]
+
+
+def test_out_of_range_choices_count_as_unanswered():
+    key = AnswerKey(QUESTIONS)
+    for value in (99999, -1, 3, "99999", "-5", 2.5, [1], {"x": 1}):
+        assert key.encode({"0": value, "1": value})[0] == UNANSWERED
+    assert key.encode({"1": 2}).tolist() == [UNANSWERED, UNANSWERED]
+
+
+def test_out_of_range_choices_do_not_break_grading():
+    key = AnswerKey(QUESTIONS)
+    assert key.grade({"0": 99999, "1": 0})["correct_count"] == 1
+    results = key.grade_many([{"0": 99999}, {"0": "c", "1": "0"}, None])
+    assert [result["correct_count"] for result in results] == [0, 2, 0]
+    assert [result["answered_count"] for result in results] == [0, 2, 0]
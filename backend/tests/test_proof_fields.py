@@ -0,0 +1,13 @@
+import main
+
+
+def test_select_proof_fields_builds_a_valid_projection():
+    query = main.select_proof_fields(main.db.collection("proof_identity"))
+    projected = [field.field_path for field in query._to_protobuf().select.fields]
+    assert "`score_integrité`" in projected
+    assert len(projected) == len(main.PROOF_SUMMARY_FIELDS)
+
+
+def test_select_proof_fields_keeps_raw_queries_whole():
+    collection = main.db.collection("proof_identity")
+    assert main.select_proof_fields(collection, "raw") is collection
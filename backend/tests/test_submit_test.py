@@ -0,0 +1,190 @@
+import asyncio
+import copy
+import os
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+from google.api_core.exceptions import NotFound, ServiceUnavailable
+
+import main
+import raw_store
+
+TOKEN = "session_s1"
+
+
+class FakeRef:
+    """Document reference of FakeDb; a write outside a batch lands at once"""
+
+    def __init__(self, db, path: str):
+        self.db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def set(self, data, merge=False):
+        self.db.docs[self.path] = dict(data)
+
+    def update(self, data):
+        self.db.docs[self.path].update(data)
+
+    def delete(self):
+        self.db.docs.pop(self.path, None)
+
+
+class FakeCollection:
+    def __init__(self, db, name: str):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id: str) -> FakeRef:
+        return FakeRef(self.db, f"{self.name}/{doc_id}")
+
+
+class FakeBatch:
+    """Stages writes and applies them all, or none, on commit, like a WriteBatch"""
+
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(("set", ref.path, data))
+
+    def update(self, ref, data):
+        self.writes.append(("update", ref.path, data))
+
+    def delete(self, ref):
+        self.writes.append(("delete", ref.path, None))
+
+    def commit(self):
+        self.db.commits += 1
+        if self.db.failure is not None:
+            raise self.db.failure
+        for kind, path, _ in self.writes:
+            if kind == "update" and path not in self.db.docs:
+                raise NotFound(f"No document to update: {path}")
+        for kind, path, data in self.writes:
+            if kind == "set":
+                self.db.docs[path] = dict(data)
+            elif kind == "update":
+                self.db.docs[path].update(data)
+            else:
+                self.db.docs.pop(path, None)
+
+
+class FakeDb:
+    def __init__(self, docs):
+        self.docs = docs
+        self.commits = 0
+        self.failure = None
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+
+def submission(violations: int = 2) -> main.TestSubmission:
+    return main.TestSubmission(
+        student_id="s1",
+        field="info",
+        answers=[
+            {"question_index": i, "answer": i % 4, "response_time": 3000 + 500 * i, "is_correct": i % 3 != 0}
+            for i in range(10)
+        ],
+        total_time=60000,
+        cognitive_data={
+            "response_patterns": [1, 2, 1, 3],
+            "hesitation_times": [200, 350, 150],
+            "consistency_scores": [0.8, 0.9],
+            "focus_metrics": [0.7, 0.95],
+        },
+        surveillance_metrics={
+            "face_detections": 40,
+            "position_violations": violations,
+            "speech_detections": 0,
+            "multiple_persons_detected": 0,
+            "total_checks": 40,
+        },
+        alerts_history=[{"message": "Visage hors cadre", "type": "position", "timestamp": 1700000000}],
+    )
+
+
+@pytest.fixture
+def fake_db(monkeypatch, tmp_path):
+    db = FakeDb({
+        "students/s1": {"id": "s1", "name": "Student", "field": "info", "has_completed_test": False},
+        f"sessions/{TOKEN}": {"user_id": "s1", "role": "student"},
+    })
+    monkeypatch.setattr(main, "db", db)
+    monkeypatch.setattr(main, "raw_data_store", raw_store.LocalRawStore(str(tmp_path)))
+    monkeypatch.setattr(main, "verify_token", lambda token, role=None: {"user_id": "s1", "role": "student"})
+    monkeypatch.setattr(main.identity_profiles, "verify", lambda student_id, proof: None)
+    monkeypatch.setattr(main.identity_profiles, "add", lambda student_id, proof: None)
+    return db
+
+
+def submit(test_submission: main.TestSubmission):
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=TOKEN)
+    return asyncio.run(main.submit_test(test_submission, credentials))
+
+
+def raw_files() -> list:
+    return sorted(os.listdir(main.raw_data_store.directory))
+
+
+def test_submit_writes_everything_in_one_commit(fake_db):
+    result = submit(submission())
+
+    assert fake_db.commits == 1
+    proof_id = result["proof_id"]
+    assert fake_db.docs[f"proof_identity/{proof_id}"]["id_student"] == "s1"
+    assert fake_db.docs["students/s1"]["has_completed_test"] is True
+    assert [path for path in fake_db.docs if path.startswith("fraude/")]
+    assert f"sessions/{TOKEN}" not in fake_db.docs
+    assert raw_files() == [f"{proof_id}.bin"]
+
+
+@pytest.mark.parametrize("failure, status_code", [
+    (ServiceUnavailable("commit lost"), 500),
+    (NotFound("student deleted"), 404),
+])
+def test_failed_commit_writes_nothing(fake_db, failure, status_code):
+    before = copy.deepcopy(fake_db.docs)
+    fake_db.failure = failure
+
+    with pytest.raises(HTTPException) as error:
+        submit(submission())
+
+    assert error.value.status_code == status_code
+    assert fake_db.commits == 1
+    assert fake_db.docs == before
+    assert raw_files() == []
+
+
+def test_missing_student_writes_nothing(fake_db):
+    del fake_db.docs["students/s1"]
+    before = copy.deepcopy(fake_db.docs)
+
+    with pytest.raises(HTTPException) as error:
+        submit(submission())
+
+    assert error.value.status_code == 404
+    assert fake_db.docs == before
+    assert raw_files() == []
+
+
+def test_failure_before_commit_writes_nothing(fake_db, monkeypatch):
+    def disk_full(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(main.raw_data_store, "put", disk_full)
+    before = copy.deepcopy(fake_db.docs)
+
+    with pytest.raises(HTTPException) as error:
+        submit(submission(violations=0))
+
+    assert error.value.status_code == 500
+    assert fake_db.commits == 0
+    assert fake_db.docs == before
@@ -0,0 +1,186 @@
+"""
+Similarity grading of short_answer questions.
+
+Answers and the accepted answers of a question are normalized (case,
+accents, punctuation, spacing), then compared with the higher of a word
+Jaccard (word order, extra words) and a character trigram Dice (typos)
+similarity; the best accepted answer wins. At FULL_CREDIT_THRESHOLD or
+above the answer gets every point, at PARTIAL_CREDIT_THRESHOLD or above
+half of them. Both thresholds can be set per question
+(full_credit_threshold / partial_credit_threshold).
+
+Scores are memoized per normalized answer, so an answer given by hundreds
+of students is compared once; when a batch still has more than
+POOL_THRESHOLD distinct answers they are scored in a process pool.
+
+    python text_grading.py   # 10k answers for one question: plain, memoized, process pool
+"""
+import os
+import re
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+FULL_CREDIT_THRESHOLD = 0.85
+PARTIAL_CREDIT_THRESHOLD = 0.6
+PARTIAL_CREDIT = 0.5
+NGRAM_SIZE = 3
+MEMO_SIZE = 50000  # distinct normalized answers kept per question
+POOL_THRESHOLD = 2000
+POOL_CHUNK_SIZE = 500
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def normalize(text: Any) -> str:
+    """Lowercase, without accents, punctuation or repeated spaces"""
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", text)).strip()
+
+
+def features(normalized: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """Word set and character n-gram set of a normalized text"""
+    padded = f" {normalized} "
+    ngrams = frozenset(padded[i:i + NGRAM_SIZE] for i in range(max(1, len(padded) - NGRAM_SIZE + 1)))
+    return frozenset(normalized.split()), ngrams
+
+
+def similarity(a: Tuple[FrozenSet[str], FrozenSet[str]], b: Tuple[FrozenSet[str], FrozenSet[str]]) -> float:
+    words_a, grams_a = a
+    words_b, grams_b = b
+    union = len(words_a | words_b)
+    jaccard = len(words_a & words_b) / union if union else 0.0
+    total = len(grams_a) + len(grams_b)
+    dice = 2 * len(grams_a & grams_b) / total if total else 0.0
+    return max(jaccard, dice)
+
+
+class TextScorer:
+    """Credit (0, PARTIAL_CREDIT or 1) of answers to one question"""
+
+    def __init__(self, accepted: Iterable[str], full_threshold: Optional[float] = None, partial_threshold: Optional[float] = None):
+        self.accepted = [normalize(answer) for answer in accepted if str(answer).strip()]
+        self.full_threshold = FULL_CREDIT_THRESHOLD if full_threshold is None else float(full_threshold)
+        self.partial_threshold = PARTIAL_CREDIT_THRESHOLD if partial_threshold is None else float(partial_threshold)
+        self._exact = set(self.accepted)
+        self._features = [features(answer) for answer in self.accepted]
+        self._memo: Dict[str, float] = {}
+        self.memo_hits = 0
+
+    @classmethod
+    def from_question(cls, question: Dict[str, Any]) -> Optional["TextScorer"]:
+        """Scorer of a question document, None when it has no accepted answers"""
+        accepted = question.get("accepted_answers") or []
+        if not any(str(answer).strip() for answer in accepted):
+            return None
+        return cls(accepted, question.get("full_credit_threshold"), question.get("partial_credit_threshold"))
+
+    def config(self) -> tuple:
+        return self.accepted, self.full_threshold, self.partial_threshold
+
+    def similarity(self, normalized: str) -> float:
+        if normalized in self._exact:
+            return 1.0
+        if not normalized:
+            return 0.0
+        answer = features(normalized)
+        return max(similarity(answer, accepted) for accepted in self._features)
+
+    def credit_of(self, normalized: str) -> float:
+        value = self.similarity(normalized)
+        if value >= self.full_threshold:
+            return 1.0
+        if value >= self.partial_threshold:
+            return PARTIAL_CREDIT
+        return 0.0
+
+    def _remember(self, normalized: str, credit: float):
+        if len(self._memo) >= MEMO_SIZE:
+            self._memo.clear()
+        self._memo[normalized] = credit
+
+    def credit(self, answer: Any) -> float:
+        normalized = normalize(answer)
+        credit = self._memo.get(normalized)
+        if credit is None:
+            credit = self.credit_of(normalized)
+            self._remember(normalized, credit)
+        else:
+            self.memo_hits += 1
+        return credit
+
+    def credits(self, answers: List[Any], parallel: bool = True) -> List[float]:
+        """Credits of many answers: distinct unseen answers are scored once, in a pool when many"""
+        # Identical raw answers are normalized once too
+        normalized_of = {answer: normalize(answer) for answer in set(map(str, answers))}
+        normalized = [normalized_of[str(answer)] for answer in answers]
+        unseen = list({text for text in normalized if text not in self._memo})
+        self.memo_hits += len(normalized) - len(unseen)
+        if parallel and len(unseen) > POOL_THRESHOLD:
+            chunks = [unseen[i:i + POOL_CHUNK_SIZE] for i in range(0, len(unseen), POOL_CHUNK_SIZE)]
+            results = get_pool().map(_score_chunk, [self.config()] * len(chunks), chunks)
+            scored = [credit for chunk in results for credit in chunk]
+        else:
+            scored = [self.credit_of(text) for text in unseen]
+        # The memo may be cleared while filling, so read the batch from a local map
+        batch = dict(zip(unseen, scored))
+        for text, credit in batch.items():
+            self._remember(text, credit)
+        return [batch[text] if text in batch else self._memo[text] for text in normalized]
+
+
+def _score_chunk(config: tuple, texts: List[str]) -> List[float]:
+    accepted, full_threshold, partial_threshold = config
+    scorer = TextScorer(accepted, full_threshold, partial_threshold)
+    return [scorer.credit_of(text) for text in texts]
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+if __name__ == "__main__":
+    import random
+
+    rng = random.Random(0)
+    accepted = ["La photosynthèse transforme l'énergie lumineuse en énergie chimique",
+                "conversion de la lumière en énergie chimique par les plantes"]
+    words = ("la les plante plantes lumière soleil énergie chimique eau glucose oxygène transforme "
+             "produit absorbe chlorophylle feuille racine cellule respiration carbone dioxyde").split()
+    popular = [accepted[0], accepted[0].upper() + " !", "les plantes transforment la lumiere en energie chimique",
+               "la plante produit de l'oxygène", "je ne sais pas"]
+    answers = [
+        rng.choice(popular) if rng.random() < 0.6 else " ".join(rng.choices(words, k=rng.randint(3, 12)))
+        for _ in range(10000)
+    ]
+
+    def plain():
+        scorer = TextScorer(accepted)
+        return [scorer.credit_of(normalize(answer)) for answer in answers]
+
+    for label, func in [
+        ("no memo", plain),
+        ("memoized", lambda: TextScorer(accepted).credits(answers, parallel=False)),
+        ("memoized + process pool", lambda: TextScorer(accepted).credits(answers)),
+        ("  again, pool warm", lambda: TextScorer(accepted).credits(answers)),
+    ]:
+        start = time.perf_counter()
+        credits = func()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<24} {elapsed * 1000:8.1f} ms  mean credit {sum(credits) / len(credits):.3f}")
+    shutdown_pool()
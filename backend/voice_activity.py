@@ -0,0 +1,311 @@
+"""
+Server-side voice-activity detection on the microphone stream of exam
+attempts.
+
+The client posts short chunks of 16-bit little-endian mono PCM as it
+records them. Each chunk is cut into FRAME_SECONDS frames, and every frame
+is classified in one vectorized pass from its energy and spectrum:
+
+- energy above the stream's adaptive noise floor by ENERGY_MARGIN_DB (and
+  above an absolute MIN_LEVEL_DB);
+- most of the energy in the voice band (VOICE_BAND_HZ);
+- a peaky, not flat, spectrum (spectral flatness below MAX_FLATNESS), which
+  separates voice from fans, hiss and other broadband noise.
+
+Speech starts after ONSET_FRAMES consecutive voiced frames and ends after
+HANGOVER_FRAMES unvoiced ones. Segments of at least MIN_SEGMENT_SECONDS
+are returned as events; a segment reaching REPORT_SECONDS is reported once
+as fraud.
+
+Only the stream state (noise floor, current segment, the samples of an
+unfinished frame) is kept between chunks, never the audio. It lives in
+`audio_streams/{attempt_id}` (with `expires_at` for a Firestore TTL
+policy), so chunks may reach any worker: a state is written back with a
+precondition on the version it was read at, and a chunk that raced with
+another one is analysed again on the newer state. Chunks are analysed in a
+process pool with a bounded number in flight.
+
+    python voice_activity.py   # frame accuracy on synthetic audio and x-real-time throughput
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from google.api_core.exceptions import AlreadyExists, Conflict, FailedPrecondition
+
+STREAMS_COLLECTION = 'audio_streams'
+SAMPLE_RATES = (8000, 16000, 22050, 24000, 32000, 44100, 48000)
+MAX_CHUNK_SECONDS = 10
+FRAME_SECONDS = 0.02
+ENERGY_MARGIN_DB = 6.0
+MIN_LEVEL_DB = -50.0  # dBFS
+VOICE_BAND_HZ = (80.0, 4000.0)
+MIN_VOICE_BAND_RATIO = 0.7
+MAX_FLATNESS = 0.35
+NOISE_ADAPTATION = 0.05
+ONSET_FRAMES = 5        # 100 ms
+HANGOVER_FRAMES = 15    # 300 ms
+MIN_SEGMENT_SECONDS = 0.3
+REPORT_SECONDS = 3.0
+MAX_IN_FLIGHT_PER_WORKER = 8
+STREAM_IDLE_SECONDS = 3600
+MAX_STATE_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+
+def new_state(sample_rate: int) -> Dict[str, Any]:
+    return {
+        "sample_rate": sample_rate,
+        "leftover": b"",       # samples of an unfinished frame
+        "frames": 0,           # frames analysed so far
+        "noise_db": None,
+        "run": 0,              # consecutive voiced frames
+        "silence": 0,          # consecutive unvoiced frames in a segment
+        "segment_start": None,
+        "last_voiced": None,
+        "reported": False,
+    }
+
+
+def frame_features(frames: np.ndarray, sample_rate: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Level (dBFS), voice-band energy ratio and spectral flatness of each frame"""
+    level = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+    power = np.abs(np.fft.rfft(frames * np.hanning(frames.shape[1]).astype(np.float32), axis=1)) ** 2 + 1e-12
+    freqs = np.fft.rfftfreq(frames.shape[1], 1.0 / sample_rate)
+    in_band = (freqs >= VOICE_BAND_HZ[0]) & (freqs <= VOICE_BAND_HZ[1])
+    total = power.sum(axis=1)
+    band_ratio = power[:, in_band].sum(axis=1) / total
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / (total / power.shape[1])
+    return level, band_ratio, flatness
+
+
+def process_chunk(state: Dict[str, Any], pcm: bytes) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Classify the frames of a chunk, returns the new stream state and the chunk's results"""
+    sample_rate = state["sample_rate"]
+    frame_size = int(sample_rate * FRAME_SECONDS)
+    data = state["leftover"] + pcm
+    usable = len(data) // 2 // frame_size * frame_size
+    state = {**state, "leftover": data[usable * 2:]}
+    samples = np.frombuffer(data[:usable * 2], dtype="<i2").astype(np.float32) / 32768.0
+    frames = samples.reshape(-1, frame_size)
+    result = {"frames": len(frames), "voiced_frames": 0, "events": [], "report": None}
+    if not len(frames):
+        return state, result
+
+    level, band_ratio, flatness = frame_features(frames, sample_rate)
+    noise_db = state["noise_db"]
+    if noise_db is None:
+        noise_db = float(np.percentile(level, 10))
+    # The floor follows the quietest frames down at once, and the unvoiced ones up slowly
+    noise_db = min(noise_db, float(np.percentile(level, 5)) if len(level) >= 20 else noise_db)
+    voiced = (
+        (level > noise_db + ENERGY_MARGIN_DB) & (level > MIN_LEVEL_DB)
+        & (band_ratio >= MIN_VOICE_BAND_RATIO) & (flatness <= MAX_FLATNESS)
+    )
+    if (~voiced).any():
+        noise_db += NOISE_ADAPTATION * (float(np.median(level[~voiced])) - noise_db)
+    state["noise_db"] = noise_db
+    result["voiced_frames"] = int(voiced.sum())
+
+    first = state["frames"]
+    run, silence = state["run"], state["silence"]
+    segment_start, last_voiced, reported = state["segment_start"], state["last_voiced"], state["reported"]
+    for index, is_voiced in enumerate(voiced.tolist(), start=first):
+        if is_voiced:
+            run += 1
+            silence = 0
+            last_voiced = index
+            if segment_start is None and run >= ONSET_FRAMES:
+                segment_start = index - run + 1
+        else:
+            run = 0
+            if segment_start is not None:
+                silence += 1
+                if silence >= HANGOVER_FRAMES:
+                    duration = (last_voiced + 1 - segment_start) * FRAME_SECONDS
+                    if duration >= MIN_SEGMENT_SECONDS:
+                        result["events"].append(_segment(segment_start, last_voiced))
+                    segment_start, silence, reported = None, 0, False
+        if segment_start is not None and not reported and (last_voiced + 1 - segment_start) * FRAME_SECONDS >= REPORT_SECONDS:
+            result["report"] = _segment(segment_start, last_voiced)
+            reported = True
+    state.update(frames=first + len(frames), run=run, silence=silence,
+                 segment_start=segment_start, last_voiced=last_voiced, reported=reported)
+    return state, result
+
+
+def to_wav(pcm: bytes, sample_rate: int) -> bytes:
+    """A chunk as a WAV file, e.g. to keep it as evidence"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def _segment(start_frame: int, last_frame: int) -> Dict[str, float]:
+    return {
+        "start": round(start_frame * FRAME_SECONDS, 2),
+        "end": round((last_frame + 1) * FRAME_SECONDS, 2),
+        "duration": round((last_frame + 1 - start_frame) * FRAME_SECONDS, 2),
+    }
+
+
+class VoiceActivityDetector:
+    """Per-attempt stream states (in Firestore), analysed in a bounded process pool"""
+
+    def __init__(self, db=None, workers: Optional[int] = None):
+        self.db = db
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = self.workers * MAX_IN_FLIGHT_PER_WORKER
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._seen: Dict[str, float] = {}
+        self.in_flight = 0
+        self.seconds = 0.0
+        self.rejected_busy = 0
+        self.pool_restarts = 0
+        self.conflicts = 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _reset_pool(self, broken: ProcessPoolExecutor):
+        # Chunks in flight may all fail on the same pool: only the first replaces it
+        if self._pool is broken:
+            logger.warning("Voice activity pool broken, restarting it")
+            self._pool = None
+            self.pool_restarts += 1
+            broken.shutdown(wait=False, cancel_futures=True)
+
+    def _forget_idle(self, now: float):
+        for attempt_id in [key for key, seen in self._seen.items() if now - seen > STREAM_IDLE_SECONDS]:
+            self.forget(attempt_id)
+
+    async def _analyse(self, state: Dict[str, Any], pcm: bytes) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        pool = self._get_pool()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, process_chunk, state, pcm)
+        except BrokenProcessPool:
+            # A worker died: the state sent is unchanged, replace the pool and retry once
+            self._reset_pool(pool)
+            return await asyncio.get_running_loop().run_in_executor(self._get_pool(), process_chunk, state, pcm)
+
+    def _save(self, stream_ref, snapshot, state: Dict[str, Any]) -> bool:
+        """Write the state back unless another chunk changed it since snapshot was read"""
+        data = {**state, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=STREAM_IDLE_SECONDS)}
+        try:
+            if snapshot.exists:
+                stream_ref.update(data, option=self.db.write_option(last_update_time=snapshot.update_time))
+            else:
+                stream_ref.create(data)
+        except (FailedPrecondition, AlreadyExists, Conflict):
+            self.conflicts += 1
+            return False
+        return True
+
+    async def process(self, attempt_id: str, pcm: bytes, sample_rate: int) -> Optional[Dict[str, Any]]:
+        """Results of the attempt's next chunk, None when the pool queue is full"""
+        if self.in_flight >= self.max_in_flight:
+            self.rejected_busy += 1
+            return None
+        now = time.monotonic()
+        if len(self._seen) > 10000:
+            self._forget_idle(now)
+        self._seen[attempt_id] = now
+        stream_ref = self.db.collection(STREAMS_COLLECTION).document(attempt_id)
+        self.in_flight += 1
+        try:
+            # Chunks of an attempt depend on the previous one's state: one at a time per
+            # worker, and the version check serialises them across workers
+            async with self._locks.setdefault(attempt_id, asyncio.Lock()):
+                for _ in range(MAX_STATE_ATTEMPTS):
+                    snapshot = await asyncio.to_thread(stream_ref.get)
+                    state = snapshot.to_dict() if snapshot.exists else None
+                    if state is None or state.get("sample_rate") != sample_rate:
+                        state = new_state(sample_rate)
+                    state.pop("expires_at", None)
+                    state["leftover"] = bytes(state["leftover"])
+                    state, result = await self._analyse(state, pcm)
+                    if await asyncio.to_thread(self._save, stream_ref, snapshot, state):
+                        break
+                else:
+                    raise RuntimeError("Flux audio modifié en parallèle, segment non analysé")
+        finally:
+            self.in_flight -= 1
+        self.seconds += len(pcm) / 2 / sample_rate
+        return {**result, "stream_seconds": round(state["frames"] * FRAME_SECONDS, 2)}
+
+    def forget(self, attempt_id: str):
+        """Drop the attempt's lock; its state document expires with the TTL"""
+        self._locks.pop(attempt_id, None)
+        self._seen.pop(attempt_id, None)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "active_streams": len(self._locks),
+            "in_flight": self.in_flight,
+            "audio_seconds": round(self.seconds, 1),
+            "rejected_busy": self.rejected_busy,
+            "pool_restarts": self.pool_restarts,
+            "conflicts": self.conflicts,
+        }
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    sample_rate, seconds = 16000, 600
+    t = np.arange(sample_rate * seconds) / sample_rate
+
+    # Alternating 2-8 s stretches of silence and "speech": harmonics of a gliding pitch,
+    # shaped by a 4 Hz syllable envelope, over a fan-like noise floor
+    truth = np.zeros(len(t), dtype=bool)
+    position = 0
+    while position < len(t):
+        length = int(rng.uniform(2, 8) * sample_rate)
+        truth[position:position + length] = rng.random() < 0.4
+        position += length
+    pitch = 150 + 40 * np.sin(2 * np.pi * 0.3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 12))
+    syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0.1, None)
+    noise = rng.normal(0, 0.01, len(t))
+    audio = np.where(truth, 0.15 * voice * syllables, 0) + noise
+    pcm = (np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes()
+    chunk_bytes = sample_rate * 2  # 1 s chunks
+
+    state, voiced, events = new_state(sample_rate), [], []
+    start = time.perf_counter()
+    for offset in range(0, len(pcm), chunk_bytes):
+        state, result = process_chunk(state, pcm[offset:offset + chunk_bytes])
+        events += result["events"]
+    elapsed = time.perf_counter() - start
+    print(f"{seconds} s of audio in {elapsed * 1000:.0f} ms: {seconds / elapsed:,.0f}x real time per core "
+          f"({elapsed / seconds * 1000:.2f} ms per 1 s chunk)")
+
+    frame_size = int(sample_rate * FRAME_SECONDS)
+    frame_truth = truth[:len(truth) // frame_size * frame_size].reshape(-1, frame_size).mean(axis=1) > 0.5
+    detected = np.zeros(len(frame_truth), dtype=bool)
+    for event in events:
+        detected[int(event["start"] / FRAME_SECONDS):int(event["end"] / FRAME_SECONDS)] = True
+    print(f"{len(events)} speech segments, frame accuracy {np.mean(detected == frame_truth):.3f}, "
+          f"false speech {np.mean(detected[~frame_truth]):.3f}, missed speech {np.mean(~detected[frame_truth]):.3f}")